@@ -5,7 +5,6 @@ import asyncio
 import random
 import time 
 import uuid 
-import json 
 # from collections import defaultdict # 似乎未使用，可以移除
 
 from astrbot.api.all import (
@@ -36,18 +35,19 @@ except ImportError:
 from .utils import ( 
     DecisionModule, LLMModule, PersonaUtils, HistoryStorage, MessageUtils, ImageCaptionUtils 
 )
+from .utils.chain_registry import ChainTaskRegistry
+from .utils.platform_registry import PlatformRegistry
+from .utils.history_summarizer import HistorySummarizer
+from .utils.history_retrieval import HistoryRetrieval
+from .utils.image_normalizer import ImageNormalizer
+from .utils.bot_profile import BotProfile
+from .utils.runtime_config import RelayRuntimeConfig, ConfigFileWatcher, RELOADABLE_CONFIG_KEYS
+from .utils.relay_stats import RelayStats
 from typing import Optional, Dict, List, Any, Union
 
-DEFAULT_LIST_STR_TYPEHINT: List[str] = [] 
-DEFAULT_MAX_INTERNAL_CHAIN_DEPTH = 1 
-DEFAULT_INITIAL_REPLY_MIN_DELAY = 0.1 
-DEFAULT_INITIAL_REPLY_MAX_DELAY = 0.8
-DEFAULT_INTERNAL_CHAIN_MIN_DELAY = 1.0 
-DEFAULT_INTERNAL_CHAIN_MAX_DELAY = 3.0 
-DEFAULT_GLOBAL_CHAIN_REPLY_PROBABILITY = 0.75
-DEFAULT_GLOBAL_BASE_REPLY_PROBABILITY = 0.1
 DEFAULT_CONVERSATION_INCENTIVE_PROB = 0.90
 DEFAULT_CONVERSATION_INCENTIVE_DURATION = 120
+DEFAULT_CONFIG_WATCH_INTERVAL = 10.0
 
 @register( "relaychat", "HikariFroya", "多Bot配置轮流连锁回复插件", "1.0.18" ) # 版本递增
 class RelayChatPlugin(Star):
@@ -63,8 +63,9 @@ class RelayChatPlugin(Star):
             logger.warning(f"{plugin_instance_name_for_log}: 钩子: hook数据中缺少 'persona_name'。"); return
         
         logger.info(f"{plugin_instance_name_for_log}: 钩子: 尝试为LLM请求应用人格 '{persona_name_to_apply}'。")
-        final_system_prompt = PersonaUtils.get_persona_system_prompt(self.context, persona_name_to_apply)
-        final_model = PersonaUtils.get_persona_model(self.context, persona_name_to_apply) 
+        with RelayStats.timer("persona_hook", persona_name_to_apply): resolved_persona = PersonaUtils.resolve_persona(self.context, persona_name_to_apply) # 索引命中，一次字典查找
+        final_system_prompt = resolved_persona.system_prompt if resolved_persona else None
+        final_model = resolved_persona.model if resolved_persona else None
         
         original_req_sys_prompt_preview = request.system_prompt[:100] if request.system_prompt else '[空]'
 
@@ -76,66 +77,105 @@ class RelayChatPlugin(Star):
             logger.warning(f"{plugin_instance_name_for_log}: 钩子: 未为 '{persona_name_to_apply}' 应用System Prompt. 当前请求提示 (开头): '{original_req_sys_prompt_preview}'.")
         
         if final_model: 
-            logger.info(f"{plugin_instance_name_for_log}: 钩子: 人格 '{persona_name_to_apply}' 建议模型 '{final_model}'.")
-            event.set_extra("relay_model_to_use", final_model)
+            logger.info(f"{plugin_instance_name_for_log}: 钩子: 为人格 '{persona_name_to_apply}' 应用模型 '{final_model}'.")
+            request.model = final_model # 由 Provider 按请求中的 model 调用；未设置时使用 Provider 的默认模型
         else: 
             logger.debug(f"{plugin_instance_name_for_log}: 钩子: 未通过 PersonaUtils 找到人格 '{persona_name_to_apply}' 的特定模型。")
-            event.set_extra("relay_model_to_use", None)
         
         logger.debug(f"{plugin_instance_name_for_log}: 钩子结束: request.system_prompt (应用后开头100字符) = '{request.system_prompt[:100] if request.system_prompt else '[空]'}'")
 
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("relay_reload_personas")
+    async def reload_personas_command(self, event: AstrMessageEvent):
+        '''重新加载 RelayChat 的人格索引 (修改全局人格后使用)'''
+        persona_count = PersonaUtils.reload(self.context)
+        logger.info(f"RelayChatPlugin: 管理员 {event.get_sender_id()} 重新加载了人格索引，共 {persona_count} 个人格。")
+        yield event.plain_result(f"RelayChat: 人格索引已重新加载，共 {persona_count} 个人格。")
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("relaystats")
+    async def relay_stats_command(self, event: AstrMessageEvent, action: str = ""):
+        '''查看 RelayChat 各阶段耗时和计数；/relaystats reset 清零'''
+        if action.strip().lower() == "reset":
+            RelayStats.reset(); logger.info(f"RelayChatPlugin: 管理员 {event.get_sender_id()} 清零了统计。")
+            yield event.plain_result("RelayChat: 统计已清零。"); return
+        yield event.plain_result(RelayStats.format_report())
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("relay_reload")
+    async def reload_config_command(self, event: AstrMessageEvent):
+        '''重新读取 RelayChat 配置 (managed_bots、延迟、概率、连锁深度等)，无需重启插件'''
+        self.config_watcher.ensure_started()
+        from_file = await self.config_watcher.refresh_from_file()
+        changed_keys = self.reload_runtime(f"管理员 {event.get_sender_id()} 执行 /relay_reload")
+        if changed_keys is None: yield event.plain_result("RelayChat: 新配置解析失败，继续使用当前配置，详见日志。"); return
+        restart_keys = [k for k in changed_keys if k not in RELOADABLE_CONFIG_KEYS]
+        reloaded_keys = [k for k in changed_keys if k in RELOADABLE_CONFIG_KEYS]
+        source_note = "已重新读取配置文件" if from_file else "使用内存中的配置"
+        if not reloaded_keys: result = f"RelayChat: {source_note}，可热重载的配置没有变化 (v{self.runtime.version})。"
+        else: result = f"RelayChat: {source_note}，已切换到配置 v{self.runtime.version}，共 {len(self.runtime.bot_profiles)} 个Bot。变化: {', '.join(reloaded_keys)}"
+        if restart_keys: result += f"\n以下配置需重启插件才会生效: {', '.join(restart_keys)}"
+        yield event.plain_result(result)
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config; self.context = context 
         logger.info(f"========== RelayChatPlugin 单例已创建 (对象 ID: {id(self)}) ==========")
         logger.info(f"RelayChatPlugin __init__: 收到全局插件配置: {self.config}")
+        RelayStats.init(self.config)
+        ImageNormalizer.init(self.config)
         if hasattr(HistoryStorage, 'init'): HistoryStorage.init(self.config) # 传递插件配置给HistoryStorage
+        HistorySummarizer.init(self.context, self.config) # 需在 HistoryStorage.init 之后，摘要存放在历史目录下
+        HistoryRetrieval.init(self.config)
         if hasattr(ImageCaptionUtils, 'init'): ImageCaptionUtils.init(self.context, self.config)
-        self.max_chain_depth: int = int(self.config.get("max_chain_depth", DEFAULT_MAX_INTERNAL_CHAIN_DEPTH))
-        self.initial_min_delay: float = float(self.config.get("initial_reply_min_delay_seconds", DEFAULT_INITIAL_REPLY_MIN_DELAY))
-        self.initial_max_delay: float = float(self.config.get("initial_reply_max_delay_seconds", DEFAULT_INITIAL_REPLY_MAX_DELAY))
-        logger.debug(f"RelayChatPlugin __init__: 初始回复延迟范围: {self.initial_min_delay}s - {self.initial_max_delay}s")
-        self.chain_min_delay: float = float(self.config.get("chain_reply_min_delay_seconds", DEFAULT_INTERNAL_CHAIN_MIN_DELAY))
-        self.chain_max_delay: float = float(self.config.get("chain_reply_max_delay_seconds", DEFAULT_INTERNAL_CHAIN_MAX_DELAY))
-        logger.debug(f"RelayChatPlugin __init__: 连锁回复延迟范围: {self.chain_min_delay}s - {self.chain_max_delay}s")
-        self.default_global_chain_reply_probability = float(self.config.get("default_global_chain_reply_probability", DEFAULT_GLOBAL_CHAIN_REPLY_PROBABILITY))
-        self.default_global_base_reply_probability = float(self.config.get("default_global_base_reply_probability", DEFAULT_GLOBAL_BASE_REPLY_PROBABILITY))
-        self.default_global_keywords: List[str] = self.config.get("default_global_keywords", DEFAULT_LIST_STR_TYPEHINT)
-        self.default_global_blacklist: List[str] = self.config.get("default_global_blacklist", DEFAULT_LIST_STR_TYPEHINT)
-        self.managed_bot_configs: Dict[str, Dict[str, Any]] = {} 
-        managed_bots_str_list = self.config.get("managed_bots", [])
-        if not isinstance(managed_bots_str_list, list): managed_bots_str_list = []
-        for i, bot_config_str in enumerate(managed_bots_str_list):
-            if not isinstance(bot_config_str, str) or not bot_config_str.strip(): logger.warning(f"RelayChatPlugin: managed_bots 条目 #{i} 为空或非字符串: '{bot_config_str}'"); continue
-            parts = bot_config_str.split("::")
-            if len(parts) < 7: logger.warning(f"RelayChatPlugin: managed_bots 条目 #{i} 格式不正确 (应至少7段,实为{len(parts)}段): '{bot_config_str}'"); continue
-            try:
-                platform_id, persona, bot_uid = parts[0].strip(), parts[1].strip(), parts[2].strip()
-                kw_str = parts[3].strip(); kws = json.loads(kw_str) if kw_str else self.default_global_keywords
-                if not isinstance(kws, list): kws = self.default_global_keywords
-                base_p_str = parts[4].strip(); base_p = float(base_p_str) if base_p_str else self.default_global_base_reply_probability
-                chain_p_str = parts[5].strip(); chain_p = float(chain_p_str) if chain_p_str else self.default_global_chain_reply_probability
-                bl_str = parts[6].strip(); bl_kws = json.loads(bl_str) if bl_str else self.default_global_blacklist
-                if not isinstance(bl_kws, list): bl_kws = self.default_global_blacklist
-                if platform_id and persona and bot_uid:
-                    self.managed_bot_configs[platform_id] = {"platform_instance_id": platform_id, "persona_name": persona, "vocechat_bot_uid": bot_uid, "keywords": kws, "base_reply_probability": base_p, "chain_reply_probability": chain_p, "blacklist_keywords": bl_kws }
-                    logger.info(f"RelayChatPlugin: 已解析平台 '{platform_id}' 的Bot配置: 人格='{persona}', UID='{bot_uid}'.")
-                else: logger.warning(f"RelayChatPlugin: managed_bots 条目 #{i} 缺少关键的平台ID/人格名/BotUID: '{bot_config_str}'")
-            except (IndexError, ValueError, json.JSONDecodeError) as e: logger.warning(f"RelayChatPlugin: 解析 managed_bots 条目 #{i} '{bot_config_str}' 时出错: {e}")
-        if not self.managed_bot_configs: logger.error("RelayChatPlugin: 未从 'managed_bots' 配置中解析出任何有效的Bot配置。")
-        self.decision_module = DecisionModule(self.config, self.managed_bot_configs) 
-        self.llm_module = LLMModule(self.context, self.config) 
-        self.active_chain_tasks: Dict[str, asyncio.Task] = {}; self.chain_scheduler_lock = asyncio.Lock()
-        logger.info(f"RelayChatPlugin (单例) 初始化完成。共解析 {len(self.managed_bot_configs)} 个Bot配置。")
+        # 连锁深度、延迟、Bot档案、决策模块和LLM模块放在同一个只读快照中，重载时整体替换
+        self.runtime = RelayRuntimeConfig(self.context, self.config)
+        if not len(self.runtime.bot_profiles): logger.error("RelayChatPlugin: 未从 'managed_bots' 配置中解析出任何有效的Bot配置。")
+        self._failed_config_fingerprint: Optional[str] = None
+        self.config_watcher = ConfigFileWatcher(self.config, float(self.config.get("config_watch_interval_seconds", DEFAULT_CONFIG_WATCH_INTERVAL)), self.reload_runtime)
+        self.chain_registry = ChainTaskRegistry() # 按会话/原始消息ID索引的连锁任务，锁按会话分片
+        self.platform_registry = PlatformRegistry(self.context) # 平台实例在插件加载后才可能就绪，首次查找时建立索引
+        for source_name, stats_fn in (("runtime", lambda: {"config_version": self.runtime.version, "bots": len(self.runtime.bot_profiles)}),
+                                      ("incentives", DecisionModule.get_state_stats), ("llm_locks", LLMModule.get_state_stats),
+                                      ("chains", self.chain_registry.stats), ("formatted_history", MessageUtils.get_cache_stats),
+                                      ("history", HistoryStorage.get_stats), ("retrieval", HistoryRetrieval.stats),
+                                      ("captions", ImageCaptionUtils.stats), ("image_normalizer", ImageNormalizer.stats)):
+            RelayStats.register_source(source_name, stats_fn) # 各模块已有的状态统计，查看统计时再读取
+        logger.info(f"RelayChatPlugin (单例) 初始化完成。共解析 {len(self.runtime.bot_profiles)} 个Bot配置。")
+
+    def reload_runtime(self, reason: str) -> Optional[List[str]]:
+        # 可热重载的配置有变化时构建新快照并一次性替换；连锁任务、平台索引、历史及各类缓存都不受影响。
+        # 返回与当前快照相比变化的配置项，新配置无法解析时返回 None 并继续使用当前快照
+        current_runtime = self.runtime
+        fingerprint = RelayRuntimeConfig.fingerprint_of(self.config)
+        changed_keys = current_runtime.changed_keys(self.config)
+        if fingerprint == current_runtime.fingerprint: return changed_keys
+        if fingerprint == self._failed_config_fingerprint: return None # 同一份错误配置只报告一次
+        try: new_runtime = RelayRuntimeConfig(self.context, self.config, version=current_runtime.version + 1)
+        except Exception as e:
+            self._failed_config_fingerprint = fingerprint
+            logger.error(f"RelayChatPlugin: {reason}: 新配置解析失败，继续使用配置 v{current_runtime.version}: {e}", exc_info=True); return None
+        if not len(new_runtime.bot_profiles): logger.error("RelayChatPlugin: 未从 'managed_bots' 配置中解析出任何有效的Bot配置。")
+        self.runtime = new_runtime; self._failed_config_fingerprint = None
+        HistorySummarizer.configure_window(self.config) # 摘要窗口默认跟随 llm_max_history_default，保持与发送的历史窗口衔接
+        logger.info(f"RelayChatPlugin: {reason}: 已切换到配置 v{new_runtime.version}，共 {len(new_runtime.bot_profiles)} 个Bot。变化的配置项: {changed_keys}")
+        restart_keys = [k for k in changed_keys if k not in RELOADABLE_CONFIG_KEYS]
+        if restart_keys: logger.warning(f"RelayChatPlugin: 以下配置需重启插件才会生效: {restart_keys}")
+        return changed_keys
 
     async def __aexit__(self, exc_type, exc_val, exc_tb): 
         logger.info(f"RelayChatPlugin (单例): 正在关闭，清理连锁任务...")
-        async with self.chain_scheduler_lock: 
-            for task_key in list(self.active_chain_tasks.keys()): # Iterate over keys to allow popping
-                task = self.active_chain_tasks.pop(task_key, None)
-                if task and not task.done(): 
-                    task.cancel()
-                    logger.debug(f"RelayChatPlugin (单例): 已取消关闭前的连锁任务 (TaskKey: {task_key})。")
+        await self.config_watcher.stop()
+        try: await RelayStats.shutdown() # 需在 HistoryStorage.shutdown 关闭 I/O 线程池之前写出最后一次统计
+        except Exception as e: logger.error(f"RelayChatPlugin (单例): 关闭时写出统计出错: {e}", exc_info=True)
+        cancelled_chain_count = self.chain_registry.cancel_all()
+        if cancelled_chain_count: logger.debug(f"RelayChatPlugin (单例): 已取消关闭前的 {cancelled_chain_count} 个连锁任务。")
+        try: await HistorySummarizer.shutdown()
+        except Exception as e: logger.error(f"RelayChatPlugin (单例): 关闭时停止摘要任务出错: {e}", exc_info=True)
+        try: await HistoryStorage.shutdown() # 写回缓存中尚未落盘的历史
+        except Exception as e: logger.error(f"RelayChatPlugin (单例): 关闭时写回历史出错: {e}", exc_info=True)
+        DecisionModule._active_conversation_sessions.stop(); LLMModule._llm_in_progress_status.stop()
+        ImageNormalizer.shutdown()
         logger.info(f"RelayChatPlugin (单例): 关闭完成。"); await super().__aexit__(exc_type, exc_val, exc_tb)
 
     def _get_event_platform_id(self, event: AstrMessageEvent) -> str:
@@ -160,21 +200,24 @@ class RelayChatPlugin(Star):
     async def _common_message_handler(self, event: AstrMessageEvent, message_type_str: str):
         event_platform_id = self._get_event_platform_id(event)
         _is_chain_event, _chain_depth, _last_replier_persona, _orig_mid, _orig_sender_id = self._get_chain_info_from_event(event)
-        bot_specific_config = self.managed_bot_configs.get(event_platform_id)
+        runtime = self.runtime # 本事件全程使用同一份配置快照，处理中途重载不会混用新旧配置
+        self.config_watcher.ensure_started(); RelayStats.ensure_dump_task()
+        bot_specific_config = runtime.bot_profiles.get(event_platform_id)
         if not _is_chain_event: # 仅对非连锁的初始事件检查LLM锁
             llm_lock_key = LLMModule.get_llm_lock_key(event)
-            if LLMModule.is_llm_in_progress_sync(llm_lock_key): logger.debug(f"RelayChatPlugin ({event_platform_id}): LLM锁 '{llm_lock_key}' 已被占用。忽略此初始事件。"); return
+            if LLMModule.is_llm_in_progress_sync(llm_lock_key):
+                RelayStats.incr("lock_contention", bot_specific_config.persona_name if bot_specific_config else None, "llm_initial_event", session=event.get_session_id())
+                logger.debug(f"RelayChatPlugin ({event_platform_id}): LLM锁 '{llm_lock_key}' 已被占用。忽略此初始事件。"); return
         if not _is_chain_event and not bot_specific_config: return # 初始事件但此平台未配置Bot
         if not bot_specific_config and _is_chain_event: logger.debug(f"RelayChatPlugin ({event_platform_id}): 收到连锁事件，但此平台未配置Bot。放弃处理。"); return
         elif not bot_specific_config: return # 其他未配置情况
         if _orig_mid: event.set_extra("relay_original_user_message_id", _orig_mid)
         if _orig_sender_id: event.set_extra("relay_original_user_sender_id", _orig_sender_id)
-        serving_persona_for_log = bot_specific_config['persona_name']
+        serving_persona_for_log = bot_specific_config.persona_name
+        RelayStats.incr("events", serving_persona_for_log, "chain" if _is_chain_event else "initial", session=event.get_session_id())
         log_prefix = f"RelayChatPlugin (平台: {event_platform_id}, 服务人格: {serving_persona_for_log})"
         logger.debug(f"{log_prefix}: 收到 {message_type_str}。连锁:{_is_chain_event}, 深度:{_chain_depth}, 上个回复者:{_last_replier_persona or '无'}, 原始消息ID:{_orig_mid or '无'}")
-        if not _is_chain_event and self.initial_min_delay < self.initial_max_delay and (self.initial_max_delay > 0) : # 确保延迟有意义
-            await asyncio.sleep(round(random.uniform(self.initial_min_delay, self.initial_max_delay), 2))
-        async for result in self._handle_event(event, bot_specific_config, _is_chain_event, _chain_depth, _last_replier_persona): yield result
+        async for result in self._handle_event(runtime, event, bot_specific_config, _is_chain_event, _chain_depth, _last_replier_persona): yield result
 
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent): 
@@ -183,30 +226,33 @@ class RelayChatPlugin(Star):
     async def on_private_message(self, event: AstrMessageEvent): 
         async for res in self._common_message_handler(event, "私聊消息"): yield res
 
-    async def _handle_event(self, event: AstrMessageEvent, bot_specific_config: Dict[str, Any], is_chain_event: bool, chain_depth: int, last_replier_persona: Optional[str]):
-        current_persona_name = bot_specific_config["persona_name"]
-        log_prefix = f"RelayChatPlugin (平台: {bot_specific_config['platform_instance_id']}, 处理人格: {current_persona_name})"
+    async def _handle_event(self, runtime: RelayRuntimeConfig, event: AstrMessageEvent, bot_specific_config: BotProfile, is_chain_event: bool, chain_depth: int, last_replier_persona: Optional[str]):
+        current_persona_name = bot_specific_config.persona_name
+        log_prefix = f"RelayChatPlugin (平台: {bot_specific_config.platform_instance_id}, 处理人格: {current_persona_name})"
+        reply_deadline = time.monotonic()
+        if not is_chain_event and runtime.initial_min_delay < runtime.initial_max_delay and (runtime.initial_max_delay > 0) : # 确保延迟有意义
+            reply_deadline += round(random.uniform(runtime.initial_min_delay, runtime.initial_max_delay), 2)
         if not is_chain_event:
-            await HistoryStorage.process_and_save_user_message(event)
             original_user_mid_str = event.get_extra("relay_original_user_message_id") 
             if not original_user_mid_str: 
                 original_user_mid_str = str(event.message_obj.message_id if event.message_obj and hasattr(event.message_obj, 'message_id') else uuid.uuid4())
                 event.set_extra("relay_original_user_message_id", original_user_mid_str)
             if not event.get_extra("relay_original_user_sender_id"): event.set_extra("relay_original_user_sender_id", event.get_sender_id())
-            async with self.chain_scheduler_lock:
-                task_keys_to_remove_or_cancel = [k for k in self.active_chain_tasks if k.startswith(str(original_user_mid_str))]
-                for task_key in task_keys_to_remove_or_cancel:
-                    task = self.active_chain_tasks.pop(task_key, None)
-                    if task and not task.done(): task.cancel(); logger.info(f"{log_prefix}: 新用户消息 (OrigMID {original_user_mid_str})，已取消之前的连锁任务 (TaskKey: {task_key})。")
+            # 连锁按引发它的那条用户消息登记，所以要取消本会话中其他消息引发的全部连锁，而不是只查当前消息ID
+            for task_key in await self.chain_registry.cancel_session(event.get_session_id(), keep_origin=str(original_user_mid_str)):
+                logger.info(f"{log_prefix}: 新用户消息 (OrigMID {original_user_mid_str})，已取消之前的连锁任务 (TaskKey: {task_key})。")
+                RelayStats.incr("chains_cancelled", current_persona_name, session=event.get_session_id())
         
-        should_plugin_reply = self.decision_module.should_reply(event, bot_specific_config, is_chain_event)
+        # 先做廉价的回复决策：不回复的Bot只保存历史，不再等待回复延迟
+        with RelayStats.timer("decision", current_persona_name): should_plugin_reply = runtime.decision_module.should_reply(event, bot_specific_config, is_chain_event)
+        if not is_chain_event and not should_plugin_reply: await HistoryStorage.process_and_save_user_message(event)
         if event.get_message_type() == MessageType.FRIEND_MESSAGE and not is_chain_event and not should_plugin_reply:
             logger.info(f"{log_prefix}: 本插件决定不回复此私聊消息 (连锁:{is_chain_event})。停止事件传播。")
             event.stop_event(); return
         
         logger.info(f"{log_prefix}: 处理消息. 连锁:{is_chain_event}, 深度:{chain_depth}, 上个回复者:{last_replier_persona or '无'}")
         am_i_qualified = (not is_chain_event) or (current_persona_name != last_replier_persona)
-        if not am_i_qualified: logger.debug(f"{log_prefix}: 不符合回复条件 (原因: 连锁且与上个回复者人格相同)。"); return
+        if not am_i_qualified: RelayStats.incr("reply_suppressed", current_persona_name, "same_persona"); logger.debug(f"{log_prefix}: 不符合回复条件 (原因: 连锁且与上个回复者人格相同)。"); return
         
         if should_plugin_reply: 
             logger.info(f"{log_prefix}: 决策模块: 是，将回复。")
@@ -214,29 +260,57 @@ class RelayChatPlugin(Star):
             hook_config_for_extra = {"persona_name": current_persona_name, "bot_specific_config": bot_specific_config }
             event.set_extra("relay_current_reply_config_for_hook", hook_config_for_extra)
             event.set_extra("relay_is_chain", is_chain_event); event.set_extra("relay_chain_depth", chain_depth)
-            event.set_extra("relay_triggering_event_platform_meta_id", bot_specific_config['platform_instance_id'])
+            event.set_extra("relay_triggering_event_platform_meta_id", bot_specific_config.platform_instance_id)
             event.set_extra("relay_triggering_event_platform_meta_name", event.platform_meta.name if event.platform_meta else "unknown_platform_name")
             event.set_extra("relay_triggering_event_session_id", event.get_session_id())
             event.set_extra("relay_triggering_event_message_type", event.get_message_type())
             if last_replier_persona: event.set_extra("relay_last_replier_persona", last_replier_persona)
 
-            self.decision_module.activate_reply_incentive(event) 
+            runtime.decision_module.activate_reply_incentive(event) 
             
-            async for llm_obj in self.llm_module.prepare_and_yield_request(event): yield llm_obj
+            prebuilt_request = None
+            if not is_chain_event: prebuilt_request = await self._prepare_request_within_delay(runtime, event, bot_specific_config, reply_deadline, log_prefix)
+            async for llm_obj in runtime.llm_module.prepare_and_yield_request(event, prebuilt_reply=event.get_extra("relay_speculative_reply"), prebuilt_request=prebuilt_request): yield llm_obj
         else: logger.debug(f"{log_prefix}: 决策模块: 否，不回复。")
         
+    async def _prepare_request_within_delay(self, runtime: RelayRuntimeConfig, event: AstrMessageEvent, bot_specific_config: BotProfile, reply_deadline: float, log_prefix: str) -> Optional[Union[ProviderRequest, LLMResponse]]:
+        # 保存历史和组装提示词与剩余的回复延迟并行；LLM锁仍在延迟结束后获取，由延迟先结束的Bot赢得回复权
+        async def save_and_build():
+            await HistoryStorage.process_and_save_user_message(event)
+            return await runtime.llm_module.build_provider_request(event, bot_specific_config)
+        started_at = time.monotonic()
+        prepare_task = asyncio.create_task(save_and_build())
+        try:
+            remaining_delay = reply_deadline - started_at
+            if remaining_delay > 0:
+                RelayStats.observe("initial_delay", remaining_delay, bot_specific_config.persona_name)
+                await asyncio.sleep(remaining_delay)
+            delay_done_at = time.monotonic()
+            prebuilt_request = await prepare_task
+            RelayStats.observe("prepare_overrun", time.monotonic() - delay_done_at, bot_specific_config.persona_name) # 延迟结束后仍在等待保存历史和组装请求的时间
+            logger.debug(f"{log_prefix}: 请求准备完成，延迟 {max(remaining_delay, 0):.2f}s，总等待 {time.monotonic() - started_at:.2f}s。")
+            return prebuilt_request
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            logger.error(f"{log_prefix}: 在回复延迟期间准备请求出错: {e}", exc_info=True); return None
+        finally:
+            if not prepare_task.done(): prepare_task.cancel()
+
     @filter.after_message_sent(priority=10) 
     async def _after_my_reply_sent(self, event: AstrMessageEvent):
         hook_config_val = event.get_extra("relay_current_reply_config_for_hook"); 
         if not (hook_config_val and isinstance(hook_config_val, dict)): logger.debug("RelayChatPlugin AfterSent: 未找到hook配置。跳过连锁。"); return
         bot_specific_config_from_hook = hook_config_val.get("bot_specific_config")
-        if not (bot_specific_config_from_hook and isinstance(bot_specific_config_from_hook, dict)): logger.warning("RelayChatPlugin AfterSent: hook数据中bot_specific_config无效。跳过连锁。"); return
+        if not isinstance(bot_specific_config_from_hook, BotProfile): logger.warning("RelayChatPlugin AfterSent: hook数据中bot_specific_config无效。跳过连锁。"); return
         event_platform_id = self._get_event_platform_id(event) 
-        if bot_specific_config_from_hook.get("platform_instance_id") != event_platform_id: return
-        replied_bot_config = bot_specific_config_from_hook; replied_persona_name = replied_bot_config.get("persona_name")
-        replied_bot_physical_id_that_just_spoke = replied_bot_config.get("vocechat_bot_uid")
+        if bot_specific_config_from_hook.platform_instance_id != event_platform_id: return
+        runtime = self.runtime
+        replied_bot_config = bot_specific_config_from_hook; replied_persona_name = replied_bot_config.persona_name
+        replied_bot_physical_id_that_just_spoke = replied_bot_config.vocechat_bot_uid
         log_prefix = f"RelayChatPlugin ({event_platform_id}, 已回复人格: {replied_persona_name}) AfterSent"
         depth_val = event.get_extra("relay_chain_depth"); current_reply_depth = int(depth_val) if depth_val is not None else 0
+        llm_requested_at = event.get_extra("relay_llm_requested_at")
+        if llm_requested_at: RelayStats.observe("llm_round_trip", time.perf_counter() - llm_requested_at, replied_persona_name) # 请求交给AstrBot到回复发出
         actual_reply_chain: Optional[List[BaseMessageComponent]] = None
         if hasattr(event, '_result') and event._result : # _result 可能是 LLMResponse 或 AstrBotMessage
             if isinstance(event._result, LLMResponse) and hasattr(event._result, 'result_chain') and event._result.result_chain: actual_reply_chain = event._result.result_chain.chain
@@ -250,49 +324,52 @@ class RelayChatPlugin(Star):
             try: await HistoryStorage.process_and_save_bot_reply(event, actual_reply_chain, str(replied_bot_physical_id_that_just_spoke), str(replied_persona_name))
             except Exception as e_h: logger.error(f"{log_prefix}: 保存Bot回复历史出错: {e_h}", exc_info=True)
             logger.info(f"{log_prefix}: 回复已发送 (原始事件深度: {current_reply_depth})。")
+            RelayStats.incr("replies", replied_persona_name, "chain" if current_reply_depth > 0 else "initial", session=event.get_session_id())
             
             original_trigger_message_type = event.get_extra("relay_triggering_event_message_type")
             if original_trigger_message_type != MessageType.GROUP_MESSAGE:
                 logger.info(f"{log_prefix}: 原始触发事件类型为 {original_trigger_message_type}，非群聊消息。跳过连锁调度。")
                 _cleanup_relay_extras(event); return
             
-            if current_reply_depth < self.max_chain_depth:
+            if current_reply_depth < runtime.max_chain_depth:
                 original_user_mid_val = event.get_extra("relay_original_user_message_id"); original_user_sender_id_val = event.get_extra("relay_original_user_sender_id")
                 original_session_id = event.get_extra("relay_triggering_event_session_id") 
                 if not (original_user_mid_val and original_session_id): logger.warning(f"{log_prefix}: 缺少原始消息ID或会话ID，无法进行连锁。"); _cleanup_relay_extras(event); return
                 original_user_mid_str = str(original_user_mid_val); next_chain_depth = current_reply_depth + 1; triggered_chain_count = 0
-                for target_platform_id_str, target_bot_config_entry in self.managed_bot_configs.items():
-                    target_persona_name = target_bot_config_entry.get("persona_name")
-                    if target_persona_name == replied_persona_name: logger.debug(f"{log_prefix}: 跳过向自身人格 '{replied_persona_name}' (目标平台 '{target_platform_id_str}') 的连锁。"); continue
+                chain_candidate_configs: List[BotProfile] = []; schedule_started_at = time.perf_counter()
+                for target_bot_config_entry in runtime.bot_profiles: # 档案解析时已保证平台ID/人格名/BotUID非空
+                    if target_bot_config_entry.persona_name == replied_persona_name: logger.debug(f"{log_prefix}: 跳过向自身人格 '{replied_persona_name}' (目标平台 '{target_bot_config_entry.platform_instance_id}') 的连锁。"); continue
+                    chain_candidate_configs.append(target_bot_config_entry)
+                # 连锁回复的概率判定在这里预先完成，只为选中的Bot创建计时任务和模拟事件
+                # 所有目标共用同一会话的LLM锁，只有一个能发出回复；预生成只给第一个选中的Bot，避免为注定被丢弃的回复调用LLM
+                for speaker_index, target_bot_config_entry in enumerate(runtime.decision_module.select_chain_speakers(chain_candidate_configs)):
+                    target_platform_id_str = target_bot_config_entry.platform_instance_id; target_persona_name = target_bot_config_entry.persona_name
                     target_platform_type_name = event.get_extra("relay_triggering_event_platform_meta_name") or "vocechat"
-                    target_bot_physical_id_for_target_event = target_bot_config_entry.get("vocechat_bot_uid")
-                    if not target_bot_physical_id_for_target_event: logger.warning(f"{log_prefix}: 目标Bot '{target_persona_name}' (平台:'{target_platform_id_str}') 缺少 'vocechat_bot_uid'。跳过连锁。"); continue
-                    sim_event_platform_meta_for_target = PlatformMetadata( name=target_platform_type_name, id=target_platform_id_str, description=f"模拟连锁事件 for {target_platform_id_str}" )
+                    target_bot_physical_id_for_target_event = target_bot_config_entry.vocechat_bot_uid
+                    sim_event_platform_meta_for_target = self.platform_registry.get_chain_metadata(target_platform_type_name, target_platform_id_str)
                     logger.info(f"{log_prefix}: 安排群聊连锁: 从人格'{replied_persona_name}'(UID:{replied_bot_physical_id_that_just_spoke}) "
                                 f"到目标平台'{target_platform_id_str}'(目标人格'{target_persona_name}', 目标UID:{target_bot_physical_id_for_target_event}), "
                                 f"目标深度:{next_chain_depth}, 原始消息ID:{original_user_mid_str}, 会话ID:{original_session_id}.")
-                    async with self.chain_scheduler_lock:
-                        chain_task_key = f"{original_user_mid_str}_to_{target_platform_id_str}_depth{next_chain_depth}"
-                        if chain_task_key not in self.active_chain_tasks or self.active_chain_tasks[chain_task_key].done():
-                            self.active_chain_tasks[chain_task_key] = asyncio.create_task(
-                                self._schedule_internal_chain_trigger(
-                                    target_platform_meta = sim_event_platform_meta_for_target, target_session_id = original_session_id,
-                                    target_message_type = MessageType.GROUP_MESSAGE, replied_persona_name = str(replied_persona_name), 
-                                    replied_bot_physical_id = str(replied_bot_physical_id_that_just_spoke), 
-                                    target_bot_physical_id_for_self_id = str(target_bot_physical_id_for_target_event), 
-                                    replied_message_components = actual_reply_chain, chain_depth_for_next_event = next_chain_depth, 
-                                    original_user_message_id = original_user_mid_str,
-                                    original_user_sender_id = str(original_user_sender_id_val) if original_user_sender_id_val else "未知原始发送者" ))
-                            triggered_chain_count += 1
-                if triggered_chain_count == 0 and len(self.managed_bot_configs) > 1 : logger.info(f"{log_prefix}: 没有其他符合条件的Bot进行群聊连锁。")
+                    chain_task_key = f"{original_user_mid_str}_to_{target_platform_id_str}_depth{next_chain_depth}"
+                    scheduled = await self.chain_registry.schedule(
+                        original_session_id, original_user_mid_str, chain_task_key,
+                        lambda meta=sim_event_platform_meta_for_target, target_uid=target_bot_physical_id_for_target_event, speculate=(speaker_index == 0): self._schedule_internal_chain_trigger(
+                            target_platform_meta = meta, target_session_id = original_session_id,
+                            target_message_type = MessageType.GROUP_MESSAGE, replied_persona_name = str(replied_persona_name), 
+                            replied_bot_physical_id = str(replied_bot_physical_id_that_just_spoke), 
+                            target_bot_physical_id_for_self_id = str(target_uid), 
+                            replied_message_components = actual_reply_chain, chain_depth_for_next_event = next_chain_depth, 
+                            original_user_message_id = original_user_mid_str,
+                            original_user_sender_id = str(original_user_sender_id_val) if original_user_sender_id_val else "未知原始发送者",
+                            speculate = speculate ))
+                    if scheduled: triggered_chain_count += 1; RelayStats.incr("chains_scheduled", target_persona_name, f"depth{next_chain_depth}", session=original_session_id)
+                RelayStats.observe("chain_schedule", time.perf_counter() - schedule_started_at, replied_persona_name)
+                if triggered_chain_count == 0 and len(runtime.bot_profiles) > 1 : logger.info(f"{log_prefix}: 没有其他Bot被选中进行群聊连锁。")
                 elif triggered_chain_count > 0: logger.info(f"{log_prefix}: 已安排 {triggered_chain_count} 个群聊连锁事件。")
             else: 
-                logger.info(f"{log_prefix}: 已达到最大连锁深度 ({self.max_chain_depth}) (当前回复深度: {current_reply_depth})。")
-                original_user_mid_val = event.get_extra("relay_original_user_message_id")
-                if original_user_mid_val: 
-                    async with self.chain_scheduler_lock: 
-                        keys_to_pop = [k for k,v in self.active_chain_tasks.items() if k.startswith(str(original_user_mid_val)) and v.done()]
-                        for k_pop in keys_to_pop: self.active_chain_tasks.pop(k_pop, None) # 清理已完成的任务
+                RelayStats.incr("chain_depth_limit", replied_persona_name)
+                logger.info(f"{log_prefix}: 已达到最大连锁深度 ({runtime.max_chain_depth}) (当前回复深度: {current_reply_depth})。")
+                # 已完成的连锁任务由 ChainTaskRegistry 在任务结束时自动移除，无需再扫描
         else: logger.debug(f"{log_prefix}: 无实际回复内容。跳过历史保存和连锁。")
         _cleanup_relay_extras(event)
 
@@ -302,10 +379,14 @@ class RelayChatPlugin(Star):
                                              target_bot_physical_id_for_self_id: str, 
                                              replied_message_components: List[BaseMessageComponent], 
                                              chain_depth_for_next_event: int, original_user_message_id: str, 
-                                             original_user_sender_id: str):
+                                             original_user_sender_id: str, speculate: bool = False):
         session_key_for_log = f"{target_platform_meta.id or '未知'}@{target_session_id or '未知'}"
-        if self.chain_min_delay < self.chain_max_delay and self.chain_max_delay > 0: # 确保延迟有意义
-            await asyncio.sleep(round(random.uniform(self.chain_min_delay, self.chain_max_delay), 2))
+        runtime = self.runtime # 延迟结束前发生的重载不影响本次连锁
+        speculate = speculate and runtime.chain_speculative_generation
+        chain_delay = 0.0
+        if runtime.chain_min_delay < runtime.chain_max_delay and runtime.chain_max_delay > 0: # 确保延迟有意义
+            chain_delay = round(random.uniform(runtime.chain_min_delay, runtime.chain_max_delay), 2)
+        if chain_delay > 0 and not speculate: await asyncio.sleep(chain_delay) # 预生成模式下延迟与LLM调用并行
             
         log_prefix = f"RelayChatPlugin 连锁 ({session_key_for_log}, 来自人格: {replied_persona_name}, 来自BotUID: {replied_bot_physical_id}, 目标平台: {target_platform_meta.id})"
         logger.info(f"{log_prefix}: 安排连锁事件, 类型: {target_message_type}, 目标深度: {chain_depth_for_next_event}.")
@@ -319,17 +400,10 @@ class RelayChatPlugin(Star):
             elif target_message_type == MessageType.FRIEND_MESSAGE: new_msg_obj.group_id = None; new_msg_obj.session_id = target_session_id 
             else: new_msg_obj.group_id = None; new_msg_obj.session_id = target_session_id # 其他类型也用 session_id
             new_msg_obj.timestamp = int(time.time()); new_msg_obj.message_id = str(uuid.uuid4()); 
-            new_msg_obj.raw_message = { "trigger_type": "relay_chat_chain", "__relay_is_chain__": True, "__relay_depth__": chain_depth_for_next_event, "__relay_last_replier_persona__": replied_persona_name, "__relay_last_replier_physical_id__": replied_bot_physical_id, "__relay_original_user_mid__": original_user_message_id, "__relay_original_user_sender_id__": original_user_sender_id }
+            new_msg_obj.raw_message = { "trigger_type": "relay_chat_chain", "__relay_is_chain__": True, "__relay_depth__": chain_depth_for_next_event, "__relay_last_replier_persona__": replied_persona_name, "__relay_last_replier_physical_id__": replied_bot_physical_id, "__relay_original_user_mid__": original_user_message_id, "__relay_original_user_sender_id__": original_user_sender_id, "__relay_prerolled__": True }
             
             if _VOCECHAT_EVENT_AVAILABLE and target_platform_meta.name == "vocechat":
-                target_adapter_instance: Optional[Platform] = None # 明确类型
-                if hasattr(self.context, 'platform_manager') and self.context.platform_manager:
-                    if hasattr(self.context.platform_manager, 'get_platform_by_id'): 
-                        target_adapter_instance = self.context.platform_manager.get_platform_by_id(str(target_platform_meta.id)) # id 可能是数字或字符串
-                    elif hasattr(self.context.platform_manager, 'get_insts'):
-                        for inst_plat in self.context.platform_manager.get_insts(): # type: ignore
-                            if hasattr(inst_plat, 'metadata') and inst_plat.metadata and str(inst_plat.metadata.id) == str(target_platform_meta.id): 
-                                target_adapter_instance = inst_plat; break # type: ignore
+                target_adapter_instance: Optional[Platform] = self.platform_registry.get_adapter(str(target_platform_meta.id)) # id 可能是数字或字符串
                 if target_adapter_instance and isinstance(target_adapter_instance, _VOCECHAT_ADAPTER_CLASS): # type: ignore
                     try: simulated_event = VoceChatEvent(message_obj=new_msg_obj, platform_meta=target_platform_meta, adapter_instance=target_adapter_instance) # type: ignore
                     except Exception as e_vce: logger.error(f"{log_prefix}: 创建VoceChatEvent失败: {e_vce}, 回退到通用事件."); simulated_event = None
@@ -339,16 +413,36 @@ class RelayChatPlugin(Star):
                 simulated_event.set_extra("relay_is_chain", True); simulated_event.set_extra("relay_chain_depth", chain_depth_for_next_event) 
                 simulated_event.set_extra("relay_last_replier_persona", replied_persona_name); simulated_event.set_extra("relay_last_replier_physical_id", replied_bot_physical_id)
                 simulated_event.set_extra("relay_original_user_message_id", original_user_message_id); simulated_event.set_extra("relay_original_user_sender_id", original_user_sender_id)
+                simulated_event.set_extra("relay_chain_prerolled", True) # 是否回复已在安排连锁时决定
                 logger.info(f"{log_prefix}: 最终模拟事件 (类型: {type(simulated_event).__name__}) 已准备好，深度 {chain_depth_for_next_event}.")
         except Exception as e: logger.error(f"{log_prefix}: 创建模拟事件对象时出错: {e}", exc_info=True); return
         
+        if simulated_event and speculate:
+            speculative_reply = await self._generate_reply_within_delay(runtime, simulated_event, str(target_platform_meta.id), chain_delay, log_prefix)
+            if speculative_reply: simulated_event.set_extra("relay_speculative_reply", speculative_reply)
+
         if simulated_event:
             event_queue = self.context.get_event_queue(); 
-            if event_queue: await event_queue.put(simulated_event); logger.info(f"{log_prefix}: 模拟事件已提交到事件队列 (目标平台: {target_platform_meta.id}).")
+            if event_queue:
+                with RelayStats.timer("event_queue_put"): await event_queue.put(simulated_event)
+                logger.info(f"{log_prefix}: 模拟事件已提交到事件队列 (目标平台: {target_platform_meta.id}).")
             else: logger.error(f"{log_prefix}: 无法获取事件队列。")
-        
-        chain_task_key = f"{original_user_message_id}_to_{target_platform_meta.id}_depth{chain_depth_for_next_event}"
-        async with self.chain_scheduler_lock: self.active_chain_tasks.pop(chain_task_key, None) # 任务完成后从字典中移除
+
+    async def _generate_reply_within_delay(self, runtime: RelayRuntimeConfig, simulated_event: AstrMessageEvent, target_platform_id: str, chain_delay: float, log_prefix: str) -> Optional[LLMResponse]:
+        # 连锁延迟期间就为目标人格生成回复，延迟结束后才放行；连锁被取消时预生成任务随之取消
+        target_bot_config = runtime.bot_profiles.get(target_platform_id)
+        if not target_bot_config:
+            if chain_delay > 0: await asyncio.sleep(chain_delay)
+            return None
+        speculative_task = asyncio.create_task(runtime.llm_module.generate_reply_directly(simulated_event, target_bot_config, lock_wait_seconds=chain_delay))
+        started_at = time.monotonic()
+        try:
+            if chain_delay > 0: await asyncio.sleep(chain_delay)
+            speculative_reply = await speculative_task
+            logger.debug(f"{log_prefix}: 预生成回复{'完成' if speculative_reply else '失败'}，总耗时 {time.monotonic() - started_at:.2f}s (延迟 {chain_delay}s)。")
+            return speculative_reply
+        finally:
+            if not speculative_task.done(): speculative_task.cancel()
 
 def _cleanup_relay_extras(event: AstrMessageEvent): 
     # 清理所有本次交互中设置的relay_* extra
@@ -0,0 +1,99 @@
+# astrbot_plugin_relaychat/utils/bot_profile.py
+
+import json
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from astrbot.api.all import AstrBotConfig, logger
+from .keyword_matcher import BotKeywordIndex, normalize_keywords
+
+DEFAULT_GLOBAL_BASE_REPLY_PROBABILITY = 0.1
+DEFAULT_GLOBAL_CHAIN_REPLY_PROBABILITY = 0.75
+
+
+class BotProfile:
+    """managed_bots 中一个Bot的解析结果。启动时构建一次，之后只读；关键词已转为小写。"""
+    __slots__ = ("platform_instance_id", "persona_name", "vocechat_bot_uid", "keywords", "blacklist_keywords",
+                 "base_reply_probability", "chain_reply_probability", "llm_max_history", "incentive_key_prefix")
+
+    def __init__(self, platform_instance_id: str, persona_name: str, vocechat_bot_uid: str,
+                 keywords: Tuple[str, ...], blacklist_keywords: Tuple[str, ...],
+                 base_reply_probability: float, chain_reply_probability: float, llm_max_history: Optional[int] = None):
+        self.platform_instance_id = platform_instance_id
+        self.persona_name = persona_name
+        self.vocechat_bot_uid = vocechat_bot_uid
+        self.keywords = keywords
+        self.blacklist_keywords = blacklist_keywords
+        self.base_reply_probability = base_reply_probability
+        self.chain_reply_probability = chain_reply_probability
+        self.llm_max_history = llm_max_history
+        self.incentive_key_prefix = f"incentive_{platform_instance_id}@"
+
+    def __repr__(self) -> str:
+        return f"BotProfile(platform={self.platform_instance_id!r}, persona={self.persona_name!r}, uid={self.vocechat_bot_uid!r})"
+
+    @staticmethod
+    def _lowered_tuple(keywords: Any) -> Tuple[str, ...]:
+        return tuple(sorted(normalize_keywords(keywords)))
+
+    @staticmethod
+    def parse(bot_config_str: Any, index: int, default_keywords: List[str], default_blacklist: List[str],
+              default_base_probability: float, default_chain_probability: float) -> Optional["BotProfile"]:
+        # 格式: 平台ID::人格名::BotUID::关键词JSON::基础回复概率::连锁回复概率::黑名单JSON，空段使用全局默认值
+        if not isinstance(bot_config_str, str) or not bot_config_str.strip(): logger.warning(f"RelayChatPlugin: managed_bots 条目 #{index} 为空或非字符串: '{bot_config_str}'"); return None
+        parts = bot_config_str.split("::")
+        if len(parts) < 7: logger.warning(f"RelayChatPlugin: managed_bots 条目 #{index} 格式不正确 (应至少7段,实为{len(parts)}段): '{bot_config_str}'"); return None
+        try:
+            platform_id, persona, bot_uid = parts[0].strip(), parts[1].strip(), parts[2].strip()
+            kw_str = parts[3].strip(); kws = json.loads(kw_str) if kw_str else default_keywords
+            if not isinstance(kws, list): kws = default_keywords
+            base_p_str = parts[4].strip(); base_p = float(base_p_str) if base_p_str else default_base_probability
+            chain_p_str = parts[5].strip(); chain_p = float(chain_p_str) if chain_p_str else default_chain_probability
+            bl_str = parts[6].strip(); bl_kws = json.loads(bl_str) if bl_str else default_blacklist
+            if not isinstance(bl_kws, list): bl_kws = default_blacklist
+        except (IndexError, ValueError, json.JSONDecodeError) as e:
+            logger.warning(f"RelayChatPlugin: 解析 managed_bots 条目 #{index} '{bot_config_str}' 时出错: {e}"); return None
+        if not (platform_id and persona and bot_uid):
+            logger.warning(f"RelayChatPlugin: managed_bots 条目 #{index} 缺少关键的平台ID/人格名/BotUID: '{bot_config_str}'"); return None
+        return BotProfile(platform_id, persona, bot_uid, BotProfile._lowered_tuple(kws), BotProfile._lowered_tuple(bl_kws), base_p, chain_p)
+
+
+class BotProfileRegistry:
+    """
+    全部托管Bot的档案：按平台ID和Bot UID各建一份索引，并持有所有Bot共用的关键词自动机。
+    判断发送者是否是我们的Bot只需一次集合查找。
+    """
+
+    def __init__(self, profiles: List[BotProfile]):
+        self.by_platform: Dict[str, BotProfile] = {}
+        for profile in profiles: self.by_platform[profile.platform_instance_id] = profile # 同一平台重复配置时以最后一条为准，与原先一致
+        self.by_uid: Dict[str, BotProfile] = {p.vocechat_bot_uid: p for p in self.by_platform.values()}
+        self.bot_uids: FrozenSet[str] = frozenset(self.by_uid)
+        self.keyword_index = BotKeywordIndex(self.by_platform.values())
+
+    @staticmethod
+    def from_config(plugin_config: AstrBotConfig) -> "BotProfileRegistry":
+        default_base_probability = float(plugin_config.get("default_global_base_reply_probability", DEFAULT_GLOBAL_BASE_REPLY_PROBABILITY))
+        default_chain_probability = float(plugin_config.get("default_global_chain_reply_probability", DEFAULT_GLOBAL_CHAIN_REPLY_PROBABILITY))
+        default_keywords: List[str] = plugin_config.get("default_global_keywords", [])
+        default_blacklist: List[str] = plugin_config.get("default_global_blacklist", [])
+        managed_bots_str_list = plugin_config.get("managed_bots", [])
+        if not isinstance(managed_bots_str_list, list): managed_bots_str_list = []
+        profiles: List[BotProfile] = []
+        for i, bot_config_str in enumerate(managed_bots_str_list):
+            profile = BotProfile.parse(bot_config_str, i, default_keywords, default_blacklist, default_base_probability, default_chain_probability)
+            if profile is None: continue
+            profiles.append(profile)
+            logger.info(f"RelayChatPlugin: 已解析平台 '{profile.platform_instance_id}' 的Bot配置: 人格='{profile.persona_name}', UID='{profile.vocechat_bot_uid}'.")
+        return BotProfileRegistry(profiles)
+
+    def get(self, platform_id: Optional[str]) -> Optional[BotProfile]:
+        return self.by_platform.get(platform_id) if platform_id is not None else None
+
+    def is_managed_bot_uid(self, user_id: Optional[str]) -> bool:
+        return user_id in self.bot_uids
+
+    def __iter__(self) -> Iterator[BotProfile]:
+        return iter(self.by_platform.values())
+
+    def __len__(self) -> int:
+        return len(self.by_platform)
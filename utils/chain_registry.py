@@ -0,0 +1,76 @@
+# astrbot_plugin_relaychat/utils/chain_registry.py
+
+import asyncio
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+
+from astrbot.api.all import logger
+from .relay_stats import RelayStats
+
+
+class ChainTaskRegistry:
+    """
+    按 会话 -> 原始用户消息ID -> 任务键 三级索引的连锁任务表。
+    取消/清理一条连锁只触及它自己的任务；锁按会话分片，不同群之间互不争用。
+    """
+    LOCK_SHARD_COUNT = 32
+
+    def __init__(self, shard_count: int = LOCK_SHARD_COUNT):
+        self._sessions: Dict[str, Dict[str, Dict[str, asyncio.Task]]] = {}
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(max(1, shard_count))]
+
+    def lock_for(self, session_id: str) -> asyncio.Lock:
+        return self._locks[hash(session_id or "") % len(self._locks)]
+
+    async def cancel_session(self, session_id: str, keep_origin: Optional[str] = None) -> List[str]:
+        # 新的用户消息到来时取消本会话中由更早消息引发的连锁 (连同其中正在预生成的回复)；keep_origin 自己引发的连锁保留
+        session_id = session_id or ""
+        async with RelayStats.contended(self.lock_for(session_id), "chain_shard"):
+            origins = self._sessions.get(session_id)
+            if not origins: return []
+            stale_origins = [mid for mid in origins if mid != keep_origin]
+            removed = [origins.pop(mid) for mid in stale_origins]
+            if not origins: self._sessions.pop(session_id, None)
+        cancelled: List[str] = []
+        for tasks in removed:
+            for task_key, task in tasks.items():
+                if not task.done(): task.cancel(); cancelled.append(task_key)
+        return cancelled
+
+    async def schedule(self, session_id: str, original_user_mid: str, task_key: str,
+                       coro_factory: Callable[[], Coroutine[Any, Any, Any]]) -> bool:
+        # 同一任务键已有未完成的任务时不重复安排；任务结束后通过回调自动从索引中移除
+        session_id = session_id or ""
+        async with RelayStats.contended(self.lock_for(session_id), "chain_shard"):
+            tasks = self._sessions.setdefault(session_id, {}).setdefault(original_user_mid, {})
+            existing = tasks.get(task_key)
+            if existing is not None and not existing.done(): return False
+            task = asyncio.create_task(coro_factory())
+            tasks[task_key] = task
+        task.add_done_callback(lambda t: self._discard(session_id, original_user_mid, task_key, t))
+        return True
+
+    def _discard(self, session_id: str, original_user_mid: str, task_key: str, task: asyncio.Task):
+        # 在事件循环线程中同步执行，不会与持锁的协程交错
+        origins = self._sessions.get(session_id)
+        if not origins: return
+        tasks = origins.get(original_user_mid)
+        if not tasks or tasks.get(task_key) is not task: return
+        del tasks[task_key]
+        if not tasks: del origins[original_user_mid]
+        if not origins: del self._sessions[session_id]
+
+    def cancel_all(self) -> int:
+        cancelled = 0
+        sessions, self._sessions = self._sessions, {}
+        for origins in sessions.values():
+            for tasks in origins.values():
+                for task_key, task in tasks.items():
+                    if not task.done():
+                        task.cancel(); cancelled += 1
+                        logger.debug(f"ChainTaskRegistry: 已取消连锁任务 (TaskKey: {task_key})。")
+        return cancelled
+
+    def stats(self) -> Dict[str, int]:
+        origin_count = sum(len(origins) for origins in self._sessions.values())
+        task_count = sum(len(tasks) for origins in self._sessions.values() for tasks in origins.values())
+        return {"sessions": len(self._sessions), "origins": origin_count, "tasks": task_count}
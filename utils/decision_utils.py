@@ -1,20 +1,25 @@
 # astrbot_plugin_relaychat/utils/decision_utils.py
 
 import random
-import time
-from typing import Dict, Any, List, Optional # List 未在此文件中直接使用
+from typing import Dict, Any, List, Optional
 
 from astrbot.api.all import AstrMessageEvent, AstrBotConfig, logger, MessageType
 from .llm_module import LLMModule 
+from .bot_profile import BotProfile, BotProfileRegistry
+from .ttl_store import TTLStore
+from .relay_stats import RelayStats
 
 class DecisionModule:
-    _active_conversation_sessions: Dict[str, float] = {} 
     CONVERSATION_INCENTIVE_PROBABILITY_DEFAULT = 0.90 
     CONVERSATION_INCENTIVE_DURATION_SECONDS_DEFAULT = 120
+    STATE_STORE_MAX_ENTRIES_DEFAULT = 10000
+    CHAIN_FANOUT_MAX_SPEAKERS_DEFAULT = 0 # 0 表示不限制每一层连锁的回复者数量
+    # 对话激励计时器：到期自动清理，条目数有上限，不再随会话数无限增长
+    _active_conversation_sessions = TTLStore("conversation_incentive", STATE_STORE_MAX_ENTRIES_DEFAULT, CONVERSATION_INCENTIVE_DURATION_SECONDS_DEFAULT)
 
-    def __init__(self, plugin_config: AstrBotConfig, managed_bot_configs_ref: Dict[str, Any]):
+    def __init__(self, plugin_config: AstrBotConfig, bot_profiles: BotProfileRegistry):
         self.plugin_config = plugin_config
-        self.managed_bot_configs = managed_bot_configs_ref
+        self.bot_profiles = bot_profiles
         self.incentive_prob = float(plugin_config.get(
             "conversation_incentive_probability", 
             self.CONVERSATION_INCENTIVE_PROBABILITY_DEFAULT
@@ -23,12 +28,20 @@ class DecisionModule:
             "conversation_incentive_duration_seconds", 
             self.CONVERSATION_INCENTIVE_DURATION_SECONDS_DEFAULT
         ))
-        logger.debug(f"DecisionModule initialized. IncentiveProb={self.incentive_prob}, IncentiveDuration={self.incentive_duration}s")
+        DecisionModule._active_conversation_sessions.configure(
+            max_entries=int(plugin_config.get("state_store_max_entries", self.STATE_STORE_MAX_ENTRIES_DEFAULT)),
+            default_ttl=max(self.incentive_duration, 1),
+        )
+        self.chain_fanout_max_speakers = int(plugin_config.get(
+            "chain_fanout_max_speakers",
+            self.CHAIN_FANOUT_MAX_SPEAKERS_DEFAULT
+        ))
+        # 所有Bot的关键词/黑名单在解析档案时编译一次，每条消息只扫描一遍
+        self.keyword_index = bot_profiles.keyword_index
+        logger.debug(f"DecisionModule initialized. IncentiveProb={self.incentive_prob}, IncentiveDuration={self.incentive_duration}s, CompiledKeywordPatterns={self.keyword_index.pattern_count}")
 
-    def _get_session_key_for_incentive(self, event: AstrMessageEvent, bot_specific_config: Dict[str, Any]) -> str:
-        platform_instance_id = bot_specific_config.get("platform_instance_id", "unknown_platform_instance")
-        session_id = event.get_session_id() or "unknown_session"
-        return f"incentive_{platform_instance_id}@{session_id}"
+    def _get_session_key_for_incentive(self, event: AstrMessageEvent, bot_specific_config: BotProfile) -> str:
+        return bot_specific_config.incentive_key_prefix + (event.get_session_id() or "unknown_session")
 
     def activate_reply_incentive(self, event: AstrMessageEvent):
         # ★★★ 修正了 event.get_extra 的调用方式 ★★★
@@ -39,93 +52,114 @@ class DecisionModule:
             return        
         
         bot_specific_config_to_use = hook_config_from_extra.get("bot_specific_config")
-        if not bot_specific_config_to_use or not isinstance(bot_specific_config_to_use, dict): 
+        if not isinstance(bot_specific_config_to_use, BotProfile): 
             logger.warning("DecisionModule (activate_incentive): Missing 'bot_specific_config' within 'relay_current_reply_config_for_hook'. Cannot activate incentive.")
             return
 
-        current_platform_id_for_log = bot_specific_config_to_use.get('platform_instance_id', 'UnknownPlat')
+        current_platform_id_for_log = bot_specific_config_to_use.platform_instance_id
         session_key = self._get_session_key_for_incentive(event, bot_specific_config_to_use)
 
         if self.incentive_duration > 0:
-            DecisionModule._active_conversation_sessions[session_key] = time.time() + self.incentive_duration
+            DecisionModule._active_conversation_sessions.set(session_key, True, ttl=self.incentive_duration)
             logger.debug(f"DecisionModule (Incentive Activation @ {current_platform_id_for_log}): "
                          f"Timer activated/refreshed for session '{session_key}'.")
         else:
             logger.debug(f"DecisionModule (Incentive Activation @ {current_platform_id_for_log}): "
                          f"Incentive duration is <= 0, incentive not activated for session '{session_key}'.")
 
-    def _is_conversation_incentive_active(self, event: AstrMessageEvent, bot_specific_config: Dict[str, Any]) -> bool:
+    def _is_conversation_incentive_active(self, event: AstrMessageEvent, bot_specific_config: BotProfile) -> bool:
         if self.incentive_duration <= 0: return False
         
-        current_platform_id_for_log = bot_specific_config.get('platform_instance_id', 'UnknownPlat')
+        current_platform_id_for_log = bot_specific_config.platform_instance_id
         session_key = self._get_session_key_for_incentive(event, bot_specific_config)
-        expiry_time = DecisionModule._active_conversation_sessions.get(session_key)
 
-        if expiry_time and time.time() < expiry_time:
+        # 过期条目由 TTLStore 在读取时或后台清理时移除
+        if session_key in DecisionModule._active_conversation_sessions:
             logger.debug(f"DecisionModule (Incentive Check @ {current_platform_id_for_log}): Active for '{session_key}'.")
             return True
-        elif expiry_time: 
-            logger.debug(f"DecisionModule (Incentive Check @ {current_platform_id_for_log}): EXPIRED for '{session_key}'. Removing.")
-            DecisionModule._active_conversation_sessions.pop(session_key, None)
         # else:
             # logger.debug(f"DecisionModule (Incentive Check @ {current_platform_id_for_log}): No active incentive for '{session_key}'.")
         return False
 
-    def should_reply(self, event: AstrMessageEvent, bot_specific_config: Dict[str, Any], is_chain_event: bool) -> bool:
-        log_prefix_base = f"DecisionModule ({bot_specific_config.get('platform_instance_id', 'UnkPlat')}, " \
-                          f"P: {bot_specific_config.get('persona_name', 'UnkPers')}, Chain: {is_chain_event})"
+    @staticmethod
+    def get_state_stats() -> Dict[str, Any]:
+        return DecisionModule._active_conversation_sessions.stats()
+
+    def select_chain_speakers(self, candidate_configs: List[BotProfile]) -> List[BotProfile]:
+        # 在安排连锁时就按 chain_reply_probability 掷骰，只有会回复的Bot才会收到模拟事件
+        selected = [conf for conf in candidate_configs if random.random() < conf.chain_reply_probability]
+        max_speakers = self.chain_fanout_max_speakers
+        if max_speakers > 0 and len(selected) > max_speakers:
+            # 按概率加权的无放回抽样 (Efraimidis-Spirakis)：权重越高越容易被选为下一位发言者
+            weighted = [(random.random() ** (1.0 / max(conf.chain_reply_probability, 1e-6)), conf) for conf in selected]
+            weighted.sort(key=lambda item: item[0], reverse=True)
+            selected = [conf for _, conf in weighted[:max_speakers]]
+        logger.debug(f"DecisionModule (Chain Preroll): {len(candidate_configs)} 个候选，选中 "
+                     f"{[conf.persona_name for conf in selected]} (上限: {max_speakers or '不限'})。")
+        return selected
+
+    @staticmethod
+    def _is_prerolled_chain_event(event: AstrMessageEvent) -> bool:
+        if event.get_extra("relay_chain_prerolled"): return True
+        raw_msg_data = getattr(event.message_obj, 'raw_message', None) if event.message_obj else None
+        return isinstance(raw_msg_data, dict) and bool(raw_msg_data.get("__relay_prerolled__", False))
+
+    @staticmethod
+    def _record_decision(event: AstrMessageEvent, bot_specific_config: BotProfile, decided: bool, reason: str) -> bool:
+        RelayStats.incr("decision_reply" if decided else "decision_skip", bot_specific_config.persona_name, reason, session=event.get_session_id())
+        return decided
+
+    def should_reply(self, event: AstrMessageEvent, bot_specific_config: BotProfile, is_chain_event: bool) -> bool:
+        log_prefix_base = f"DecisionModule ({bot_specific_config.platform_instance_id}, " \
+                          f"P: {bot_specific_config.persona_name}, Chain: {is_chain_event})"
 
         message_content = event.get_message_str().lower()
         sender_id = event.get_sender_id()
         
         # 1. 黑名单关键词检查
         if not is_chain_event: # 只对非连锁事件检查黑名单 (假设连锁事件的内容是可信的)
-            is_from_our_managed_bot = False
-            for _, conf in self.managed_bot_configs.items():
-                if conf.get("vocechat_bot_uid") == sender_id:
-                    is_from_our_managed_bot = True; break
-            
-            if not is_from_our_managed_bot: # 如果消息不是来自我们管理的另一个Bot
-                blacklist = bot_specific_config.get("blacklist_keywords", [])
-                if any(keyword.lower() in message_content for keyword in blacklist if keyword.strip()):
+            if not self.bot_profiles.is_managed_bot_uid(sender_id): # 如果消息不是来自我们管理的另一个Bot
+                if self.keyword_index.matches_blacklist(bot_specific_config.platform_instance_id, message_content):
                     logger.info(f"{log_prefix_base}: Message from {sender_id} (not our bot) matched blacklist. Not replying.")
-                    return False
+                    return self._record_decision(event, bot_specific_config, False, "blacklist")
 
         # 2. 私聊消息强制回复 (仅对用户发起的首次回复，且未被黑名单阻止)
         if event.get_message_type() == MessageType.FRIEND_MESSAGE and not is_chain_event :
             logger.info(f"{log_prefix_base}: Private message from user. Forcing reply (passed blacklist check).")
-            return True
+            return self._record_decision(event, bot_specific_config, True, "private")
 
         # 3. 连锁回复逻辑
         if is_chain_event:
-            chain_prob = bot_specific_config.get("chain_reply_probability", 0.0)
+            if self._is_prerolled_chain_event(event):
+                logger.info(f"{log_prefix_base}: Triggering CHAIN reply (decided when the chain was scheduled).")
+                return self._record_decision(event, bot_specific_config, True, "chain_prerolled")
+            chain_prob = bot_specific_config.chain_reply_probability
             if random.random() < chain_prob:
                 logger.info(f"{log_prefix_base}: Triggering CHAIN reply based on Chain probability ({chain_prob:.2f}).")
-                return True
+                return self._record_decision(event, bot_specific_config, True, "chain_probability")
             else:
                 logger.debug(f"{log_prefix_base}: NOT triggering CHAIN reply (Prob: {chain_prob:.2f}).")
-                return False
+                return self._record_decision(event, bot_specific_config, False, "chain_probability")
 
         # --- 以下仅对非连锁的群聊事件 (因为私聊在上面已经return True了) ---
         # 4. 关键词触发逻辑
-        keywords = bot_specific_config.get("keywords", [])
-        if any(keyword.lower() in message_content for keyword in keywords if keyword.strip()):
+        if self.keyword_index.matches_keyword(bot_specific_config.platform_instance_id, message_content):
             logger.info(f"{log_prefix_base}: Message from {sender_id} matched keyword. Triggering.")
-            return True
+            return self._record_decision(event, bot_specific_config, True, "keyword")
             
         # 5. 对话激励逻辑
         if self._is_conversation_incentive_active(event, bot_specific_config):
             if random.random() < self.incentive_prob:
                 logger.info(f"{log_prefix_base}: Triggering reply (Incentive Prob: {self.incentive_prob:.2f}).")
-                return True
+                return self._record_decision(event, bot_specific_config, True, "incentive")
             else:
                 logger.debug(f"{log_prefix_base}: NOT triggering reply (Incentive Prob: {self.incentive_prob:.2f}).")
         
         # 6. 基础概率回复逻辑
-        base_prob = bot_specific_config.get("base_reply_probability", 0.0)
+        base_prob = bot_specific_config.base_reply_probability
         if random.random() < base_prob:
             logger.info(f"{log_prefix_base}: Triggering reply (Base Prob: {base_prob:.2f}).")
-            return True
+            return self._record_decision(event, bot_specific_config, True, "base_probability")
         else:
             logger.debug(f"{log_prefix_base}: NOT triggering reply (Base Prob: {base_prob:.2f}).")
-            return False
+            return self._record_decision(event, bot_specific_config, False, "base_probability")
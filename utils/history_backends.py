@@ -0,0 +1,245 @@
+# astrbot_plugin_relaychat/utils/history_backends.py
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+ChatKey = Tuple[str, str, str] # (platform_name, "group"/"private", chat_id)
+
+
+class HistoryBackend:
+    """历史记录持久化后端接口。所有方法都是同步阻塞的，由 HistoryStorage 放到 IOExecutor 中执行并按会话串行化写入。"""
+    name = "base"
+
+    def load_tail(self, chat_key: ChatKey, limit: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def append(self, chat_key: ChatKey, entries: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def clear(self, chat_key: ChatKey):
+        raise NotImplementedError
+
+    def needs_compaction(self, chat_key: ChatKey) -> bool:
+        return False
+
+    def compact(self, chat_key: ChatKey):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlHistoryBackend(HistoryBackend):
+    """每个会话一个追加写的 JSONL 日志，超出保留上限后由后台任务压缩。"""
+    name = "jsonl"
+    HISTORY_FILE_SUFFIX = ".jsonl" # 追加写日志：每行一条历史记录
+    LEGACY_FILE_SUFFIX = ".json" # 旧格式：整个文件是一个 JSON 列表
+    COMPACTION_SLACK_RATIO = 0.5 # 行数超出保留上限的 50% 后触发后台压缩
+    TAIL_READ_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, base_storage_path: str, max_entries: int):
+        self.base_storage_path = base_storage_path
+        self.max_entries = max_entries
+        self._line_counts: Dict[str, int] = {} # file_path -> 当前日志行数 (近似值，压缩后校准)
+        self._migration_checked_paths: set = set()
+
+    def get_file_path(self, chat_key: ChatKey) -> str:
+        platform_name, chat_type_dir, chat_id = chat_key
+        directory = os.path.join(self.base_storage_path, platform_name, chat_type_dir)
+        file_path = os.path.join(directory, f"{chat_id}{self.HISTORY_FILE_SUFFIX}")
+        if file_path not in self._migration_checked_paths:
+            if not os.path.exists(directory):
+                try: os.makedirs(directory, exist_ok=True)
+                except Exception as e: logger.error(f"RelayChat HistoryStorage: 创建目录失败 {directory}: {e}")
+            self._migrate_legacy_file(file_path)
+            self._migration_checked_paths.add(file_path)
+        return file_path
+
+    def _migrate_legacy_file(self, file_path: str):
+        # 旧版本每个会话是一个 <chat_id>.json 列表文件，首次访问时透明地转换为 JSONL 日志
+        legacy_path = file_path[:-len(self.HISTORY_FILE_SUFFIX)] + self.LEGACY_FILE_SUFFIX
+        if not os.path.exists(legacy_path) or os.path.exists(file_path): return
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                file_content = f.read()
+            legacy_history = json.loads(file_content) if file_content.strip() else []
+            if not isinstance(legacy_history, list):
+                logger.warning(f"RelayChat HistoryStorage: 旧历史文件 '{legacy_path}' 内容不是列表，跳过迁移。")
+                return
+            legacy_history = [e for e in legacy_history if isinstance(e, dict)][-self.max_entries:]
+            self._rewrite_log(file_path, legacy_history)
+            os.replace(legacy_path, legacy_path + ".migrated")
+            logger.info(f"RelayChat HistoryStorage: 已将旧历史文件 '{legacy_path}' 迁移为 JSONL ({len(legacy_history)} 条)。")
+        except Exception as e:
+            logger.error(f"RelayChat HistoryStorage: 迁移旧历史文件 '{legacy_path}' 失败: {e}", exc_info=True)
+
+    def _rewrite_log(self, file_path: str, entries: List[Dict[str, Any]]):
+        # 先写临时文件再原子替换，避免压缩/迁移中途崩溃导致日志损坏
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries))
+        os.replace(tmp_path, file_path)
+        self._line_counts[file_path] = len(entries)
+
+    def _count_lines(self, file_path: str) -> int:
+        if not os.path.exists(file_path): return 0
+        count = 0
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(self.TAIL_READ_BLOCK_SIZE), b""):
+                count += block.count(b"\n")
+        return count
+
+    def _read_tail_lines(self, file_path: str, max_lines: int) -> List[bytes]:
+        # 从文件末尾按块向前读取，只解析最后 max_lines 行，不必加载整个日志
+        if max_lines <= 0 or not os.path.exists(file_path): return []
+        with open(file_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            chunks: List[bytes] = []
+            newline_count = 0
+            while pos > 0 and newline_count <= max_lines:
+                read_size = min(self.TAIL_READ_BLOCK_SIZE, pos)
+                pos -= read_size
+                f.seek(pos)
+                chunk = f.read(read_size)
+                chunks.append(chunk)
+                newline_count += chunk.count(b"\n")
+        lines = [line for line in b"".join(reversed(chunks)).split(b"\n") if line.strip()]
+        return lines[-max_lines:]
+
+    @staticmethod
+    def _parse_lines(lines: List[bytes], file_path: str) -> List[Dict[str, Any]]:
+        entries: List[Dict[str, Any]] = []
+        for line in lines:
+            try: entry = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e_json: # 崩溃时可能留下半行，跳过即可
+                logger.warning(f"RelayChat HistoryStorage: 跳过历史日志 '{file_path}' 中无法解析的行: {e_json}. 内容(前100字节): {line[:100]!r}")
+                continue
+            if isinstance(entry, dict): entries.append(entry)
+        return entries
+
+    def load_tail(self, chat_key: ChatKey, limit: int) -> List[Dict[str, Any]]:
+        file_path = self.get_file_path(chat_key)
+        return self._parse_lines(self._read_tail_lines(file_path, min(limit, self.max_entries)), file_path)
+
+    def append(self, chat_key: ChatKey, entries: List[Dict[str, Any]]):
+        # 一批条目只做一次追加写，不再读取并重写整个历史文件
+        if not entries: return
+        file_path = self.get_file_path(chat_key)
+        lines = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        if file_path not in self._line_counts:
+            self._line_counts[file_path] = self._count_lines(file_path)
+        with open(file_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        self._line_counts[file_path] += len(entries)
+
+    def clear(self, chat_key: ChatKey):
+        file_path = self.get_file_path(chat_key)
+        if os.path.exists(file_path): os.remove(file_path)
+        self._line_counts.pop(file_path, None)
+
+    def needs_compaction(self, chat_key: ChatKey) -> bool:
+        limit = self.max_entries
+        return self._line_counts.get(self.get_file_path(chat_key), 0) > limit + int(limit * self.COMPACTION_SLACK_RATIO)
+
+    def compact(self, chat_key: ChatKey):
+        self._compact_log_sync(self.get_file_path(chat_key))
+
+    def _compact_log_sync(self, file_path: str):
+        try:
+            kept_entries = self._parse_lines(self._read_tail_lines(file_path, self.max_entries), file_path)
+            self._rewrite_log(file_path, kept_entries)
+            logger.debug(f"RelayChat HistoryStorage: 已压缩历史日志 '{file_path}'，保留 {len(kept_entries)} 条。")
+        except Exception as e:
+            logger.error(f"RelayChat HistoryStorage: 压缩历史日志 '{file_path}' 失败: {e}", exc_info=True)
+
+
+class SqliteHistoryBackend(HistoryBackend):
+    """所有会话存放在同一个 WAL 模式的 SQLite 库中，按 (platform, chat_type, chat_id, ts) 建索引。"""
+    name = "sqlite"
+    DB_FILE_NAME = "history.sqlite3"
+
+    def __init__(self, base_storage_path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.db_path = os.path.join(base_storage_path, self.DB_FILE_NAME)
+        self._lock = threading.Lock() # sqlite3 连接不能被多个线程同时使用
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                platform TEXT NOT NULL,
+                chat_type TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                ts REAL NOT NULL,
+                message_id TEXT,
+                entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_chat_ts ON history (platform, chat_type, chat_id, ts);
+            CREATE INDEX IF NOT EXISTS idx_history_message_id ON history (message_id);
+        """)
+        logger.info(f"RelayChat HistoryStorage: SQLite 历史库已打开 '{self.db_path}'.")
+
+    def load_tail(self, chat_key: ChatKey, limit: int) -> List[Dict[str, Any]]:
+        limit = min(limit, self.max_entries)
+        if limit <= 0: return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? "
+                "ORDER BY ts DESC, id DESC LIMIT ?", (*chat_key, limit)).fetchall()
+        entries: List[Dict[str, Any]] = []
+        for (entry_text,) in reversed(rows):
+            try: entry = json.loads(entry_text)
+            except json.JSONDecodeError as e_json:
+                logger.warning(f"RelayChat HistoryStorage: 跳过 SQLite 中无法解析的历史 ({chat_key}): {e_json}")
+                continue
+            if isinstance(entry, dict): entries.append(entry)
+        return entries
+
+    def append(self, chat_key: ChatKey, entries: List[Dict[str, Any]]):
+        if not entries: return
+        now = time.time()
+        rows = [(*chat_key, now, str(e.get("message_id", "")) or None, json.dumps(e, ensure_ascii=False)) for e in entries]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO history (platform, chat_type, chat_id, ts, message_id, entry) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                # 保留策略：按索引找到第 max_entries 新的记录，删除比它更旧的
+                self._conn.execute(
+                    "DELETE FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? AND (ts, id) < ("
+                    "SELECT ts, id FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? "
+                    "ORDER BY ts DESC, id DESC LIMIT 1 OFFSET ?)", (*chat_key, *chat_key, self.max_entries - 1))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK"); raise
+
+    def clear(self, chat_key: ChatKey):
+        with self._lock:
+            self._conn.execute("DELETE FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ?", chat_key)
+
+    def close(self):
+        with self._lock:
+            try: self._conn.close()
+            except Exception as e: logger.warning(f"RelayChat HistoryStorage: 关闭 SQLite 历史库失败: {e}")
+
+
+HISTORY_BACKENDS = {
+    JsonlHistoryBackend.name: JsonlHistoryBackend,
+    SqliteHistoryBackend.name: SqliteHistoryBackend,
+}
+
+
+def create_history_backend(backend_name: Optional[str], base_storage_path: str, max_entries: int) -> HistoryBackend:
+    backend_cls = HISTORY_BACKENDS.get((backend_name or JsonlHistoryBackend.name).strip().lower())
+    if backend_cls is None:
+        logger.warning(f"RelayChat HistoryStorage: 未知的历史存储后端 '{backend_name}'，使用 '{JsonlHistoryBackend.name}'。")
+        backend_cls = JsonlHistoryBackend
+    return backend_cls(base_storage_path, max_entries)
@@ -0,0 +1,146 @@
+# astrbot_plugin_relaychat/utils/history_cache.py
+import json
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+def estimate_entry_bytes(entry: Dict[str, Any]) -> int:
+    # 以序列化后的长度近似条目占用的内存，用于字节预算
+    return len(json.dumps(entry, ensure_ascii=False))
+
+
+class _CachedSession:
+    __slots__ = ("entries", "entry_sizes", "pending", "byte_size", "message_ids")
+
+    def __init__(self, max_entries: int):
+        self.entries: Deque[Dict[str, Any]] = deque()
+        self.entry_sizes: Deque[int] = deque()
+        self.pending: List[Dict[str, Any]] = [] # 尚未写回磁盘的条目
+        self.byte_size = 0
+        self.message_ids: Dict[str, int] = {} # message_id -> 在 entries 中出现的次数，用于幂等写入
+
+
+class HistorySessionCache:
+    """
+    按会话缓存最近历史的 LRU 写回缓存。
+    读取直接命中内存；写入先进入 pending，由 HistoryStorage 定期或在淘汰/关闭时写回磁盘。
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int, max_entries_per_session: int):
+        self.max_sessions = max(1, max_sessions)
+        self.max_bytes = max(0, max_bytes)
+        self.max_entries_per_session = max(1, max_entries_per_session)
+        self._sessions: "OrderedDict[Hashable, _CachedSession]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, key: Hashable) -> Optional[List[Dict[str, Any]]]:
+        session = self._sessions.get(key)
+        if session is None:
+            self.misses += 1
+            return None
+        self._sessions.move_to_end(key)
+        self.hits += 1
+        return list(session.entries)
+
+    def load(self, key: Hashable, entries: Iterable[Dict[str, Any]]) -> List[Tuple[Hashable, List[Dict[str, Any]]]]:
+        # 用磁盘上读到的历史填充会话 (保留已有的 pending)，返回因超出预算被淘汰且需要写回的会话
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._sessions[key] = _CachedSession(self.max_entries_per_session)
+        else:
+            self._sessions.move_to_end(key)
+        pending_ids = {id(e) for e in session.pending}
+        existing = [e for e in session.entries if id(e) in pending_ids]
+        self._clear_entries(session)
+        for entry in list(entries) + existing:
+            self._push(session, entry)
+        return self._evict_over_budget(protect=key)
+
+    def append(self, key: Hashable, entry: Dict[str, Any]) -> List[Tuple[Hashable, List[Dict[str, Any]]]]:
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._sessions[key] = _CachedSession(self.max_entries_per_session)
+        else:
+            self._sessions.move_to_end(key)
+        self._push(session, entry)
+        session.pending.append(entry)
+        return self._evict_over_budget(protect=key)
+
+    def has_message_id(self, key: Hashable, message_id: str) -> bool:
+        session = self._sessions.get(key)
+        return session is not None and message_id in session.message_ids
+
+    def take_pending(self, key: Hashable) -> List[Dict[str, Any]]:
+        session = self._sessions.get(key)
+        if session is None or not session.pending: return []
+        pending, session.pending = session.pending, []
+        return pending
+
+    def restore_pending(self, key: Hashable, entries: List[Dict[str, Any]]):
+        # 写回失败时把条目放回队首，等待下一次刷新
+        session = self._sessions.get(key)
+        if session is not None and entries:
+            session.pending = entries + session.pending
+
+    def dirty_keys(self) -> List[Hashable]:
+        return [k for k, s in self._sessions.items() if s.pending]
+
+    def pending_count(self) -> int:
+        return sum(len(s.pending) for s in self._sessions.values())
+
+    def discard(self, key: Hashable):
+        session = self._sessions.pop(key, None)
+        if session is not None: self._total_bytes -= session.byte_size
+
+    def _push(self, session: _CachedSession, entry: Dict[str, Any]):
+        size = estimate_entry_bytes(entry)
+        session.entries.append(entry); session.entry_sizes.append(size)
+        session.byte_size += size; self._total_bytes += size
+        message_id = entry.get("message_id")
+        if message_id: session.message_ids[message_id] = session.message_ids.get(message_id, 0) + 1
+        while len(session.entries) > self.max_entries_per_session:
+            dropped_entry = session.entries.popleft()
+            dropped = session.entry_sizes.popleft()
+            session.byte_size -= dropped; self._total_bytes -= dropped
+            dropped_id = dropped_entry.get("message_id")
+            if dropped_id in session.message_ids:
+                session.message_ids[dropped_id] -= 1
+                if session.message_ids[dropped_id] <= 0: del session.message_ids[dropped_id]
+
+    def _clear_entries(self, session: _CachedSession):
+        self._total_bytes -= session.byte_size
+        session.entries.clear(); session.entry_sizes.clear(); session.byte_size = 0
+        session.message_ids.clear()
+
+    def _evict_over_budget(self, protect: Hashable) -> List[Tuple[Hashable, List[Dict[str, Any]]]]:
+        evicted: List[Tuple[Hashable, List[Dict[str, Any]]]] = []
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            cold_key = next(iter(self._sessions))
+            if cold_key == protect: break # 只剩当前会话超预算时不淘汰它自己
+            cold_session = self._sessions.pop(cold_key)
+            self._total_bytes -= cold_session.byte_size
+            self.evictions += 1
+            if cold_session.pending: evicted.append((cold_key, cold_session.pending))
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions), "bytes": self._total_bytes,
+            "pending_entries": self.pending_count(),
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+        }
@@ -0,0 +1,164 @@
+# astrbot_plugin_relaychat/utils/history_retrieval.py
+import re
+import math
+import logging
+from collections import Counter, OrderedDict, deque
+from typing import Any, Collection, Deque, Dict, List, Optional, Tuple
+
+from astrbot.api.all import AstrBotConfig
+from .history_backends import ChatKey
+from .history_storage import HistoryStorage
+from .message_utils import MessageUtils, history_entry_key
+from .token_estimator import TokenEstimator
+
+logger = logging.getLogger(__name__)
+
+
+_CJK_RUN_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+_TERM_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9_]{2,}")
+
+
+def tokenize_for_retrieval(text: str) -> List[str]:
+    # 英文/数字按单词切分；中日韩文本没有空格，按相邻两字 (bigram) 切分，单字成段时保留单字
+    terms: List[str] = []
+    for match in _TERM_PATTERN.finditer((text or "").lower()):
+        run = match.group(0)
+        if _CJK_RUN_PATTERN.fullmatch(run):
+            if len(run) == 1: terms.append(run)
+            else: terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else: terms.append(run)
+    return terms
+
+
+class _ChatIndex:
+    """单个会话的倒排索引，文档按写入顺序编号，超过容量时淘汰最旧的文档。"""
+    __slots__ = ("docs", "order", "postings", "total_length", "next_doc_id", "max_docs")
+
+    def __init__(self, max_docs: int):
+        self.docs: Dict[int, Tuple[Dict[str, Any], Counter, int]] = {} # doc_id -> (历史条目, 词频, 文档长度)
+        self.order: Deque[int] = deque()
+        self.postings: Dict[str, Dict[int, int]] = {} # term -> {doc_id: 词频}
+        self.total_length = 0
+        self.next_doc_id = 0
+        self.max_docs = max_docs
+
+    def add(self, entry: Dict[str, Any]):
+        term_freqs = Counter(tokenize_for_retrieval(entry.get("text") or ""))
+        if not term_freqs: return
+        doc_id = self.next_doc_id; self.next_doc_id += 1
+        doc_length = sum(term_freqs.values())
+        self.docs[doc_id] = (entry, term_freqs, doc_length)
+        self.order.append(doc_id)
+        self.total_length += doc_length
+        for term, freq in term_freqs.items(): self.postings.setdefault(term, {})[doc_id] = freq
+        while len(self.order) > self.max_docs: self._remove(self.order.popleft())
+
+    def _remove(self, doc_id: int):
+        _, term_freqs, doc_length = self.docs.pop(doc_id)
+        self.total_length -= doc_length
+        for term in term_freqs:
+            posting = self.postings.get(term)
+            if posting is None: continue
+            posting.pop(doc_id, None)
+            if not posting: del self.postings[term]
+
+    def search(self, query_terms: List[str], top_k: int, exclude_keys: Collection[tuple], k1: float, b: float) -> List[Tuple[float, int, Dict[str, Any]]]:
+        doc_count = len(self.docs)
+        if not doc_count or not query_terms: return []
+        avg_length = self.total_length / doc_count
+        scores: Dict[int, float] = {}
+        for term, query_freq in Counter(query_terms).items():
+            posting = self.postings.get(term)
+            if not posting: continue
+            idf = math.log(1.0 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, freq in posting.items():
+                doc_length = self.docs[doc_id][2]
+                tf_part = freq * (k1 + 1.0) / (freq + k1 * (1.0 - b + b * doc_length / avg_length))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf_part * query_freq
+        results: List[Tuple[float, int, Dict[str, Any]]] = []
+        for doc_id, score in sorted(scores.items(), key=lambda item: (-item[1], -item[0])):
+            entry = self.docs[doc_id][0]
+            if history_entry_key(entry) in exclude_keys: continue
+            results.append((score, doc_id, entry))
+            if len(results) >= top_k: break
+        return results
+
+
+class HistoryRetrieval:
+    """
+    按会话维护历史消息的本地倒排索引 (BM25 排序)，为当前消息检索最近窗口之外的相关旧消息。
+    索引在首次检索时由已缓存的历史建立，之后随 HistoryStorage 的写入增量更新。
+    """
+    TOP_K_DEFAULT = 0 # 0 表示不启用检索
+    MAX_CHATS_DEFAULT = 256
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+
+    top_k: int = TOP_K_DEFAULT
+    max_chats: int = MAX_CHATS_DEFAULT
+    _indexes: "OrderedDict[ChatKey, _ChatIndex]" = OrderedDict()
+
+    @staticmethod
+    def init(plugin_config: AstrBotConfig):
+        HistoryRetrieval.top_k = max(0, int(plugin_config.get("llm_retrieval_top_k", HistoryRetrieval.TOP_K_DEFAULT)))
+        HistoryRetrieval._indexes.clear()
+        if HistoryRetrieval.top_k > 0: HistoryStorage.add_write_listener(HistoryRetrieval._on_history_write)
+        else: HistoryStorage.remove_write_listener(HistoryRetrieval._on_history_write)
+        logger.debug(f"RelayChat HistoryRetrieval: top_k={HistoryRetrieval.top_k}, max_chats={HistoryRetrieval.max_chats}")
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return HistoryRetrieval.top_k > 0
+
+    @staticmethod
+    def _on_history_write(chat_key: ChatKey, history_entry: Optional[Dict[str, Any]]):
+        # 只更新已经建立的索引；尚未建立的会话在首次检索时从完整历史建立
+        if history_entry is None: HistoryRetrieval._indexes.pop(chat_key, None); return
+        index = HistoryRetrieval._indexes.get(chat_key)
+        if index is not None: index.add(history_entry)
+
+    @staticmethod
+    async def _get_index(chat_key: ChatKey) -> _ChatIndex:
+        index = HistoryRetrieval._indexes.get(chat_key)
+        if index is not None:
+            HistoryRetrieval._indexes.move_to_end(chat_key); return index
+        history = await HistoryStorage.get_history_by_chat_key(chat_key)
+        index = HistoryRetrieval._indexes.get(chat_key) # 读取历史期间可能已被并发的检索建立
+        if index is None:
+            index = _ChatIndex(HistoryStorage.MAX_HISTORY_ENTRIES)
+            for entry in history: index.add(entry)
+            HistoryRetrieval._indexes[chat_key] = index
+            while len(HistoryRetrieval._indexes) > HistoryRetrieval.max_chats: HistoryRetrieval._indexes.popitem(last=False)
+            logger.debug(f"RelayChat HistoryRetrieval: 已为 {chat_key} 建立索引，共 {len(index.docs)} 条。")
+        return index
+
+    @staticmethod
+    async def retrieve(chat_key: Optional[ChatKey], query_text: str, exclude_entries: List[Dict[str, Any]], top_k: Optional[int] = None,
+                       token_budget: Optional[int] = None, estimator: Optional[TokenEstimator] = None) -> List[Dict[str, Any]]:
+        """
+        返回与 query_text 最相关的至多 top_k 条历史 (按时间先后排列)，exclude_entries 中的条目 (通常是最近窗口) 不会返回。
+        给出 token_budget 时按相关度从高到低选取，格式化后的总长度不超过预算。
+        """
+        top_k = HistoryRetrieval.top_k if top_k is None else top_k
+        if not chat_key or top_k <= 0 or (token_budget is not None and token_budget <= 0): return []
+        query_terms = tokenize_for_retrieval(query_text)
+        if not query_terms: return []
+        try:
+            index = await HistoryRetrieval._get_index(chat_key)
+            exclude_keys = {history_entry_key(e) for e in exclude_entries}
+            results = index.search(query_terms, top_k, exclude_keys, HistoryRetrieval.BM25_K1, HistoryRetrieval.BM25_B)
+        except Exception as e:
+            logger.warning(f"RelayChat HistoryRetrieval: 检索 {chat_key} 的历史失败: {e}"); return []
+        if token_budget is not None and estimator is not None:
+            selected, used_tokens = [], 0
+            for result in results:
+                entry_tokens = estimator.count(MessageUtils.format_history_entry(result[2]))
+                if used_tokens + entry_tokens > token_budget: continue
+                selected.append(result); used_tokens += entry_tokens
+            results = selected
+        return [entry for _, _, entry in sorted(results, key=lambda item: item[1])]
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        return {"chats": len(HistoryRetrieval._indexes), "docs": sum(len(i.docs) for i in HistoryRetrieval._indexes.values()),
+                "terms": sum(len(i.postings) for i in HistoryRetrieval._indexes.values())}
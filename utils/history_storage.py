@@ -1,13 +1,21 @@
 # astrbot_plugin_relaychat/utils/history_storage.py
 import os
 import json # 使用标准json
-import logging 
-from typing import List, Optional, Dict, Any, Tuple # Tuple for return type
+import asyncio
+import logging
+import weakref 
+from typing import List, Optional, Dict, Any, Tuple, Callable, Awaitable # Tuple for return type
 from astrbot.api.all import AstrMessageEvent, AstrBotMessage, MessageMember, MessageType, BaseMessageComponent, AstrBotConfig
 from astrbot.api.message_components import Image, Plain 
 from datetime import datetime
 import uuid
 import traceback 
+from .history_cache import HistorySessionCache, estimate_entry_bytes
+from .history_backends import ChatKey, HistoryBackend, JsonlHistoryBackend, create_history_backend
+from .image_blob_store import ImageBlobStore
+from .io_executor import IOExecutor
+from .image_normalizer import ImageNormalizer
+from .relay_stats import RelayStats
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +23,23 @@ class HistoryStorage:
     config: Optional[AstrBotConfig] = None # 用于存储插件配置
     base_storage_path: Optional[str] = None
     MAX_HISTORY_ENTRIES = 200 
+    BACKEND_DEFAULT = JsonlHistoryBackend.name
+    _backend: Optional[HistoryBackend] = None
+
+    # 写回缓存：读取命中内存，写入按间隔批量追加到后端
+    CACHE_MAX_SESSIONS_DEFAULT = 256
+    CACHE_MAX_BYTES_DEFAULT = 64 * 1024 * 1024
+    FLUSH_INTERVAL_SECONDS_DEFAULT = 2.0
+    _session_cache: Optional[HistorySessionCache] = None
+    _flush_interval: float = FLUSH_INTERVAL_SECONDS_DEFAULT
+    _flush_task: Optional[asyncio.Task] = None
+    _compaction_tasks: Dict[ChatKey, asyncio.Task] = {}
+    # 按会话串行化写入/加载，不同会话之间互不阻塞；锁不再被引用时自动回收
+    _chat_locks: "weakref.WeakValueDictionary[ChatKey, asyncio.Lock]" = weakref.WeakValueDictionary()
+    # 单写入者：同一 (会话, message_id) 同时只有一个协程在写入，其余等待它完成
+    _ingest_inflight: Dict[Tuple[ChatKey, str], asyncio.Future] = {}
+    # 写入监听器：每条新历史写入缓存后以 (chat_key, entry) 同步回调一次；清空会话时 entry 为 None
+    _write_listeners: List[Callable[[ChatKey, Optional[Dict[str, Any]]], None]] = []
 
     @staticmethod
     def init(plugin_config: AstrBotConfig): 
@@ -30,6 +55,64 @@ class HistoryStorage:
             
         HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
         logger.info(f"RelayChat HistoryStorage: 存储路径已初始化为 {HistoryStorage.base_storage_path}")
+        ImageBlobStore.init(str(HistoryStorage.base_storage_path))
+
+        if HistoryStorage._backend is not None: HistoryStorage._backend.close()
+        HistoryStorage._backend = create_history_backend(
+            plugin_config.get("history_storage_backend", HistoryStorage.BACKEND_DEFAULT),
+            str(HistoryStorage.base_storage_path), HistoryStorage.MAX_HISTORY_ENTRIES)
+        logger.info(f"RelayChat HistoryStorage: 使用历史存储后端 '{HistoryStorage._backend.name}'.")
+
+        if HistoryStorage._session_cache is None:
+            HistoryStorage._session_cache = HistorySessionCache(
+                max_sessions=int(plugin_config.get("history_cache_max_sessions", HistoryStorage.CACHE_MAX_SESSIONS_DEFAULT)),
+                max_bytes=int(plugin_config.get("history_cache_max_bytes", HistoryStorage.CACHE_MAX_BYTES_DEFAULT)),
+                max_entries_per_session=HistoryStorage.MAX_HISTORY_ENTRIES,
+            )
+        HistoryStorage._flush_interval = max(0.0, float(plugin_config.get("history_flush_interval_seconds", HistoryStorage.FLUSH_INTERVAL_SECONDS_DEFAULT)))
+        IOExecutor.configure(
+            int(plugin_config.get("history_io_max_workers", IOExecutor.MAX_WORKERS_DEFAULT)),
+            int(plugin_config.get("history_io_max_pending", IOExecutor.MAX_PENDING_DEFAULT)))
+        logger.debug(f"RelayChat HistoryStorage: 写回缓存已启用 (会话上限: {HistoryStorage._session_cache.max_sessions}, 字节上限: {HistoryStorage._session_cache.max_bytes}, 刷新间隔: {HistoryStorage._flush_interval}s)。")
+
+    @staticmethod
+    def _get_session_cache() -> HistorySessionCache:
+        if HistoryStorage._session_cache is None:
+            HistoryStorage._session_cache = HistorySessionCache(
+                HistoryStorage.CACHE_MAX_SESSIONS_DEFAULT, HistoryStorage.CACHE_MAX_BYTES_DEFAULT, HistoryStorage.MAX_HISTORY_ENTRIES)
+        return HistoryStorage._session_cache
+
+    @staticmethod
+    def _get_backend() -> Optional[HistoryBackend]:
+        if HistoryStorage._backend is None and HistoryStorage.config is not None:
+            HistoryStorage.init(HistoryStorage.config)
+        return HistoryStorage._backend
+
+    @staticmethod
+    def _get_chat_lock(chat_key: ChatKey) -> asyncio.Lock:
+        lock = HistoryStorage._chat_locks.get(chat_key)
+        if lock is None:
+            lock = asyncio.Lock()
+            HistoryStorage._chat_locks[chat_key] = lock
+        return lock
+
+    @staticmethod
+    def add_write_listener(listener: Callable[[ChatKey, Optional[Dict[str, Any]]], None]):
+        if listener not in HistoryStorage._write_listeners: HistoryStorage._write_listeners.append(listener)
+
+    @staticmethod
+    def remove_write_listener(listener: Callable[[ChatKey, Optional[Dict[str, Any]]], None]):
+        if listener in HistoryStorage._write_listeners: HistoryStorage._write_listeners.remove(listener)
+
+    @staticmethod
+    def _notify_write_listeners(chat_key: ChatKey, history_entry: Optional[Dict[str, Any]]):
+        for listener in list(HistoryStorage._write_listeners):
+            try: listener(chat_key, history_entry)
+            except Exception as e: logger.error(f"RelayChat HistoryStorage: 历史写入监听器 {getattr(listener, '__qualname__', listener)} 出错: {e}", exc_info=True)
+
+    @staticmethod
+    def get_stats() -> Dict[str, Any]:
+        return {"cache": HistoryStorage._get_session_cache().stats(), "io": IOExecutor.stats()}
 
     @staticmethod
     def _ensure_dir(directory: str):
@@ -38,11 +121,9 @@ class HistoryStorage:
             except Exception as e: logger.error(f"RelayChat HistoryStorage: 创建目录失败 {directory}: {e}")
 
     @staticmethod
-    def _get_file_path_for_chat(event: AstrMessageEvent) -> Optional[str]:
-        if not HistoryStorage.base_storage_path and HistoryStorage.config: 
-            HistoryStorage.init(HistoryStorage.config) 
-        elif not HistoryStorage.base_storage_path:
-             logger.error("RelayChat HistoryStorage: 未初始化 (config is None). 无法获取历史文件路径。")
+    def get_chat_key(event: AstrMessageEvent) -> Optional[ChatKey]:
+        if not HistoryStorage._get_backend():
+             logger.error("RelayChat HistoryStorage: 未初始化 (config is None). 无法确定历史会话。")
              return None
 
         platform_name = event.get_platform_name() or "unknown_platform"
@@ -66,33 +147,175 @@ class HistoryStorage:
             logger.warning(f"RelayChat HistoryStorage: 无法确定聊天ID (平台: {platform_name}, 类型: {event.get_message_type()}, sender: {event.get_sender_id()}, session: {event.get_session_id()}).")
             return None
             
-        directory = os.path.join(str(HistoryStorage.base_storage_path), platform_name, chat_type_dir) # 确保 path 是 str
-        HistoryStorage._ensure_dir(directory)
-        return os.path.join(directory, f"{str(chat_id)}.json")
+        return (platform_name, chat_type_dir, str(chat_id))
+
+    @staticmethod
+    async def _load_session(chat_key: ChatKey) -> List[Dict[str, Any]]:
+        cache = HistoryStorage._get_session_cache()
+        cached = cache.get(chat_key)
+        if cached is not None: return cached
+        async with RelayStats.contended(HistoryStorage._get_chat_lock(chat_key), "history_chat"):
+            if chat_key in cache: return cache.get(chat_key) or [] # 等锁期间可能已被其他协程加载
+            backend = HistoryStorage._get_backend()
+            RelayStats.incr("history_cache_miss")
+            with RelayStats.timer("history_load"):
+                entries = await IOExecutor.run(HistoryStorage._load_from_backend, backend, chat_key) if backend else []
+            evicted = cache.load(chat_key, entries)
+        await HistoryStorage._flush_evicted(evicted)
+        return entries
+
+    @staticmethod
+    def _load_from_backend(backend: HistoryBackend, chat_key: ChatKey) -> List[Dict[str, Any]]:
+        entries = backend.load_tail(chat_key, HistoryStorage.MAX_HISTORY_ENTRIES)
+        HistoryStorage._externalize_legacy_images(entries)
+        return entries
+
+    @staticmethod
+    def _externalize_legacy_images(entries: List[Dict[str, Any]]):
+        # 旧条目内联了整段 base64，加载时转存到 blob 目录，缓存中只保留哈希
+        for entry in entries:
+            legacy_uri = entry.get("image_base64_uri")
+            if not legacy_uri: continue
+            image_hash = ImageBlobStore.put_base64_uri(legacy_uri)
+            if image_hash:
+                entry.pop("image_base64_uri", None); entry["image_hash"] = image_hash
+
+    @staticmethod
+    async def _cache_entry(chat_key: ChatKey, history_entry: Dict[str, Any]):
+        cache = HistoryStorage._get_session_cache()
+        if chat_key not in cache: await HistoryStorage._load_session(chat_key)
+        evicted = cache.append(chat_key, history_entry)
+        RelayStats.incr("history_entries", reason=str(history_entry.get("role") or "")); RelayStats.incr("history_bytes", value=estimate_entry_bytes(history_entry))
+        HistoryStorage._notify_write_listeners(chat_key, history_entry)
+        await HistoryStorage._flush_evicted(evicted)
+        if HistoryStorage._flush_interval <= 0: await HistoryStorage._flush_session(chat_key) # 间隔为0时退化为直写
+        else: HistoryStorage._ensure_flush_task()
+
+    @staticmethod
+    async def _flush_evicted(evicted: List[Tuple[ChatKey, List[Dict[str, Any]]]]):
+        backend = HistoryStorage._get_backend()
+        for evicted_key, pending_entries in evicted:
+            try:
+                async with RelayStats.contended(HistoryStorage._get_chat_lock(evicted_key), "history_chat"):
+                    await IOExecutor.run(backend.append, evicted_key, pending_entries) # type: ignore
+            except Exception as e: logger.error(f"RelayChat HistoryStorage: 写回被淘汰会话 {evicted_key} 失败 ({len(pending_entries)} 条丢失): {e}", exc_info=True)
+
+    @staticmethod
+    async def _flush_session(chat_key: ChatKey):
+        cache = HistoryStorage._get_session_cache()
+        backend = HistoryStorage._get_backend()
+        if not backend: return
+        async with RelayStats.contended(HistoryStorage._get_chat_lock(chat_key), "history_chat"):
+            pending_entries = cache.take_pending(chat_key)
+            if not pending_entries: return
+            try:
+                with RelayStats.timer("history_flush"): await IOExecutor.run(backend.append, chat_key, pending_entries)
+                RelayStats.incr("history_entries_flushed", value=len(pending_entries))
+                logger.debug(f"RelayChat HistoryStorage: 已写回 {len(pending_entries)} 条历史到 {chat_key}.")
+            except Exception as e:
+                cache.restore_pending(chat_key, pending_entries)
+                logger.error(f"RelayChat HistoryStorage: 写回历史到 {chat_key} 失败: {e}", exc_info=True)
+                return
+            needs_compaction = await IOExecutor.run(backend.needs_compaction, chat_key)
+        if needs_compaction: HistoryStorage._schedule_compaction(chat_key, backend)
+
+    @staticmethod
+    def _schedule_compaction(chat_key: ChatKey, backend: HistoryBackend):
+        existing_task = HistoryStorage._compaction_tasks.get(chat_key)
+        if existing_task and not existing_task.done(): return
+        HistoryStorage._compaction_tasks[chat_key] = asyncio.get_running_loop().create_task(HistoryStorage._compact_session(chat_key, backend))
+
+    @staticmethod
+    async def _compact_session(chat_key: ChatKey, backend: HistoryBackend):
+        try:
+            async with RelayStats.contended(HistoryStorage._get_chat_lock(chat_key), "history_chat"):
+                await IOExecutor.run(backend.compact, chat_key)
+        except Exception as e:
+            logger.error(f"RelayChat HistoryStorage: 压缩会话 {chat_key} 失败: {e}", exc_info=True)
+        finally:
+            HistoryStorage._compaction_tasks.pop(chat_key, None)
+
+    @staticmethod
+    async def flush_all():
+        for chat_key in HistoryStorage._get_session_cache().dirty_keys():
+            await HistoryStorage._flush_session(chat_key)
+
+    @staticmethod
+    def _ensure_flush_task():
+        if HistoryStorage._flush_task and not HistoryStorage._flush_task.done(): return
+        HistoryStorage._flush_task = asyncio.get_running_loop().create_task(HistoryStorage._flush_loop())
+
+    @staticmethod
+    async def _flush_loop():
+        # 防抖写回：同一间隔内的多条消息合并为一次追加；没有待写内容时退出，下次写入时再启动
+        while True:
+            await asyncio.sleep(HistoryStorage._flush_interval)
+            await HistoryStorage.flush_all()
+            if not HistoryStorage._get_session_cache().dirty_keys(): break
+
+    @staticmethod
+    async def shutdown():
+        flush_task = HistoryStorage._flush_task
+        HistoryStorage._flush_task = None
+        if flush_task and not flush_task.done():
+            flush_task.cancel()
+            try: await flush_task
+            except asyncio.CancelledError: pass
+        await HistoryStorage.flush_all()
+        for compaction_task in list(HistoryStorage._compaction_tasks.values()):
+            try: await compaction_task
+            except Exception: pass
+        if HistoryStorage._backend is not None:
+            await IOExecutor.run(HistoryStorage._backend.close); HistoryStorage._backend = None
+        IOExecutor.shutdown()
+        logger.info(f"RelayChat HistoryStorage: 已写回所有缓存中的历史。")
+
+    @staticmethod
+    async def _ingest_once(chat_key: ChatKey, message_id: str, build_entry: Callable[[], Awaitable[Dict[str, Any]]]) -> bool:
+        # 一条群消息会被每个托管Bot的平台实例各收到一次，且都映射到同一会话。
+        # 按 message_id 保证只写入一次：第一个到达者写入，并发到达者等待其完成，之后到达者直接视为已存在。
+        # 第一个到达者写入失败 (构建条目出错或被取消) 时，等待者重新尝试写入，避免这条消息丢失。
+        ingest_key = (chat_key, message_id)
+        while True:
+            inflight = HistoryStorage._ingest_inflight.get(ingest_key)
+            if inflight is None: break
+            if await asyncio.shield(inflight): return False
+        done_future = asyncio.get_running_loop().create_future()
+        HistoryStorage._ingest_inflight[ingest_key] = done_future
+        stored = False
+        try:
+            cache = HistoryStorage._get_session_cache()
+            if chat_key not in cache: await HistoryStorage._load_session(chat_key)
+            if cache.has_message_id(chat_key, message_id): stored = True; return False
+            await HistoryStorage._cache_entry(chat_key, await build_entry())
+            stored = True
+            return True
+        finally:
+            HistoryStorage._ingest_inflight.pop(ingest_key, None)
+            if not done_future.done(): done_future.set_result(stored)
 
     @staticmethod
     async def _extract_relevant_info_for_history(components: Optional[List[BaseMessageComponent]]) -> Tuple[str, Optional[str]]:
+        # 返回 (文本摘要, 第一张 base64 图片在 ImageBlobStore 中的内容哈希)
         from .message_utils import MessageUtils 
         
         text_summary = ""
         if components:
             text_summary = await MessageUtils.outline_message_list(components, for_history=True)
         
-        image_base64_uri = None        
+        image_hash = None        
         if components:
             for comp in components:
                 if isinstance(comp, Image) and comp.file and comp.file.startswith("base64://"):
-                    image_base64_uri = comp.file 
+                    image_uri = await ImageNormalizer.normalize_base64_uri(comp.file) # 缩放压缩后再存，blob 和之后发给LLM的历史图片都更小
+                    image_hash = await IOExecutor.run(ImageBlobStore.put_base64_uri, image_uri) 
                     break 
-        return text_summary, image_base64_uri
+        return text_summary, image_hash
 
     @staticmethod
     async def process_and_save_user_message(event: AstrMessageEvent):
-        file_path = HistoryStorage._get_file_path_for_chat(event)
-        if not file_path: return
-        history: List[Dict[str, Any]] = await HistoryStorage.get_history_as_dicts(event)
-
-        text_summary, image_uri = await HistoryStorage._extract_relevant_info_for_history(event.get_messages())
+        chat_key = HistoryStorage.get_chat_key(event)
+        if not chat_key: return
         
         msg_obj = event.message_obj
         sender_name = "未知用户"
@@ -108,82 +331,81 @@ class HistoryStorage:
         if msg_obj and hasattr(msg_obj, 'message_id') and msg_obj.message_id:
             message_id_val = str(msg_obj.message_id)
 
-
-        history_entry = {
-            "role": "user", "name": sender_name, "user_id": sender_id_val,
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "text": text_summary, "message_id": message_id_val,
-        }
-        if image_uri: history_entry["image_base64_uri"] = image_uri
+        async def build_entry() -> Dict[str, Any]:
+            text_summary, image_hash = await HistoryStorage._extract_relevant_info_for_history(event.get_messages())
+            history_entry = {
+                "role": "user", "name": sender_name, "user_id": sender_id_val,
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "text": text_summary, "message_id": message_id_val,
+            }
+            if image_hash: history_entry["image_hash"] = image_hash
+            return history_entry
         
-        history.append(history_entry)
-        if len(history) > HistoryStorage.MAX_HISTORY_ENTRIES:
-            history = history[-HistoryStorage.MAX_HISTORY_ENTRIES:]
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            logger.debug(f"RelayChat HistoryStorage: 用户消息已保存到 '{file_path}' (事件MID: {message_id_val}).")
+            with RelayStats.timer("history_save_user"): ingested = await HistoryStorage._ingest_once(chat_key, message_id_val, build_entry)
+            if ingested:
+                logger.debug(f"RelayChat HistoryStorage: 用户消息已缓存待写入 {chat_key} (事件MID: {message_id_val}).")
+            else:
+                logger.debug(f"RelayChat HistoryStorage: 用户消息已由其他Bot实例写入 {chat_key} (事件MID: {message_id_val})，跳过。")
         except Exception as e:
-            logger.error(f"RelayChat HistoryStorage: 保存用户消息到 '{file_path}' 失败: {e}", exc_info=True)
+            logger.error(f"RelayChat HistoryStorage: 保存用户消息到 {chat_key} 失败: {e}", exc_info=True)
             
     @staticmethod
     async def process_and_save_bot_reply(event: AstrMessageEvent, bot_reply_chain: List[BaseMessageComponent], bot_physical_id: str, bot_persona_name: str):
-        file_path = HistoryStorage._get_file_path_for_chat(event)
-        if not file_path: return
-        history: List[Dict[str, Any]] = await HistoryStorage.get_history_as_dicts(event)
-
-        text_summary, image_uri = await HistoryStorage._extract_relevant_info_for_history(bot_reply_chain)
+        chat_key = HistoryStorage.get_chat_key(event)
+        if not chat_key: return
 
         # 从 event 中获取 message_id 作为关联，或者生成新的
         triggering_message_id = str(uuid.uuid4())
         if event.message_obj and hasattr(event.message_obj, 'message_id') and event.message_obj.message_id:
             triggering_message_id = str(event.message_obj.message_id)
+        reply_message_id = f"{triggering_message_id}_bot_reply_{bot_physical_id}" # 多个Bot回复同一条消息时各存一条
 
-
-        history_entry = {
-            "role": "assistant", "name": f"Bot_{bot_persona_name}", "user_id": bot_physical_id,
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "text": text_summary, "message_id": triggering_message_id + "_bot_reply",
-        }
-        if image_uri: history_entry["image_base64_uri"] = image_uri
+        async def build_entry() -> Dict[str, Any]:
+            text_summary, image_hash = await HistoryStorage._extract_relevant_info_for_history(bot_reply_chain)
+            history_entry = {
+                "role": "assistant", "name": f"Bot_{bot_persona_name}", "user_id": bot_physical_id,
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "text": text_summary, "message_id": reply_message_id,
+            }
+            if image_hash: history_entry["image_hash"] = image_hash
+            return history_entry
             
-        history.append(history_entry)
-        if len(history) > HistoryStorage.MAX_HISTORY_ENTRIES:
-            history = history[-HistoryStorage.MAX_HISTORY_ENTRIES:]
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            logger.debug(f"RelayChat HistoryStorage: Bot回复已保存到 '{file_path}'.")
+            with RelayStats.timer("history_save_reply", bot_persona_name): ingested = await HistoryStorage._ingest_once(chat_key, reply_message_id, build_entry)
+            if ingested:
+                logger.debug(f"RelayChat HistoryStorage: Bot回复已缓存待写入 {chat_key}.")
+            else:
+                logger.debug(f"RelayChat HistoryStorage: Bot回复 {reply_message_id} 已存在于 {chat_key}，跳过。")
         except Exception as e:
-            logger.error(f"RelayChat HistoryStorage: 保存Bot回复到 '{file_path}' 失败: {e}", exc_info=True)
+            logger.error(f"RelayChat HistoryStorage: 保存Bot回复到 {chat_key} 失败: {e}", exc_info=True)
+
+    @staticmethod
+    async def get_history_as_dicts(event: AstrMessageEvent, max_entries: Optional[int] = None) -> List[Dict[str, Any]]:
+        chat_key = HistoryStorage.get_chat_key(event)
+        if not chat_key: return []
+        return await HistoryStorage.get_history_by_chat_key(chat_key, max_entries)
 
     @staticmethod
-    async def get_history_as_dicts(event: AstrMessageEvent) -> List[Dict[str, Any]]:
-        file_path = HistoryStorage._get_file_path_for_chat(event)
-        if not file_path or not os.path.exists(file_path): return []
+    async def get_history_by_chat_key(chat_key: ChatKey, max_entries: Optional[int] = None) -> List[Dict[str, Any]]:
         try:
-            with open(file_path, "r", encoding="utf-8") as f: 
-                file_content = f.read()
-                if not file_content.strip(): # 如果文件为空
-                    return []
-                history_data = json.loads(file_content)
-            if not isinstance(history_data, list): 
-                logger.warning(f"RelayChat HistoryStorage: 历史文件 '{file_path}'内容不是列表。")
-                return []
-            return history_data
-        except json.JSONDecodeError as e_json:
-            logger.error(f"RelayChat HistoryStorage: JSON解码历史文件 '{file_path}' 失败: {e_json}. 文件内容(前100字节): '{file_content[:100]}'")
-            return []
+            history = await HistoryStorage._load_session(chat_key)
+            if max_entries is not None: history = history[-max_entries:] if max_entries > 0 else []
+            return history
         except Exception as e: 
-            logger.error(f"RelayChat HistoryStorage:读取历史 '{file_path}' 失败: {e}", exc_info=True); return []
+            logger.error(f"RelayChat HistoryStorage:读取历史 {chat_key} 失败: {e}", exc_info=True); return []
             
     @staticmethod
-    def clear_history(event: AstrMessageEvent) -> bool:
-        file_path = HistoryStorage._get_file_path_for_chat(event)
-        if not file_path: return False
+    async def clear_history(event: AstrMessageEvent) -> bool:
+        chat_key = HistoryStorage.get_chat_key(event)
+        backend = HistoryStorage._get_backend()
+        if not chat_key or not backend: return False
         try:
-            if os.path.exists(file_path): os.remove(file_path)
-            logger.info(f"RelayChat HistoryStorage: 已清空历史 '{file_path}'.")
+            async with RelayStats.contended(HistoryStorage._get_chat_lock(chat_key), "history_chat"):
+                HistoryStorage._get_session_cache().discard(chat_key)
+                await IOExecutor.run(backend.clear, chat_key)
+            HistoryStorage._notify_write_listeners(chat_key, None)
+            logger.info(f"RelayChat HistoryStorage: 已清空历史 {chat_key}.")
             return True
         except Exception as e:
-            logger.error(f"RelayChat HistoryStorage: 清空历史 '{file_path}' 失败: {e}"); return False
+            logger.error(f"RelayChat HistoryStorage: 清空历史 {chat_key} 失败: {e}"); return False
@@ -0,0 +1,182 @@
+# astrbot_plugin_relaychat/utils/history_summarizer.py
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from astrbot.api.all import Context, AstrBotConfig
+from .history_backends import ChatKey
+from .history_storage import HistoryStorage
+from .io_executor import IOExecutor
+from .message_utils import MessageUtils
+
+logger = logging.getLogger(__name__)
+
+
+class HistorySummarizer:
+    """
+    按会话维护"较早历史"的滚动摘要。
+    最近 window 条历史原样发送给 LLM，更早的部分每新增 K 条消息在后台增量合并进摘要，摘要以 JSON 文件存放在历史目录旁。
+    """
+    SUMMARY_DIR_NAME = "summaries"
+    WINDOW_DEFAULT = 20
+    REFRESH_EVERY_DEFAULT = 10
+    MAX_CHARS_DEFAULT = 600
+    BATCH_MAX_ENTRIES = 60 # 单次调用 LLM 合并的最多条数，积压更多时分批合并
+    MAX_CACHED_CHATS = 1024 # 内存中最多保留的会话数，按 LRU 淘汰；摘要在磁盘上，淘汰后下次用到时重新读取
+    SUMMARY_SYSTEM_PROMPT = "你是一个聊天记录整理助手，只负责客观、简洁地总结群聊内容，不扮演任何角色。"
+
+    enabled: bool = False
+    window: int = WINDOW_DEFAULT
+    refresh_every: int = REFRESH_EVERY_DEFAULT
+    max_chars: int = MAX_CHARS_DEFAULT
+    base_path: Optional[str] = None
+    _context: Optional[Context] = None
+    _summaries: "OrderedDict[ChatKey, Dict[str, Any]]" = OrderedDict() # chat_key -> {"text", "covered_until", "updated_at"}
+    _new_entry_counts: "OrderedDict[ChatKey, int]" = OrderedDict() # 淘汰只会推迟该会话的下一次摘要，未合并的历史仍按 covered_until 找回
+    _refresh_tasks: Dict[ChatKey, asyncio.Task] = {}
+
+    @staticmethod
+    def init(context: Context, plugin_config: AstrBotConfig):
+        HistorySummarizer._context = context
+        HistorySummarizer.enabled = bool(plugin_config.get("history_summary_enabled", False))
+        HistorySummarizer.configure_window(plugin_config)
+        HistorySummarizer.refresh_every = max(1, int(plugin_config.get("history_summary_refresh_every", HistorySummarizer.REFRESH_EVERY_DEFAULT)))
+        HistorySummarizer.max_chars = max(50, int(plugin_config.get("history_summary_max_chars", HistorySummarizer.MAX_CHARS_DEFAULT)))
+        if HistoryStorage.base_storage_path:
+            HistorySummarizer.base_path = os.path.join(HistoryStorage.base_storage_path, HistorySummarizer.SUMMARY_DIR_NAME)
+        if HistorySummarizer.enabled: HistoryStorage.add_write_listener(HistorySummarizer._on_history_write)
+        else: HistoryStorage.remove_write_listener(HistorySummarizer._on_history_write)
+        logger.debug(f"RelayChat HistorySummarizer: enabled={HistorySummarizer.enabled}, window={HistorySummarizer.window}, "
+                     f"refresh_every={HistorySummarizer.refresh_every}, max_chars={HistorySummarizer.max_chars}")
+
+    @staticmethod
+    def configure_window(plugin_config: AstrBotConfig):
+        # 默认与 LLM 的历史条数一致：窗口内的历史原样发送，窗口外的进入摘要。热重载时随 llm_max_history_default 一起更新
+        HistorySummarizer.window = max(1, int(plugin_config.get("history_summary_window", plugin_config.get("llm_max_history_default", HistorySummarizer.WINDOW_DEFAULT))))
+
+    @staticmethod
+    def _summary_path(chat_key: ChatKey) -> Optional[str]:
+        if not HistorySummarizer.base_path: return None
+        platform_name, chat_type_dir, chat_id = chat_key
+        return os.path.join(HistorySummarizer.base_path, platform_name, chat_type_dir, f"{chat_id}.json")
+
+    @staticmethod
+    def _read_summary_file(chat_key: ChatKey) -> Dict[str, Any]:
+        path = HistorySummarizer._summary_path(chat_key)
+        if not path or not os.path.exists(path): return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f: state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except Exception as e:
+            logger.warning(f"RelayChat HistorySummarizer: 读取摘要 '{path}' 失败: {e}"); return {}
+
+    @staticmethod
+    def _write_summary_file(chat_key: ChatKey, state: Dict[str, Any]):
+        path = HistorySummarizer._summary_path(chat_key)
+        if not path: return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _delete_summary_file(chat_key: ChatKey):
+        path = HistorySummarizer._summary_path(chat_key)
+        if path and os.path.exists(path): os.remove(path)
+
+    @staticmethod
+    def _remember(lru: "OrderedDict[ChatKey, Any]", chat_key: ChatKey, value: Any):
+        lru[chat_key] = value
+        lru.move_to_end(chat_key)
+        while len(lru) > HistorySummarizer.MAX_CACHED_CHATS: lru.popitem(last=False)
+
+    @staticmethod
+    async def _get_state(chat_key: ChatKey) -> Dict[str, Any]:
+        state = HistorySummarizer._summaries.get(chat_key)
+        if state is None:
+            state = await IOExecutor.run(HistorySummarizer._read_summary_file, chat_key)
+            state = HistorySummarizer._summaries.get(chat_key, state) # 读取期间后台刷新可能已写入更新的摘要
+        HistorySummarizer._remember(HistorySummarizer._summaries, chat_key, state)
+        return state
+
+    @staticmethod
+    async def get_summary(chat_key: Optional[ChatKey]) -> Optional[str]:
+        if not HistorySummarizer.enabled or not chat_key: return None
+        try: return (await HistorySummarizer._get_state(chat_key)).get("text") or None
+        except Exception as e:
+            logger.warning(f"RelayChat HistorySummarizer: 获取 {chat_key} 的摘要失败: {e}"); return None
+
+    @staticmethod
+    def _on_history_write(chat_key: ChatKey, history_entry: Optional[Dict[str, Any]]):
+        if history_entry is None: # 会话被清空，摘要随之作废
+            HistorySummarizer._summaries.pop(chat_key, None); HistorySummarizer._new_entry_counts.pop(chat_key, None)
+            refresh_task = HistorySummarizer._refresh_tasks.pop(chat_key, None)
+            if refresh_task and not refresh_task.done(): refresh_task.cancel()
+            asyncio.get_running_loop().create_task(IOExecutor.run(HistorySummarizer._delete_summary_file, chat_key))
+            return
+        count = HistorySummarizer._new_entry_counts.get(chat_key, 0) + 1
+        existing_task = HistorySummarizer._refresh_tasks.get(chat_key)
+        if count < HistorySummarizer.refresh_every or (existing_task and not existing_task.done()):
+            HistorySummarizer._remember(HistorySummarizer._new_entry_counts, chat_key, count); return
+        HistorySummarizer._remember(HistorySummarizer._new_entry_counts, chat_key, 0)
+        HistorySummarizer._refresh_tasks[chat_key] = asyncio.get_running_loop().create_task(HistorySummarizer._refresh(chat_key))
+
+    @staticmethod
+    def _select_unsummarized(history: List[Dict[str, Any]], covered_until: Optional[str]) -> List[Dict[str, Any]]:
+        older = history[:-HistorySummarizer.window] if len(history) > HistorySummarizer.window else []
+        if not older or not covered_until: return older
+        for i in range(len(history) - 1, -1, -1):
+            if history[i].get("message_id") == covered_until: return older[i + 1:]
+        return older # 上次摘要到的位置已被保留策略淘汰，剩下的较早历史都是新的
+
+    @staticmethod
+    async def _refresh(chat_key: ChatKey):
+        # 在后台运行，不占用回复路径；失败只记录日志，下一轮再试
+        try:
+            history = await HistoryStorage.get_history_by_chat_key(chat_key)
+            state = await HistorySummarizer._get_state(chat_key)
+            pending_entries = HistorySummarizer._select_unsummarized(history, state.get("covered_until"))
+            while pending_entries:
+                batch = pending_entries[:HistorySummarizer.BATCH_MAX_ENTRIES]
+                summary_text = await HistorySummarizer._summarize(chat_key, state.get("text") or "", batch)
+                if summary_text is None: return
+                state = {"text": summary_text, "covered_until": batch[-1].get("message_id"), "updated_at": time.time()}
+                HistorySummarizer._remember(HistorySummarizer._summaries, chat_key, state)
+                await IOExecutor.run(HistorySummarizer._write_summary_file, chat_key, state)
+                logger.debug(f"RelayChat HistorySummarizer: 已更新 {chat_key} 的摘要 (合并 {len(batch)} 条，长度 {len(summary_text)})。")
+                pending_entries = pending_entries[len(batch):]
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            logger.error(f"RelayChat HistorySummarizer: 更新 {chat_key} 的摘要失败: {e}", exc_info=True)
+        finally:
+            if HistorySummarizer._refresh_tasks.get(chat_key) is asyncio.current_task(): HistorySummarizer._refresh_tasks.pop(chat_key, None)
+
+    @staticmethod
+    async def _summarize(chat_key: ChatKey, previous_summary: str, entries: List[Dict[str, Any]]) -> Optional[str]:
+        provider = HistorySummarizer._context.get_using_provider() if HistorySummarizer._context else None
+        if not provider:
+            logger.warning("RelayChat HistorySummarizer: 没有可用的LLM Provider，跳过摘要。"); return None
+        new_history_text = "\n-\n".join(MessageUtils.format_history_entry(e) for e in entries)
+        prompt = (
+            f"已有的对话摘要：\n{previous_summary or '(无)'}\n\n"
+            f"以下是紧接在摘要之后的更多聊天记录：\n{new_history_text}\n\n"
+            f"请把这些聊天记录合并进摘要，保留人物、话题、结论和仍未解决的问题，使用中文，不超过 {HistorySummarizer.max_chars} 字。只输出新的摘要。"
+        )
+        llm_response = await provider.text_chat(
+            prompt=prompt, session_id=f"relaychat_summary_{'_'.join(chat_key)}", contexts=[],
+            system_prompt=HistorySummarizer.SUMMARY_SYSTEM_PROMPT)
+        summary_text = (llm_response.completion_text or "").strip() if llm_response and llm_response.role != "err" else ""
+        if not summary_text:
+            logger.warning(f"RelayChat HistorySummarizer: LLM 没有返回 {chat_key} 的摘要。"); return None
+        return summary_text[:HistorySummarizer.max_chars]
+
+    @staticmethod
+    async def shutdown():
+        tasks = [t for t in HistorySummarizer._refresh_tasks.values() if not t.done()]
+        HistorySummarizer._refresh_tasks.clear()
+        for refresh_task in tasks: refresh_task.cancel()
+        if tasks: await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,93 @@
+# astrbot_plugin_relaychat/utils/image_blob_store.py
+import os
+import uuid
+import base64
+import hashlib
+import binascii
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+BASE64_URI_PREFIX = "base64://"
+
+
+class ImageBlobStore:
+    """
+    按内容哈希存储图片的 blob 目录。
+    历史记录中只保存哈希 (image_hash)，需要发送给 LLM 时再按哈希读取并还原为 base64:// URI。
+    """
+    base_path: Optional[str] = None
+    BLOB_DIR_NAME = "blobs"
+
+    @staticmethod
+    def init(history_base_path: str):
+        ImageBlobStore.base_path = os.path.join(history_base_path, ImageBlobStore.BLOB_DIR_NAME)
+        try: os.makedirs(ImageBlobStore.base_path, exist_ok=True)
+        except Exception as e: logger.error(f"RelayChat ImageBlobStore: 创建目录失败 {ImageBlobStore.base_path}: {e}")
+        logger.debug(f"RelayChat ImageBlobStore: blob 目录已初始化为 {ImageBlobStore.base_path}")
+
+    @staticmethod
+    def hash_bytes(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def decode_base64_uri(uri: str) -> Optional[bytes]:
+        if not uri or not uri.startswith(BASE64_URI_PREFIX): return None
+        try: return base64.b64decode(uri[len(BASE64_URI_PREFIX):], validate=False)
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"RelayChat ImageBlobStore: base64 图片解码失败: {e}")
+            return None
+
+    @staticmethod
+    def _blob_path(image_hash: str) -> Optional[str]:
+        if not ImageBlobStore.base_path or len(image_hash) < 3 or not all(c in "0123456789abcdef" for c in image_hash): return None
+        return os.path.join(ImageBlobStore.base_path, image_hash[:2], image_hash)
+
+    @staticmethod
+    def put_bytes(data: bytes) -> Optional[str]:
+        image_hash = ImageBlobStore.hash_bytes(data)
+        blob_path = ImageBlobStore._blob_path(image_hash)
+        if not blob_path:
+            logger.error("RelayChat ImageBlobStore: 未初始化，无法保存图片。"); return None
+        if os.path.exists(blob_path): return image_hash # 相同内容只存一份
+        tmp_path = f"{blob_path}.{uuid.uuid4().hex}.tmp" # 每次写入独立的临时文件，多个线程同时保存同一张图片时互不干扰
+        try:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            with open(tmp_path, "wb") as f: f.write(data)
+            os.replace(tmp_path, blob_path)
+            return image_hash
+        except Exception as e:
+            if os.path.exists(blob_path): return image_hash # 其他写入者已保存了相同内容
+            logger.error(f"RelayChat ImageBlobStore: 保存图片 blob '{image_hash}' 失败: {e}", exc_info=True)
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                try: os.remove(tmp_path)
+                except OSError: pass
+
+    @staticmethod
+    def put_base64_uri(uri: str) -> Optional[str]:
+        data = ImageBlobStore.decode_base64_uri(uri)
+        if data is None: return None
+        return ImageBlobStore.put_bytes(data)
+
+    @staticmethod
+    def get_bytes(image_hash: str) -> Optional[bytes]:
+        blob_path = ImageBlobStore._blob_path(image_hash)
+        if not blob_path or not os.path.exists(blob_path):
+            logger.warning(f"RelayChat ImageBlobStore: 找不到图片 blob '{image_hash}'."); return None
+        try:
+            with open(blob_path, "rb") as f: return f.read()
+        except Exception as e:
+            logger.error(f"RelayChat ImageBlobStore: 读取图片 blob '{image_hash}' 失败: {e}"); return None
+
+    @staticmethod
+    def get_base64_uri(image_hash: str) -> Optional[str]:
+        data = ImageBlobStore.get_bytes(image_hash)
+        if data is None: return None
+        return ImageBlobStore.encode_base64_uri(data)
+
+    @staticmethod
+    def encode_base64_uri(data: bytes) -> str:
+        return BASE64_URI_PREFIX + base64.b64encode(data).decode("ascii")
@@ -1,103 +1,291 @@
 # astrbot_plugin_relaychat/utils/image_caption.py
 
 from astrbot.api.all import logger, Context, AstrBotConfig # 从 all 导入，保持一致性
+import os
+import uuid
 import asyncio
-from typing import Optional, List, Any
+import hashlib
+from collections import OrderedDict
+from typing import Optional, List, Any, Dict, Type
+
+from .image_blob_store import ImageBlobStore, BASE64_URI_PREFIX
+from .io_executor import IOExecutor
+from .history_storage import HistoryStorage
+
+
+class ImageCaptioner:
+    """图像描述后端。不同实现只需覆盖 caption；输入为 base64:// URI 或图片URL。"""
+    name = "base"
+
+    def __init__(self, context: Optional[Context], plugin_config: Optional[AstrBotConfig]):
+        self.context = context
+        self.plugin_config = plugin_config
+
+    async def caption(self, image_uri: str) -> Optional[str]:
+        raise NotImplementedError
+
+
+class ProviderImageCaptioner(ImageCaptioner):
+    # 使用支持图片输入的 LLM Provider 生成描述；image_caption_provider_id 为空时使用当前 Provider
+    name = "provider"
+    CAPTION_PROMPT = "请用一句简短的中文描述这张图片的内容。如果是表情包，请说明它表达的情绪或含义。只输出描述本身。"
+    CAPTION_SYSTEM_PROMPT = "你是一个图片描述助手。"
+
+    def _get_provider(self) -> Any:
+        if not self.context: return None
+        provider_id = (self.plugin_config.get("image_caption_provider_id", "") if self.plugin_config else "") or ""
+        if provider_id and hasattr(self.context, "get_provider_by_id"):
+            provider = self.context.get_provider_by_id(provider_id) # type: ignore
+            if provider: return provider
+            logger.warning(f"ImageCaptionUtils: 找不到 Provider '{provider_id}'，改用当前 Provider。")
+        return self.context.get_using_provider()
+
+    async def caption(self, image_uri: str) -> Optional[str]:
+        provider = self._get_provider()
+        if not provider:
+            logger.warning("ImageCaptionUtils: 没有可用的LLM Provider，无法生成图像描述。"); return None
+        llm_response = await provider.text_chat(
+            prompt=self.CAPTION_PROMPT, session_id="relaychat_image_caption", image_urls=[image_uri],
+            contexts=[], system_prompt=self.CAPTION_SYSTEM_PROMPT)
+        if not llm_response or llm_response.role == "err": return None
+        return (llm_response.completion_text or "").strip() or None
+
+
+class PlaceholderImageCaptioner(ImageCaptioner):
+    # 不调用任何模型，只根据文件名给出粗略描述；用于调试或没有多模态模型时
+    name = "placeholder"
+
+    async def caption(self, image_uri: str) -> Optional[str]:
+        lowered = image_uri[:200].lower() if not image_uri.startswith(BASE64_URI_PREFIX) else ""
+        if "cat" in lowered: return "一只可爱的猫"
+        if "dog" in lowered: return "一只活泼的狗"
+        if "landscape" in lowered: return "美丽的风景"
+        return "一张图片"
+
+
+IMAGE_CAPTIONERS: Dict[str, Type[ImageCaptioner]] = {
+    ProviderImageCaptioner.name: ProviderImageCaptioner,
+    PlaceholderImageCaptioner.name: PlaceholderImageCaptioner,
+}
 
-# 假设我们未来可能会用到 Context 和 AstrBotConfig 进行初始化或获取API密钥等
-_context_ref: Optional[Context] = None
-_config_ref: Optional[AstrBotConfig] = None
-_is_initialized: bool = False
 
 class ImageCaptionUtils:
     """
     图像描述生成工具类。
-    当前版本只提供基础的占位符或模拟描述。
+    描述按图片内容哈希缓存 (内存 LRU + 磁盘)，相同的表情包只描述一次；并发数受信号量限制，同一张图片的并发请求共用一次调用。
     """
+    CACHE_DIR_NAME = "captions"
+    MEMORY_CACHE_SIZE_DEFAULT = 512
+    MAX_CONCURRENCY_DEFAULT = 2
+    HISTORY_IMAGE_MODES = ("image", "caption") # image: 历史图片以图片发送; caption: 历史图片替换为缓存的文字描述
+    CAPTION_TOKENS_ESTIMATE = 48 # Token预算中每条历史图片描述的预留量
+
+    enabled: bool = False
+    history_image_mode: str = HISTORY_IMAGE_MODES[0]
+    _captioner: Optional[ImageCaptioner] = None
+    _memory_cache: "OrderedDict[str, str]" = OrderedDict()
+    _memory_cache_size: int = MEMORY_CACHE_SIZE_DEFAULT
+    _max_concurrency: int = MAX_CONCURRENCY_DEFAULT
+    _semaphore: Optional[asyncio.Semaphore] = None
+    _semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+    _in_flight: Dict[str, asyncio.Task] = {}
+    _cache_dir: Optional[str] = None
+    _counters: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "shared_in_flight": 0, "captioned": 0, "failed": 0}
 
     @staticmethod
     def init(context: Context, plugin_config: AstrBotConfig):
+        """读取配置并创建描述后端。磁盘缓存放在历史目录下，需在 HistoryStorage.init 之后调用。"""
+        ImageCaptionUtils.enabled = bool(plugin_config.get("image_caption_enable", False))
+        ImageCaptionUtils._memory_cache_size = max(0, int(plugin_config.get("image_caption_cache_size", ImageCaptionUtils.MEMORY_CACHE_SIZE_DEFAULT)))
+        ImageCaptionUtils._max_concurrency = max(1, int(plugin_config.get("image_caption_max_concurrency", ImageCaptionUtils.MAX_CONCURRENCY_DEFAULT)))
+        ImageCaptionUtils._semaphore = None
+        ImageCaptionUtils._memory_cache.clear()
+        if ImageBlobStore.base_path:
+            ImageCaptionUtils._cache_dir = os.path.join(os.path.dirname(ImageBlobStore.base_path), ImageCaptionUtils.CACHE_DIR_NAME)
+        backend_name = str(plugin_config.get("image_caption_backend", ProviderImageCaptioner.name) or ProviderImageCaptioner.name).strip().lower()
+        captioner_cls = IMAGE_CAPTIONERS.get(backend_name)
+        if captioner_cls is None:
+            logger.warning(f"ImageCaptionUtils: 未知的图像描述后端 '{backend_name}'，使用 '{ProviderImageCaptioner.name}'。")
+            captioner_cls = ProviderImageCaptioner
+        ImageCaptionUtils._captioner = captioner_cls(context, plugin_config)
+        ImageCaptionUtils.history_image_mode = ImageCaptionUtils.parse_history_image_mode(plugin_config.get("llm_history_image_mode"))
+        # 描述模式下，带图片的历史一写入就在后台生成描述，等到发给LLM时通常已经在缓存中
+        if ImageCaptionUtils.history_image_mode == "caption": HistoryStorage.add_write_listener(ImageCaptionUtils._on_history_write)
+        else: HistoryStorage.remove_write_listener(ImageCaptionUtils._on_history_write)
+        logger.debug(f"ImageCaptionUtils initialized. Enabled={ImageCaptionUtils.enabled}, Backend={captioner_cls.name}, HistoryImageMode={ImageCaptionUtils.history_image_mode}, "
+                     f"MaxConcurrency={ImageCaptionUtils._max_concurrency}, CacheSize={ImageCaptionUtils._memory_cache_size}, CacheDir={ImageCaptionUtils._cache_dir}")
+
+    @staticmethod
+    def parse_history_image_mode(value: Any) -> str:
+        mode = str(value or ImageCaptionUtils.HISTORY_IMAGE_MODES[0]).strip().lower()
+        if mode not in ImageCaptionUtils.HISTORY_IMAGE_MODES:
+            logger.warning(f"ImageCaptionUtils: 未知的 llm_history_image_mode '{value}'，使用 '{ImageCaptionUtils.HISTORY_IMAGE_MODES[0]}'。")
+            return ImageCaptionUtils.HISTORY_IMAGE_MODES[0]
+        return mode
+
+    @staticmethod
+    def set_captioner(captioner: ImageCaptioner):
+        """替换描述后端 (例如测试时使用本地的假实现)，已缓存的描述保持不变。"""
+        ImageCaptionUtils._captioner = captioner
+
+    @staticmethod
+    def _get_semaphore() -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if ImageCaptionUtils._semaphore is None or ImageCaptionUtils._semaphore_loop is not loop:
+            ImageCaptionUtils._semaphore = asyncio.Semaphore(ImageCaptionUtils._max_concurrency)
+            ImageCaptionUtils._semaphore_loop = loop
+        return ImageCaptionUtils._semaphore
+
+    @staticmethod
+    def _load_image_for_caption(image_url_or_path: str) -> Optional[tuple]:
+        # 返回 (内容哈希, 发送给描述后端的URI)；URL 不下载，按URL本身计算哈希
+        if image_url_or_path.startswith(BASE64_URI_PREFIX):
+            data = ImageBlobStore.decode_base64_uri(image_url_or_path)
+            return (ImageBlobStore.hash_bytes(data), image_url_or_path) if data else None
+        if image_url_or_path.startswith(("http://", "https://")):
+            return "url_" + hashlib.sha256(image_url_or_path.encode("utf-8")).hexdigest(), image_url_or_path
+        path = image_url_or_path[len("file://"):] if image_url_or_path.startswith("file://") else image_url_or_path
+        if not os.path.isfile(path): return None
+        with open(path, "rb") as f: data = f.read()
+        return ImageBlobStore.hash_bytes(data), ImageBlobStore.encode_base64_uri(data)
+
+    @staticmethod
+    def _cache_path(content_hash: str) -> Optional[str]:
+        if not ImageCaptionUtils._cache_dir: return None
+        return os.path.join(ImageCaptionUtils._cache_dir, content_hash[:2], f"{content_hash}.txt")
+
+    @staticmethod
+    def _read_cached_caption(content_hash: str) -> Optional[str]:
+        path = ImageCaptionUtils._cache_path(content_hash)
+        if not path or not os.path.exists(path): return None
+        with open(path, "r", encoding="utf-8") as f: return f.read().strip() or None
+
+    @staticmethod
+    def _write_cached_caption(content_hash: str, caption: str):
+        path = ImageCaptionUtils._cache_path(content_hash)
+        if not path: return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp" # 与 ImageBlobStore 一样每次写入独立的临时文件，并发写同一描述时互不干扰
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(caption)
+            os.replace(tmp_path, path)
+        except OSError:
+            if not os.path.exists(path): raise # 其他写入者已写好同一描述时视为成功
+        finally:
+            if os.path.exists(tmp_path):
+                try: os.remove(tmp_path)
+                except OSError: pass
+
+    @staticmethod
+    def _remember(content_hash: str, caption: str):
+        if ImageCaptionUtils._memory_cache_size <= 0: return
+        ImageCaptionUtils._memory_cache[content_hash] = caption
+        ImageCaptionUtils._memory_cache.move_to_end(content_hash)
+        while len(ImageCaptionUtils._memory_cache) > ImageCaptionUtils._memory_cache_size: ImageCaptionUtils._memory_cache.popitem(last=False)
+
+    @staticmethod
+    def get_cached_caption(content_hash: str) -> Optional[str]:
+        """只查内存缓存，不触发描述生成。"""
+        caption = ImageCaptionUtils._memory_cache.get(content_hash)
+        if caption is not None: ImageCaptionUtils._memory_cache.move_to_end(content_hash)
+        return caption
+
+    @staticmethod
+    async def _caption_uncached(content_hash: str, image_uri: Optional[str]) -> Optional[str]:
+        try:
+            caption = await IOExecutor.run(ImageCaptionUtils._read_cached_caption, content_hash)
+            if caption:
+                ImageCaptionUtils._counters["disk_hits"] += 1
+                ImageCaptionUtils._remember(content_hash, caption); return caption
+        except Exception as e:
+            logger.warning(f"ImageCaptionUtils: 读取描述缓存 '{content_hash}' 失败: {e}")
+        captioner = ImageCaptionUtils._captioner
+        if captioner is None: return None
+        if image_uri is None: # 历史图片：磁盘缓存未命中时才从 blob 目录读取图片
+            try: image_uri = await IOExecutor.run(ImageBlobStore.get_base64_uri, content_hash)
+            except Exception as e: logger.warning(f"ImageCaptionUtils: 读取图片 blob '{content_hash}' 失败: {e}")
+            if not image_uri: return None
+        try:
+            async with ImageCaptionUtils._get_semaphore():
+                caption = await captioner.caption(image_uri)
+        except Exception as e:
+            logger.error(f"ImageCaptionUtils: 生成图像描述失败 ({captioner.name}): {e}", exc_info=True); caption = None
+        if not caption:
+            ImageCaptionUtils._counters["failed"] += 1; return None # 失败不缓存，下次再试
+        ImageCaptionUtils._counters["captioned"] += 1
+        ImageCaptionUtils._remember(content_hash, caption)
+        try: await IOExecutor.run(ImageCaptionUtils._write_cached_caption, content_hash, caption)
+        except Exception as e: logger.warning(f"ImageCaptionUtils: 写入描述缓存 '{content_hash}' 失败: {e}")
+        return caption
+
+    @staticmethod
+    async def caption_by_hash(content_hash: str, image_uri: Optional[str] = None) -> Optional[str]:
         """
-        初始化图像描述模块 (如果需要)。
-        例如，可以在这里加载模型或设置API密钥。
+        按内容哈希获取描述：依次查内存缓存、进行中的请求、磁盘缓存，最后才调用描述后端。
+        image_uri 为空时按哈希从图片 blob 目录读取图片 (即历史记录中的 image_hash)。
         """
-        global _context_ref, _config_ref, _is_initialized
-        _context_ref = context
-        _config_ref = plugin_config # 这是 RelayChatPlugin 实例的配置
-        
-        # 从插件配置中读取图像描述相关的设置
-        # enable_captioning = plugin_config.get("image_captioning_enable", False)
-        # caption_api_key = plugin_config.get("image_caption_api_key")
-        # caption_model_path = plugin_config.get("image_caption_model_path")
-        
-        # if enable_captioning:
-        #     logger.info("ImageCaptionUtils: 图像描述功能已启用 (模拟模式)。")
-        #     # 在这里可以进行API客户端的初始化或模型的加载 (如果不是模拟模式)
-        # else:
-        #     logger.info("ImageCaptionUtils: 图像描述功能未启用。")
-            
-        _is_initialized = True
-        logger.debug("ImageCaptionUtils initialized (basic/placeholder version).")
+        caption = ImageCaptionUtils.get_cached_caption(content_hash)
+        if caption is not None:
+            ImageCaptionUtils._counters["memory_hits"] += 1; return caption
+        task = ImageCaptionUtils._in_flight.get(content_hash)
+        if task is not None: ImageCaptionUtils._counters["shared_in_flight"] += 1
+        else:
+            task = asyncio.get_running_loop().create_task(ImageCaptionUtils._caption_uncached(content_hash, image_uri))
+            ImageCaptionUtils._in_flight[content_hash] = task
+            task.add_done_callback(lambda t: ImageCaptionUtils._in_flight.pop(content_hash, None) if ImageCaptionUtils._in_flight.get(content_hash) is t else None)
+        return await asyncio.shield(task) # 某个等待方被取消时不影响共用同一请求的其他调用方
 
     @staticmethod
-    async def generate_image_caption(image_url_or_path: str) -> Optional[str]:
+    def _on_history_write(chat_key: Any, history_entry: Optional[Dict[str, Any]]):
+        image_hash = history_entry.get("image_hash") if history_entry else None
+        if isinstance(image_hash, str) and image_hash: ImageCaptionUtils._prefetch_history_caption(image_hash)
+
+    @staticmethod
+    def _prefetch_history_caption(image_hash: str):
+        if image_hash in ImageCaptionUtils._memory_cache or image_hash in ImageCaptionUtils._in_flight: return
+        asyncio.get_running_loop().create_task(ImageCaptionUtils.caption_by_hash(image_hash))
+
+    @staticmethod
+    async def get_history_caption(image_hash: str) -> Optional[str]:
+        """
+        取历史图片的描述，不等待描述生成：内存或磁盘缓存中没有时返回 None，并在后台开始生成，供之后的请求使用。
         """
-        为给定的图像URL或本地路径生成文本描述。
-        当前为模拟实现。
+        caption = ImageCaptionUtils.get_cached_caption(image_hash)
+        if caption is not None:
+            ImageCaptionUtils._counters["memory_hits"] += 1; return caption
+        if image_hash in ImageCaptionUtils._in_flight: return None
+        try: caption = await IOExecutor.run(ImageCaptionUtils._read_cached_caption, image_hash)
+        except Exception as e: logger.warning(f"ImageCaptionUtils: 读取描述缓存 '{image_hash}' 失败: {e}")
+        if caption:
+            ImageCaptionUtils._counters["disk_hits"] += 1
+            ImageCaptionUtils._remember(image_hash, caption); return caption
+        ImageCaptionUtils._prefetch_history_caption(image_hash)
+        return None
 
-        Args:
-            image_url_or_path: 图像的URL或本地文件路径。
+    @staticmethod
+    async def generate_image_caption(image_url_or_path: str) -> Optional[str]:
+        """
+        为给定的图像 (base64:// URI、URL 或本地文件路径) 生成文本描述。
 
         Returns:
-            生成的图像描述字符串，如果失败则返回 None。
+            生成的图像描述字符串；未启用、图片无法读取或生成失败时返回 None。
         """
-        if not _is_initialized:
-            logger.warning("ImageCaptionUtils: 未初始化，无法生成图像描述。返回默认占位符。")
-            # 可以在这里尝试调用一个临时的 init，或者要求必须先 init
-            # 为了简单，我们直接返回占位符
-            return "图片描述未启用"
-
-        # plugin_config = _config_ref # 可以通过 _config_ref 访问插件配置
-        # enable_captioning = plugin_config.get("image_captioning_enable", False) if plugin_config else False
-        # if not enable_captioning:
-        #     return None # 如果插件总开关未启用图片描述，直接返回None
-
-        logger.debug(f"ImageCaptionUtils: 请求为图像 '{image_url_or_path[:100]}...' 生成描述 (模拟)。")
-
-        # --- 模拟图像描述生成 ---
-        # 在实际应用中，这里会调用图像识别API或本地模型
-        # 例如：
-        # if image_url_or_path.startswith("http"):
-        #     # response = await some_api_client.describe_url(image_url_or_path)
-        #     # return response.caption
-        # else:
-        #     # response = await some_local_model.describe_file(image_url_or_path)
-        #     # return response.caption
-        
-        # 模拟延迟
-        await asyncio.sleep(0.1) 
-
-        # 模拟一些基于文件名的简单描述
-        if "cat" in image_url_or_path.lower():
-            return "一只可爱的猫"
-        elif "dog" in image_url_or_path.lower():
-            return "一只活泼的狗"
-        elif "landscape" in image_url_or_path.lower():
-            return "美丽的风景"
-        
-        # 默认返回一个通用占位符或简单的描述
-        # return f"图像（路径/URL的最后部分：{image_url_or_path.split('/')[-1][:30]}）"
-        return "一张图片" # 更通用的占位符
+        if not ImageCaptionUtils.enabled or not image_url_or_path: return None
+        try: loaded = await IOExecutor.run(ImageCaptionUtils._load_image_for_caption, image_url_or_path)
+        except Exception as e:
+            logger.warning(f"ImageCaptionUtils: 读取图像 '{image_url_or_path[:100]}' 失败: {e}"); return None
+        if not loaded:
+            logger.warning(f"ImageCaptionUtils: 无法读取图像 '{image_url_or_path[:100]}'。"); return None
+        content_hash, image_uri = loaded
+        return await ImageCaptionUtils.caption_by_hash(content_hash, image_uri)
 
     @staticmethod
     async def process_images_for_llm_prompt(message_components: List[Any], # Type Any to avoid import BaseMessageComponent if not already there
-                                            max_image_count: int, 
+                                            max_image_count: int,
                                             enable_caption: bool) -> List[Any]: # Assuming it returns List[Plain] or similar text components
         """
         处理消息组件中的图像，为LLM的prompt生成文本描述。
-        这个方法是从旧的 llm_utils.py 借鉴过来的，但我们新插件可能不直接用这个方式处理。
-        LLMModule 和 MessageUtils.outline_message_list 会处理图像描述。
-        保留此方法结构以备将来参考或如果 MessageUtils 需要调用它。
+        多张图片并发描述，返回顺序与图片在消息中的顺序一致。
         """
         if not enable_caption or max_image_count <= 0:
             return []
@@ -106,10 +294,9 @@ class ImageCaptionUtils:
         try: from astrbot.core.message.components import Plain
         except ImportError: Plain = str # Fallback to returning strings
 
-        descriptions = []
-        processed_count = 0
+        image_sources: List[str] = []
         for component in message_components:
-            if processed_count >= max_image_count:
+            if len(image_sources) >= max_image_count:
                 break
             # 假设 component 有 type 和 url/file 属性
             if hasattr(component, 'type') and component.type == "image":
@@ -117,16 +304,16 @@ class ImageCaptionUtils:
                 if hasattr(component, 'url') and component.url:
                     image_source = component.url
                 elif hasattr(component, 'file') and component.file:
-                    image_source = component.file # 本地路径
-                
-                if image_source:
-                    caption = await ImageCaptionUtils.generate_image_caption(image_source)
-                    if caption:
-                        if Plain is str: descriptions.append(f"图片描述：{caption}")
-                        else: descriptions.append(Plain(text=f"图片描述：{caption}"))
-                    else:
-                        if Plain is str: descriptions.append("图片（无法获取描述）")
-                        else: descriptions.append(Plain(text="图片（无法获取描述）"))
-                    processed_count += 1
+                    image_source = component.file # 本地路径或 base64://
+                if image_source: image_sources.append(image_source)
+
+        captions = await asyncio.gather(*(ImageCaptionUtils.generate_image_caption(s) for s in image_sources))
+        descriptions = []
+        for caption in captions:
+            text = f"图片描述：{caption}" if caption else "图片（无法获取描述）"
+            descriptions.append(text if Plain is str else Plain(text=text))
         return descriptions
 
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        return {**ImageCaptionUtils._counters, "memory_entries": len(ImageCaptionUtils._memory_cache), "in_flight": len(ImageCaptionUtils._in_flight)}
@@ -0,0 +1,160 @@
+# astrbot_plugin_relaychat/utils/image_normalizer.py
+import io
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from .image_blob_store import ImageBlobStore, BASE64_URI_PREFIX
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image as PILImage, ImageOps # 可选依赖：未安装时图片原样使用
+    _PIL_AVAILABLE = True
+except ImportError:
+    PILImage = None # type: ignore
+    ImageOps = None # type: ignore
+    _PIL_AVAILABLE = False
+
+
+class ImageNormalizer:
+    """
+    图片在写入历史和发送给 LLM 之前统一经过这里：解码一次，长边缩小到 max_edge，再重新编码为较紧凑的格式。
+    结果按原图内容哈希缓存；同一张图片的并发请求 (例如同一事件的历史保存和请求组装) 共用一次处理。
+    解码和编码在独立的线程池中执行，不占用事件循环，也不挤占磁盘 I/O 线程。
+    """
+    MAX_EDGE_DEFAULT = 1024 # 0 表示不处理
+    FORMAT_DEFAULT = "jpeg"
+    SUPPORTED_FORMATS = {"jpeg": "JPEG", "webp": "WEBP", "png": "PNG"}
+    QUALITY_DEFAULT = 85
+    MAX_WORKERS_DEFAULT = 2
+    MEMO_MAX_BYTES = 32 * 1024 * 1024
+
+    max_edge: int = MAX_EDGE_DEFAULT
+    output_format: str = FORMAT_DEFAULT
+    quality: int = QUALITY_DEFAULT
+    _max_workers: int = MAX_WORKERS_DEFAULT
+    _executor: Optional[ThreadPoolExecutor] = None
+    _memo: "OrderedDict[str, str]" = OrderedDict() # 原图内容哈希 -> 处理后的 base64:// URI
+    _memo_bytes: int = 0
+    _memo_lock = threading.Lock() # 缓存在工作线程中读写
+    _in_flight: Dict[str, "asyncio.Future[str]"] = {} # 原始 URI -> 进行中的处理
+    _counters: Dict[str, int] = {"normalized": 0, "memo_hits": 0, "shared_in_flight": 0, "unchanged": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+    @staticmethod
+    def init(plugin_config: Any):
+        ImageNormalizer.max_edge = max(0, int(plugin_config.get("image_normalize_max_edge", ImageNormalizer.MAX_EDGE_DEFAULT)))
+        output_format = str(plugin_config.get("image_normalize_format", ImageNormalizer.FORMAT_DEFAULT) or "").strip().lower()
+        if output_format not in ImageNormalizer.SUPPORTED_FORMATS:
+            logger.warning(f"RelayChat ImageNormalizer: 不支持的图片格式 '{output_format}'，使用 '{ImageNormalizer.FORMAT_DEFAULT}'。")
+            output_format = ImageNormalizer.FORMAT_DEFAULT
+        ImageNormalizer.output_format = output_format
+        ImageNormalizer.quality = min(100, max(1, int(plugin_config.get("image_normalize_quality", ImageNormalizer.QUALITY_DEFAULT))))
+        ImageNormalizer._max_workers = max(1, int(plugin_config.get("image_normalize_max_workers", ImageNormalizer.MAX_WORKERS_DEFAULT)))
+        ImageNormalizer.shutdown()
+        with ImageNormalizer._memo_lock:
+            ImageNormalizer._memo.clear(); ImageNormalizer._memo_bytes = 0
+        if ImageNormalizer.max_edge > 0 and not _PIL_AVAILABLE:
+            logger.warning("RelayChat ImageNormalizer: 未安装 Pillow，图片将不做缩放和压缩。")
+        logger.debug(f"RelayChat ImageNormalizer: max_edge={ImageNormalizer.max_edge}, format={ImageNormalizer.output_format}, "
+                     f"quality={ImageNormalizer.quality}, workers={ImageNormalizer._max_workers}, pillow={_PIL_AVAILABLE}")
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return ImageNormalizer.max_edge > 0 and _PIL_AVAILABLE
+
+    @staticmethod
+    def _get_executor() -> ThreadPoolExecutor:
+        if ImageNormalizer._executor is None:
+            ImageNormalizer._executor = ThreadPoolExecutor(max_workers=ImageNormalizer._max_workers, thread_name_prefix="relaychat-img")
+        return ImageNormalizer._executor
+
+    @staticmethod
+    def _remember(content_hash: str, normalized_uri: str):
+        with ImageNormalizer._memo_lock:
+            previous = ImageNormalizer._memo.pop(content_hash, None)
+            if previous is not None: ImageNormalizer._memo_bytes -= len(previous)
+            ImageNormalizer._memo[content_hash] = normalized_uri
+            ImageNormalizer._memo_bytes += len(normalized_uri)
+            while ImageNormalizer._memo_bytes > ImageNormalizer.MEMO_MAX_BYTES and len(ImageNormalizer._memo) > 1:
+                _, evicted = ImageNormalizer._memo.popitem(last=False)
+                ImageNormalizer._memo_bytes -= len(evicted)
+
+    @staticmethod
+    def _encode(data: bytes) -> Optional[bytes]:
+        # 返回处理后的图片；动图、无法识别的图片或处理后反而更大的图片返回 None，保持原样
+        with PILImage.open(io.BytesIO(data)) as img: # type: ignore
+            if getattr(img, "is_animated", False): return None # 动图表情不重新编码，避免丢帧
+            img = ImageOps.exif_transpose(img) # type: ignore
+            resized = max(img.size) > ImageNormalizer.max_edge
+            if resized: img.thumbnail((ImageNormalizer.max_edge, ImageNormalizer.max_edge), PILImage.LANCZOS) # type: ignore
+            pil_format = ImageNormalizer.SUPPORTED_FORMATS[ImageNormalizer.output_format]
+            if pil_format == "JPEG" and img.mode != "RGB":
+                if img.mode in ("RGBA", "LA", "P"):
+                    img = img.convert("RGBA")
+                    background = PILImage.new("RGB", img.size, (255, 255, 255)) # type: ignore
+                    background.paste(img, mask=img.getchannel("A")); img = background
+                else: img = img.convert("RGB")
+            out = io.BytesIO()
+            save_kwargs: Dict[str, Any] = {"optimize": True}
+            if pil_format in ("JPEG", "WEBP"): save_kwargs["quality"] = ImageNormalizer.quality
+            img.save(out, format=pil_format, **save_kwargs)
+        encoded = out.getvalue()
+        if not resized and len(encoded) >= len(data): return None
+        return encoded
+
+    @staticmethod
+    def _normalize_uri_sync(uri: str) -> str:
+        data = ImageBlobStore.decode_base64_uri(uri)
+        if data is None: return uri
+        content_hash = ImageBlobStore.hash_bytes(data)
+        with ImageNormalizer._memo_lock:
+            cached = ImageNormalizer._memo.get(content_hash)
+            if cached is not None:
+                ImageNormalizer._memo.move_to_end(content_hash)
+                ImageNormalizer._counters["memo_hits"] += 1
+                return cached
+        try: encoded = ImageNormalizer._encode(data)
+        except Exception as e:
+            logger.warning(f"RelayChat ImageNormalizer: 处理图片 {content_hash[:12]} 失败，保持原图: {e}")
+            with ImageNormalizer._memo_lock: ImageNormalizer._counters["failed"] += 1
+            encoded = None
+        normalized_uri = ImageBlobStore.encode_base64_uri(encoded) if encoded else uri
+        with ImageNormalizer._memo_lock:
+            ImageNormalizer._counters["normalized" if encoded else "unchanged"] += 1
+            ImageNormalizer._counters["bytes_in"] += len(data)
+            ImageNormalizer._counters["bytes_out"] += len(encoded) if encoded else len(data)
+        ImageNormalizer._remember(content_hash, normalized_uri)
+        return normalized_uri
+
+    @staticmethod
+    async def normalize_base64_uri(uri: str) -> str:
+        """返回缩放、压缩后的 base64:// URI；未启用、非 base64 图片或处理失败时原样返回。"""
+        if not ImageNormalizer.is_enabled() or not uri or not uri.startswith(BASE64_URI_PREFIX): return uri
+        future = ImageNormalizer._in_flight.get(uri)
+        if future is not None:
+            ImageNormalizer._counters["shared_in_flight"] += 1
+            return await asyncio.shield(future)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(ImageNormalizer._get_executor(), ImageNormalizer._normalize_uri_sync, uri)
+        ImageNormalizer._in_flight[uri] = future
+        future.add_done_callback(lambda f: ImageNormalizer._in_flight.pop(uri, None) if ImageNormalizer._in_flight.get(uri) is f else None)
+        try: return await asyncio.shield(future)
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            logger.warning(f"RelayChat ImageNormalizer: 图片处理出错，保持原图: {e}"); return uri
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        with ImageNormalizer._memo_lock:
+            return {**ImageNormalizer._counters, "memo_entries": len(ImageNormalizer._memo), "memo_bytes": ImageNormalizer._memo_bytes,
+                    "in_flight": len(ImageNormalizer._in_flight)}
+
+    @staticmethod
+    def shutdown():
+        if ImageNormalizer._executor is not None:
+            ImageNormalizer._executor.shutdown(wait=False)
+            ImageNormalizer._executor = None
@@ -0,0 +1,118 @@
+# astrbot_plugin_relaychat/utils/io_executor.py
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class IOExecutor:
+    """
+    有界线程池：阻塞的文件/数据库 I/O 统一在这里执行，避免卡住 AstrBot 的事件循环。
+    max_pending 限制同时排队的任务数，磁盘变慢时调用方会在 await 处排队而不是无限堆积。
+    """
+    MAX_WORKERS_DEFAULT = 4
+    MAX_PENDING_DEFAULT = 256
+    SLOW_WAIT_WARN_SECONDS = 1.0
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _max_workers: int = MAX_WORKERS_DEFAULT
+    _max_pending: int = MAX_PENDING_DEFAULT
+    _slots: Optional[asyncio.Semaphore] = None
+    _slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    _stats_lock = threading.Lock() # 计数在工作线程中更新
+    _in_flight = 0 # 已提交、尚未完成 (含排队和执行中)
+    _running = 0
+    _completed = 0
+    _failed = 0
+    _total_wait_seconds = 0.0
+    _total_run_seconds = 0.0
+    _max_wait_seconds = 0.0
+    _max_run_seconds = 0.0
+
+    @staticmethod
+    def configure(max_workers: int, max_pending: int):
+        IOExecutor._max_workers = max(1, int(max_workers))
+        IOExecutor._max_pending = max(1, int(max_pending))
+        if IOExecutor._executor is not None: # 重新配置时让旧线程池处理完已提交任务后退出
+            IOExecutor._executor.shutdown(wait=False)
+            IOExecutor._executor = None
+        IOExecutor._slots = None
+        logger.debug(f"RelayChat IOExecutor: 线程数={IOExecutor._max_workers}, 最大排队={IOExecutor._max_pending}")
+
+    @staticmethod
+    def _get_executor() -> ThreadPoolExecutor:
+        if IOExecutor._executor is None:
+            IOExecutor._executor = ThreadPoolExecutor(max_workers=IOExecutor._max_workers, thread_name_prefix="relaychat-io")
+        return IOExecutor._executor
+
+    @staticmethod
+    def _get_slots() -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if IOExecutor._slots is None or IOExecutor._slots_loop is not loop:
+            IOExecutor._slots = asyncio.Semaphore(IOExecutor._max_pending)
+            IOExecutor._slots_loop = loop
+        return IOExecutor._slots
+
+    @staticmethod
+    async def run(func: Callable[..., T], *args: Any) -> T:
+        submitted_at = time.perf_counter()
+        with IOExecutor._stats_lock: IOExecutor._in_flight += 1
+        try:
+            async with IOExecutor._get_slots():
+                return await asyncio.get_running_loop().run_in_executor(
+                    IOExecutor._get_executor(), IOExecutor._timed_call, submitted_at, func, args)
+        finally:
+            with IOExecutor._stats_lock: IOExecutor._in_flight -= 1
+
+    @staticmethod
+    def _timed_call(submitted_at: float, func: Callable[..., T], args: tuple) -> T:
+        started_at = time.perf_counter()
+        wait_seconds = started_at - submitted_at
+        with IOExecutor._stats_lock: IOExecutor._running += 1
+        failed = False
+        try:
+            return func(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            run_seconds = time.perf_counter() - started_at
+            with IOExecutor._stats_lock:
+                IOExecutor._running -= 1
+                if failed: IOExecutor._failed += 1
+                else: IOExecutor._completed += 1
+                IOExecutor._total_wait_seconds += wait_seconds; IOExecutor._total_run_seconds += run_seconds
+                IOExecutor._max_wait_seconds = max(IOExecutor._max_wait_seconds, wait_seconds)
+                IOExecutor._max_run_seconds = max(IOExecutor._max_run_seconds, run_seconds)
+            if wait_seconds > IOExecutor.SLOW_WAIT_WARN_SECONDS:
+                logger.warning(f"RelayChat IOExecutor: I/O 任务 {getattr(func, '__qualname__', func)} 排队 {wait_seconds:.2f}s 才开始执行，磁盘可能过慢。")
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        with IOExecutor._stats_lock:
+            return IOExecutor._stats_unlocked()
+
+    @staticmethod
+    def _stats_unlocked() -> Dict[str, Any]:
+        finished = IOExecutor._completed + IOExecutor._failed
+        return {
+            "queue_depth": max(0, IOExecutor._in_flight - IOExecutor._running), "running": IOExecutor._running,
+            "completed": IOExecutor._completed, "failed": IOExecutor._failed,
+            "avg_wait_ms": round(IOExecutor._total_wait_seconds / finished * 1000, 3) if finished else 0.0,
+            "avg_run_ms": round(IOExecutor._total_run_seconds / finished * 1000, 3) if finished else 0.0,
+            "max_wait_ms": round(IOExecutor._max_wait_seconds * 1000, 3),
+            "max_run_ms": round(IOExecutor._max_run_seconds * 1000, 3),
+        }
+
+    @staticmethod
+    def shutdown():
+        if IOExecutor._executor is not None:
+            IOExecutor._executor.shutdown(wait=True)
+            IOExecutor._executor = None
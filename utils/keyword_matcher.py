@@ -0,0 +1,94 @@
+# astrbot_plugin_relaychat/utils/keyword_matcher.py
+
+from collections import OrderedDict, deque
+from typing import Any, Dict, FrozenSet, Iterable, List
+
+
+def normalize_keywords(keywords: Any) -> FrozenSet[str]:
+    # 与原先 `keyword.lower() in message` 的语义一致：忽略空白关键词，匹配时不去除首尾空格
+    if not isinstance(keywords, (list, tuple, set, frozenset)): return frozenset()
+    return frozenset(k.lower() for k in keywords if isinstance(k, str) and k.strip())
+
+
+class KeywordMatcher:
+    """Aho-Corasick 多模式匹配器：一次扫描文本即可找出其中出现的全部关键词。"""
+
+    def __init__(self, keywords: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[FrozenSet[str]] = [frozenset()]
+        for keyword in set(keywords):
+            if keyword: self._add(keyword)
+        self._build_fail_links()
+
+    def _add(self, keyword: str):
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({}); self._fail.append(0); self._output.append(frozenset())
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._output[state] = self._output[state] | {keyword}
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]: fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(ch, 0)
+                self._fail[next_state] = candidate if candidate != next_state else 0
+                self._output[next_state] = self._output[next_state] | self._output[self._fail[next_state]]
+
+    def find_all(self, text: str) -> FrozenSet[str]:
+        if len(self._goto) == 1 or not text: return frozenset()
+        goto, fail, output = self._goto, self._fail, self._output
+        found: set = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]: state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]: found.update(output[state])
+        return frozenset(found)
+
+
+class BotKeywordIndex:
+    """
+    把所有托管Bot的关键词和黑名单编译进同一个自动机。
+    同一条消息会被每个Bot实例各判断一次，扫描结果按消息文本做小容量缓存，只扫描一次。
+    """
+    RECENT_RESULTS_MAX = 64
+
+    def __init__(self, bot_profiles: Iterable[Any]):
+        # bot_profiles 为 BotProfile，关键词在解析时已转为小写
+        self.keywords_by_bot: Dict[str, FrozenSet[str]] = {}
+        self.blacklist_by_bot: Dict[str, FrozenSet[str]] = {}
+        for profile in bot_profiles:
+            self.keywords_by_bot[profile.platform_instance_id] = frozenset(profile.keywords)
+            self.blacklist_by_bot[profile.platform_instance_id] = frozenset(profile.blacklist_keywords)
+        all_patterns = set().union(*self.keywords_by_bot.values(), *self.blacklist_by_bot.values())
+        self.matcher = KeywordMatcher(all_patterns)
+        self.pattern_count = len(all_patterns)
+        self._recent_results: "OrderedDict[str, FrozenSet[str]]" = OrderedDict()
+
+    def match(self, message_lower: str) -> FrozenSet[str]:
+        cached = self._recent_results.get(message_lower)
+        if cached is not None:
+            self._recent_results.move_to_end(message_lower)
+            return cached
+        found = self.matcher.find_all(message_lower)
+        self._recent_results[message_lower] = found
+        if len(self._recent_results) > self.RECENT_RESULTS_MAX: self._recent_results.popitem(last=False)
+        return found
+
+    def matches_keyword(self, platform_id: str, message_lower: str) -> bool:
+        keywords = self.keywords_by_bot.get(platform_id)
+        return bool(keywords) and not keywords.isdisjoint(self.match(message_lower))
+
+    def matches_blacklist(self, platform_id: str, message_lower: str) -> bool:
+        blacklist = self.blacklist_by_bot.get(platform_id)
+        return bool(blacklist) and not blacklist.isdisjoint(self.match(message_lower))
@@ -1,7 +1,7 @@
 # astrbot_plugin_relaychat/utils/llm_module.py
+import time
 import asyncio
 import uuid
-import threading
 from typing import Dict, Any, Optional, AsyncGenerator, List, Union
 
 from astrbot.api.all import Context, AstrBotConfig, AstrMessageEvent, logger
@@ -9,21 +9,62 @@ from astrbot.core.provider.entities import ProviderRequest, LLMResponse
 from astrbot.api.message_components import Image, Plain 
 from .history_storage import HistoryStorage
 from .message_utils import MessageUtils
+from .persona_utils import PersonaUtils
+from .token_estimator import create_token_estimator
+from .history_summarizer import HistorySummarizer
+from .history_retrieval import HistoryRetrieval
+from .image_caption import ImageCaptionUtils
+from .image_normalizer import ImageNormalizer
+from .ttl_store import TTLStore
+from .bot_profile import BotProfile
+from .relay_stats import RelayStats
 
 class LLMModule:
-    _llm_in_progress_status: Dict[tuple, bool] = {} 
-    _llm_status_async_lock = asyncio.Lock()
-    _llm_status_sync_read_lock = threading.Lock()
-
     LLM_LOCK_RELEASE_DELAY_SECONDS_DEFAULT = 1.0
     LLM_PROMPT_MAX_HISTORY_DEFAULT = 20
+    LLM_HISTORY_TOKEN_BUDGET_DEFAULT = 0 # 0 表示只按条数截取历史
+    LLM_CONTEXT_WINDOW_STEP_DEFAULT = 10
+    LLM_RETRIEVAL_BUDGET_SHARE = 0.5 # 开启Token预算时，检索到的旧消息最多占用历史预算的比例
+    LLM_LOCK_POLL_INTERVAL_SECONDS = 0.1 # 预生成等待LLM锁释放时的检查间隔
+    LLM_LOCK_MAX_HOLD_SECONDS_DEFAULT = 300.0 # 安全上限：即使释放逻辑没有执行，锁也会在此时间后自动失效
+    STATE_STORE_MAX_ENTRIES_DEFAULT = 10000
+
+    _llm_in_progress_status = TTLStore("llm_locks", STATE_STORE_MAX_ENTRIES_DEFAULT, LLM_LOCK_MAX_HOLD_SECONDS_DEFAULT)
+    _llm_status_async_lock = asyncio.Lock()
 
     def __init__(self, context: Context, plugin_config: AstrBotConfig):
         self.context = context
         self.plugin_config = plugin_config 
         self.release_delay = float(self.plugin_config.get("llm_lock_release_delay_seconds", self.LLM_LOCK_RELEASE_DELAY_SECONDS_DEFAULT))
         self.max_history_count_default = int(self.plugin_config.get("llm_max_history_default", self.LLM_PROMPT_MAX_HISTORY_DEFAULT))
-        logger.debug(f"LLMModule initialized. LockReleaseDelay={self.release_delay}s, MaxHistoryDefault={self.max_history_count_default}")
+        self.history_token_budget_default = int(self.plugin_config.get("llm_history_token_budget", self.LLM_HISTORY_TOKEN_BUDGET_DEFAULT))
+        self.persona_token_budgets = self._parse_persona_token_budgets(self.plugin_config.get("llm_persona_token_budgets", []))
+        self.token_estimator = create_token_estimator(self.plugin_config.get("llm_token_estimator", "heuristic"))
+        self.structured_contexts = bool(self.plugin_config.get("llm_structured_contexts", False))
+        self.context_window_step = int(self.plugin_config.get("llm_context_window_step", self.LLM_CONTEXT_WINDOW_STEP_DEFAULT))
+        self.history_image_mode = ImageCaptionUtils.history_image_mode # 与描述预取监听器一致，只在启动时读取
+        LLMModule._llm_in_progress_status.configure(
+            max_entries=int(self.plugin_config.get("state_store_max_entries", self.STATE_STORE_MAX_ENTRIES_DEFAULT)),
+            default_ttl=max(float(self.plugin_config.get("llm_lock_max_hold_seconds", self.LLM_LOCK_MAX_HOLD_SECONDS_DEFAULT)), self.release_delay + 1.0),
+        )
+        logger.debug(f"LLMModule initialized. LockReleaseDelay={self.release_delay}s, MaxHistoryDefault={self.max_history_count_default}, "
+                     f"HistoryTokenBudget={self.history_token_budget_default}, PersonaTokenBudgets={self.persona_token_budgets}, TokenEstimator={self.token_estimator.name}, HistoryImageMode={self.history_image_mode}")
+
+    @staticmethod
+    def _parse_persona_token_budgets(budget_strs: Any) -> Dict[str, int]:
+        # 格式与 managed_bots 一致，用 "::" 分隔: "PersonaName::TokenBudget"
+        budgets: Dict[str, int] = {}
+        if not isinstance(budget_strs, list): return budgets
+        for i, budget_str in enumerate(budget_strs):
+            if not isinstance(budget_str, str) or "::" not in budget_str:
+                logger.warning(f"LLMModule: llm_persona_token_budgets 条目 #{i} 格式不正确: '{budget_str}'"); continue
+            persona_name, _, budget_val = budget_str.rpartition("::")
+            try: budgets[persona_name.strip()] = int(budget_val.strip())
+            except ValueError: logger.warning(f"LLMModule: llm_persona_token_budgets 条目 #{i} 的预算不是整数: '{budget_str}'")
+        return budgets
+
+    def get_history_token_budget(self, persona_name: str) -> int:
+        return self.persona_token_budgets.get(persona_name, self.history_token_budget_default)
 
     @staticmethod
     def get_llm_lock_key(event: AstrMessageEvent) -> tuple:
@@ -40,42 +81,29 @@ class LLMModule:
     
     @staticmethod 
     def is_llm_in_progress_sync(lock_key: tuple) -> bool:
-        with LLMModule._llm_status_sync_read_lock:
-            return LLMModule._llm_in_progress_status.get(lock_key, False)
+        return LLMModule._llm_in_progress_status.get(lock_key, False)
 
     @staticmethod
     async def set_llm_in_progress_async(lock_key: tuple, status: bool):
-        async with LLMModule._llm_status_async_lock:
-            if status: LLMModule._llm_in_progress_status[lock_key] = True; logger.debug(f"LLMModule: Async: LLM lock ACQUIRED for key {lock_key}")
-            elif lock_key in LLMModule._llm_in_progress_status: del LLMModule._llm_in_progress_status[lock_key]; logger.debug(f"LLMModule: Async: LLM lock RELEASED for key {lock_key}")
+        async with RelayStats.contended(LLMModule._llm_status_async_lock, "llm_status"):
+            if status: LLMModule._llm_in_progress_status.set(lock_key, True); logger.debug(f"LLMModule: Async: LLM lock ACQUIRED for key {lock_key}")
+            elif LLMModule._llm_in_progress_status.pop(lock_key) is not None: logger.debug(f"LLMModule: Async: LLM lock RELEASED for key {lock_key}")
+
+    @staticmethod
+    def get_state_stats() -> Dict[str, Any]:
+        return LLMModule._llm_in_progress_status.stats()
         
-    async def prepare_and_yield_request(self, event: AstrMessageEvent) -> AsyncGenerator[Union[ProviderRequest, LLMResponse], None]:
+    async def build_provider_request(self, event: AstrMessageEvent, bot_specific_config: BotProfile) -> Union[ProviderRequest, LLMResponse]:
+        # 只负责组装请求 (读历史、格式化、拼接提示词)，不涉及LLM锁；出错时返回 role="err" 的 LLMResponse
         lock_key = LLMModule.get_llm_lock_key(event)
-        if LLMModule.is_llm_in_progress_sync(lock_key): 
-            logger.warning(f"LLMModule ({lock_key}): LLM lock held. Aborting."); yield LLMResponse(role="err", completion_text="LLM_LOCKED_ON_ENTRY"); return
-        await LLMModule.set_llm_in_progress_async(lock_key, True) 
-        
-        current_reply_config_for_hook: Optional[Dict[str, Any]] = None; persona_name_to_apply: Optional[str] = None
+        persona_name_to_apply = bot_specific_config.persona_name
+        if not persona_name_to_apply: logger.error(f"LLMModule ({lock_key}): Missing 'persona_name'."); return LLMResponse(role="err", completion_text="MISSING_PERSONA_NAME")
+        started_at = time.perf_counter()
         try:
-            current_reply_config_for_hook = event.get_extra("relay_current_reply_config_for_hook") # type: ignore
-            if not (current_reply_config_for_hook and isinstance(current_reply_config_for_hook, dict)): logger.error(f"LLMModule ({lock_key}): Missing/invalid 'relay_current_reply_config_for_hook'."); yield LLMResponse(role="err", completion_text="MISSING_HOOK_DATA"); return
-            bot_specific_config = current_reply_config_for_hook.get("bot_specific_config")
-            if not (bot_specific_config and isinstance(bot_specific_config, dict)): logger.error(f"LLMModule ({lock_key}): Missing/invalid 'bot_specific_config'."); yield LLMResponse(role="err", completion_text="MISSING_BOT_SPECIFIC_CONFIG"); return
-            persona_name_to_apply = bot_specific_config.get("persona_name")
-            if not persona_name_to_apply: logger.error(f"LLMModule ({lock_key}): Missing 'persona_name'."); yield LLMResponse(role="err", completion_text="MISSING_PERSONA_NAME"); return
-            
             logger.debug(f"LLMModule ({lock_key}): Preparing LLM request for P:'{persona_name_to_apply}'.")
-            prompt_parts = []; current_event_image_data: List[str] = []; history_event_image_data: List[str] = []; text_parts_for_current_message_prompt: List[str] = []
-            max_hist = int(bot_specific_config.get("llm_max_history", self.max_history_count_default))
+            prompt_parts = []; history_contexts: List[Dict[str, str]] = []; current_event_image_data: List[str] = []; history_event_image_data: List[str] = []; text_parts_for_current_message_prompt: List[str] = []
+            max_hist = bot_specific_config.llm_max_history if bot_specific_config.llm_max_history is not None else self.max_history_count_default
             
-            history_dicts = await HistoryStorage.get_history_as_dicts(event) # ★★★ 使用新的方法 ★★★
-            deduped_history_dicts = MessageUtils.dedup_history(history_dicts) if history_dicts else [] # 去重
-
-            formatted_history_text, history_event_image_data = await MessageUtils.format_history_for_llm(deduped_history_dicts, max_messages=max_hist)
-            
-            if formatted_history_text: prompt_parts.append(f"这是之前的聊天记录：\n{formatted_history_text}")
-            if history_event_image_data: logger.debug(f"LLMModule: 从历史记录中获取了 {len(history_event_image_data)} 张图片。")
-
             current_message_components = event.get_messages()
             if current_message_components:
                 for component in current_message_components:
@@ -84,10 +112,62 @@ class LLMModule:
                         elif component.url: current_event_image_data.append(component.url); text_parts_for_current_message_prompt.append("[图片URL]"); logger.debug(f"LLMModule: Added current image URL: {component.url[:100]}...")
                     elif hasattr(component, 'text') and isinstance(component.text, str): text_parts_for_current_message_prompt.append(component.text)
             
+            if current_event_image_data: # 与历史保存共用同一份处理结果 (按内容哈希缓存，并发时只处理一次)
+                current_event_image_data = list(await asyncio.gather(*(ImageNormalizer.normalize_base64_uri(u) for u in current_event_image_data)))
             current_msg_text_for_prompt = " ".join(text_parts_for_current_message_prompt).strip()
             if not current_msg_text_for_prompt and current_event_image_data : current_msg_text_for_prompt = "[用户发送了一张或多张图片]"
             elif not current_msg_text_for_prompt: current_msg_text_for_prompt = event.get_message_str()
-            prompt_parts.append(f"这是当前收到的消息内容 (来自发送者ID: {event.get_sender_id()}):\n{current_msg_text_for_prompt}")
+            current_message_prompt_part = f"这是当前收到的消息内容 (来自发送者ID: {event.get_sender_id()}):\n{current_msg_text_for_prompt}"
+
+            history_session_key = HistoryStorage.get_chat_key(event)
+            history_summary = await HistorySummarizer.get_summary(history_session_key) # 未启用摘要时为 None
+            history_token_budget: Optional[int] = None
+            token_budget_total = self.get_history_token_budget(persona_name_to_apply)
+            if token_budget_total > 0:
+                # 为系统提示词、当前消息和当前图片预留空间，剩余预算从新到旧填充历史
+                resolved_persona = PersonaUtils.resolve_persona(self.context, persona_name_to_apply)
+                reserved_tokens = self.token_estimator.count(current_message_prompt_part) + len(current_event_image_data) * self.token_estimator.IMAGE_TOKENS_DEFAULT
+                if resolved_persona and resolved_persona.system_prompt: reserved_tokens += self.token_estimator.count(resolved_persona.system_prompt)
+                if history_summary: reserved_tokens += self.token_estimator.count(MessageUtils.format_history_summary(history_summary))
+                history_token_budget = max(0, token_budget_total - reserved_tokens)
+                logger.debug(f"LLMModule ({lock_key}): Token预算 {token_budget_total}，预留 {reserved_tokens}，历史可用 {history_token_budget}。")
+
+            history_dicts = await HistoryStorage.get_history_as_dicts(event) # ★★★ 使用新的方法 ★★★
+            retrieved_history_text = ""
+            if history_session_key and history_dicts and HistoryRetrieval.is_enabled():
+                # 从最近窗口之外检索与当前消息相关的旧消息；占用的Token从历史预算中扣除
+                retrieval_budget = int(history_token_budget * self.LLM_RETRIEVAL_BUDGET_SHARE) if history_token_budget is not None else None
+                recent_window_entries = MessageUtils.get_session_window_entries(
+                    history_session_key, history_dicts, max_messages=max_hist, token_budget=history_token_budget, estimator=self.token_estimator, image_mode=self.history_image_mode)
+                retrieved_entries = await HistoryRetrieval.retrieve(
+                    history_session_key, current_msg_text_for_prompt, recent_window_entries,
+                    token_budget=retrieval_budget, estimator=self.token_estimator)
+                if retrieved_entries:
+                    retrieved_history_text = "\n-\n".join(MessageUtils.format_history_entry(e) for e in retrieved_entries)
+                    if history_token_budget is not None: history_token_budget = max(0, history_token_budget - self.token_estimator.count(retrieved_history_text))
+                    logger.debug(f"LLMModule ({lock_key}): 检索到 {len(retrieved_entries)} 条相关的较早历史。")
+            if history_session_key and self.structured_contexts:
+                # 历史作为多轮上下文发送，窗口起点按步长对齐，prompt 只放当前消息，便于服务端前缀缓存复用
+                event_mid = getattr(event.message_obj, 'message_id', None) if event.message_obj else None
+                history_contexts, history_event_image_data = await MessageUtils.build_session_contexts_for_llm(
+                    history_session_key, history_dicts, persona_name_to_apply, max_messages=max_hist, token_budget=history_token_budget,
+                    estimator=self.token_estimator, align_step=self.context_window_step,
+                    exclude_message=(str(event_mid) if event_mid else None, event.get_sender_id(), event.get_message_str()), summary=history_summary,
+                    image_mode=self.history_image_mode)
+                formatted_history_text = ""
+            elif history_session_key:
+                # 去重和格式化结果按会话增量缓存，不必每次请求都重建整段历史
+                formatted_history_text, history_event_image_data = await MessageUtils.format_session_history_for_llm(
+                    history_session_key, history_dicts, max_messages=max_hist, token_budget=history_token_budget, estimator=self.token_estimator, summary=history_summary,
+                    image_mode=self.history_image_mode)
+            else:
+                deduped_history_dicts = MessageUtils.dedup_history(history_dicts) if history_dicts else [] # 去重
+                formatted_history_text, history_event_image_data = await MessageUtils.format_history_for_llm(deduped_history_dicts, max_messages=max_hist, summary=history_summary, image_mode=self.history_image_mode)
+            
+            if retrieved_history_text: prompt_parts.append(f"这是与当前消息可能相关的更早聊天记录：\n{retrieved_history_text}")
+            if formatted_history_text: prompt_parts.append(f"这是之前的聊天记录：\n{formatted_history_text}")
+            if history_event_image_data: logger.debug(f"LLMModule: 从历史记录中获取了 {len(history_event_image_data)} 张图片。")
+            prompt_parts.append(current_message_prompt_part)
             final_prompt_str = "\n\n".join(filter(None, prompt_parts)).strip()
 
             all_image_data_for_llm = history_event_image_data + current_event_image_data
@@ -96,19 +176,84 @@ class LLMModule:
                 all_image_data_for_llm = all_image_data_for_llm[-(MessageUtils.MAX_HISTORY_IMAGES_TO_LLM + 1):]
 
             if not final_prompt_str and not all_image_data_for_llm:
-                logger.warning(f"LLMModule ({lock_key}): 最终提示词和图片均为空 (P:'{persona_name_to_apply}'). 中止。"); yield LLMResponse(role="err", completion_text="EMPTY_INPUT"); return
+                logger.warning(f"LLMModule ({lock_key}): 最终提示词和图片均为空 (P:'{persona_name_to_apply}'). 中止。"); return LLMResponse(role="err", completion_text="EMPTY_INPUT")
             session_id_for_req = event.get_session_id() or str(uuid.uuid4())
             provider_request = ProviderRequest(
                 prompt=final_prompt_str, session_id=session_id_for_req,
                 image_urls=all_image_data_for_llm if all_image_data_for_llm else None, 
-                contexts=[], system_prompt="", conversation=getattr(event, 'conversation', None) )
-            logger.debug(f"LLMModule ({lock_key}): 发起ProviderRequest (P:'{persona_name_to_apply}'). Prompt长度:{len(final_prompt_str)} 内容(开头):'{final_prompt_str[:100]}...'. 图片数量: {len(all_image_data_for_llm)}")
-            yield provider_request
+                contexts=history_contexts, system_prompt="", conversation=getattr(event, 'conversation', None) )
+            logger.debug(f"LLMModule ({lock_key}): 发起ProviderRequest (P:'{persona_name_to_apply}'). Prompt长度:{len(final_prompt_str)} 上下文轮数:{len(history_contexts)} 内容(开头):'{final_prompt_str[:100]}...'. 图片数量: {len(all_image_data_for_llm)}")
+            return provider_request
+        except Exception as e:
+            logger.error(f"LLMModule ({lock_key}): 组装LLM请求出错 (P:'{persona_name_to_apply}'): {e}", exc_info=True)
+            return LLMResponse(role="err", completion_text=f"LLM_MODULE_PREPARE_ERROR: {type(e).__name__}", error_message=str(e))
+        finally: RelayStats.observe("prompt_build", time.perf_counter() - started_at, persona_name_to_apply)
+
+    async def generate_reply_directly(self, event: AstrMessageEvent, bot_specific_config: BotProfile, lock_wait_seconds: float = 0.0) -> Optional[LLMResponse]:
+        # 不经过AstrBot的LLM流水线，直接用当前Provider生成回复 (用于连锁回复的预生成)；失败或 lock_wait_seconds 内等不到LLM锁时返回 None，由调用方走常规流程
+        # 其他插件的 on_llm_request 钩子不会执行，回复作为普通文本发送，不经过LLM结果的后处理；人格的提示词和模型在这里直接应用
+        lock_key = LLMModule.get_llm_lock_key(event)
+        persona_name = bot_specific_config.persona_name
+        provider = self.context.get_using_provider()
+        if not provider: logger.warning(f"LLMModule ({lock_key}): 没有可用的LLM Provider，无法预生成回复。"); return None
+        if LLMModule.is_llm_in_progress_sync(lock_key):
+            # 上一个Bot的锁通常还在释放延迟中，等它释放后再开始；等到连锁延迟结束仍未释放就放弃预生成
+            RelayStats.incr("lock_contention", persona_name, "llm_speculative")
+            wait_deadline = time.monotonic() + lock_wait_seconds
+            while LLMModule.is_llm_in_progress_sync(lock_key):
+                if time.monotonic() >= wait_deadline:
+                    logger.debug(f"LLMModule ({lock_key}): LLM锁一直被占用，不预生成回复 (P:'{persona_name}')。"); return None
+                await asyncio.sleep(LLMModule.LLM_LOCK_POLL_INTERVAL_SECONDS)
+        await LLMModule.set_llm_in_progress_async(lock_key, True) # 与常规流程一样持锁调用LLM；发送前释放，由模拟事件的处理重新获取
+        try:
+            provider_request = await self.build_provider_request(event, bot_specific_config)
+            if isinstance(provider_request, LLMResponse): return None
+            resolved_persona = PersonaUtils.resolve_persona(self.context, persona_name) if persona_name else None
+            model_kwargs = {"model": resolved_persona.model} if resolved_persona and resolved_persona.model else {}
+            RelayStats.incr("llm_requests", persona_name, "speculative")
+            with RelayStats.timer("llm_speculative", persona_name): llm_response = await provider.text_chat(
+                prompt=provider_request.prompt, session_id=provider_request.session_id,
+                image_urls=provider_request.image_urls, contexts=provider_request.contexts,
+                system_prompt=(resolved_persona.system_prompt if resolved_persona else None) or provider_request.system_prompt, **model_kwargs )
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            logger.error(f"LLMModule ({lock_key}): 预生成回复出错 (P:'{persona_name}'): {e}", exc_info=True); return None
+        finally: await LLMModule.set_llm_in_progress_async(lock_key, False)
+        if not llm_response or llm_response.role == "err" or not (llm_response.completion_text or "").strip():
+            logger.warning(f"LLMModule ({lock_key}): 预生成回复为空或出错 (P:'{persona_name}')，改用常规流程。"); return None
+        logger.debug(f"LLMModule ({lock_key}): 预生成回复完成 (P:'{persona_name}'), 长度:{len(llm_response.completion_text)}.")
+        return llm_response
+
+    async def prepare_and_yield_request(self, event: AstrMessageEvent, prebuilt_reply: Optional[LLMResponse] = None,
+                                        prebuilt_request: Optional[Union[ProviderRequest, LLMResponse]] = None) -> AsyncGenerator[Any, None]:
+        lock_key = LLMModule.get_llm_lock_key(event)
+        if LLMModule.is_llm_in_progress_sync(lock_key): 
+            RelayStats.incr("lock_contention", reason="llm_on_entry")
+            logger.warning(f"LLMModule ({lock_key}): LLM lock held. Aborting."); yield LLMResponse(role="err", completion_text="LLM_LOCKED_ON_ENTRY"); return
+        await LLMModule.set_llm_in_progress_async(lock_key, True) 
+        
+        current_reply_config_for_hook: Optional[Dict[str, Any]] = None
+        try:
+            current_reply_config_for_hook = event.get_extra("relay_current_reply_config_for_hook") # type: ignore
+            if not (current_reply_config_for_hook and isinstance(current_reply_config_for_hook, dict)): logger.error(f"LLMModule ({lock_key}): Missing/invalid 'relay_current_reply_config_for_hook'."); yield LLMResponse(role="err", completion_text="MISSING_HOOK_DATA"); return
+            bot_specific_config = current_reply_config_for_hook.get("bot_specific_config")
+            if not isinstance(bot_specific_config, BotProfile): logger.error(f"LLMModule ({lock_key}): Missing/invalid 'bot_specific_config'."); yield LLMResponse(role="err", completion_text="MISSING_BOT_SPECIFIC_CONFIG"); return
+            if prebuilt_reply is not None:
+                # 回复已经预先生成，直接作为普通消息发送，不再调用LLM
+                logger.debug(f"LLMModule ({lock_key}): 使用预生成的回复 (P:'{bot_specific_config.persona_name}').")
+                RelayStats.incr("llm_replies_prebuilt", bot_specific_config.persona_name)
+                yield event.plain_result(prebuilt_reply.completion_text); return
+            # 请求可能已在回复延迟期间组装好，这里只负责持锁发出
+            request_to_yield = prebuilt_request if prebuilt_request is not None else await self.build_provider_request(event, bot_specific_config)
+            if isinstance(request_to_yield, ProviderRequest):
+                RelayStats.incr("llm_requests", bot_specific_config.persona_name, "prebuilt" if prebuilt_request is not None else "inline")
+                event.set_extra("relay_llm_requested_at", time.perf_counter()) # 回复发出后据此记录LLM往返耗时
+            else: RelayStats.incr("llm_request_errors", bot_specific_config.persona_name, str(request_to_yield.completion_text or "").split(":")[0])
+            yield request_to_yield
         except Exception as e:
-            p_name_err = persona_name_to_apply or (current_reply_config_for_hook.get("bot_specific_config", {}).get("persona_name") if current_reply_config_for_hook else "UnknownP")
+            p_name_err = current_reply_config_for_hook.get("persona_name") if isinstance(current_reply_config_for_hook, dict) else "UnknownP"
             logger.error(f"LLMModule ({lock_key}): prepare_and_yield_request 出错 (P:'{p_name_err}'): {e}", exc_info=True)
             yield LLMResponse(role="err", completion_text=f"LLM_MODULE_PREPARE_ERROR: {type(e).__name__}", error_message=str(e))
         finally:
             logger.debug(f"LLMModule ({lock_key}): {self.release_delay}秒后释放LLM锁。")
             await asyncio.sleep(self.release_delay); await LLMModule.set_llm_in_progress_async(lock_key, False)
-
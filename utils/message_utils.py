@@ -1,14 +1,138 @@
 # astrbot_plugin_relaychat/utils/message_utils.py
 import asyncio
 import logging
-from typing import List, Dict, Any, Optional, Tuple 
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Deque, Hashable, Optional, Tuple 
 from astrbot.api.all import AstrMessageEvent # 导入 AstrMessageEvent
 from astrbot.api.message_components import BaseMessageComponent, Plain, Image as AstrBotImageComponent
+from .image_blob_store import ImageBlobStore
+from .io_executor import IOExecutor
+from .token_estimator import TokenEstimator
+from .image_caption import ImageCaptionUtils
 
 logger = logging.getLogger(__name__)
 
+
+def history_entry_key(entry: Dict[str, Any]) -> tuple:
+    # 用于把缓存中的格式化结果与当前历史逐条对齐
+    return (entry.get("message_id"), entry.get("time"), entry.get("role"), entry.get("user_id"), entry.get("text"))
+
+
+class FormattedHistoryEntry:
+    __slots__ = ("seq", "key", "entry", "piece", "signature", "image_ref", "token_count", "token_estimator_name", "context_content")
+
+    def __init__(self, seq: int, entry: Dict[str, Any]):
+        self.seq = seq
+        self.key = history_entry_key(entry)
+        self.entry = entry
+        self.piece = MessageUtils.format_history_entry(entry)
+        self.signature = MessageUtils.history_signature(entry)
+        image_ref = entry.get("image_hash") or entry.get("image_base64_uri")
+        self.image_ref: Optional[str] = image_ref if isinstance(image_ref, str) and image_ref else None
+        self.token_count = 0
+        self.token_estimator_name: Optional[str] = None
+        self.context_content: Optional[str] = None # 结构化上下文中的单轮内容，首次使用时生成
+
+    def count_tokens(self, estimator: TokenEstimator) -> int:
+        # 每条历史只估算一次，换用其他估算器时重新计算
+        if self.token_estimator_name != estimator.name:
+            self.token_count = estimator.count(self.piece)
+            self.token_estimator_name = estimator.name
+        return self.token_count
+
+
+class _FormattedSession:
+    __slots__ = ("items", "latest_seq_by_signature", "next_seq")
+
+    def __init__(self):
+        self.items: Deque[FormattedHistoryEntry] = deque()
+        self.latest_seq_by_signature: Dict[str, int] = {} # 去重：同一签名只保留最新的一条
+        self.next_seq = 0
+
+    def push(self, entry: Dict[str, Any]):
+        item = FormattedHistoryEntry(self.next_seq, entry); self.next_seq += 1
+        self.items.append(item)
+        self.latest_seq_by_signature[item.signature] = item.seq
+
+    def pop_front(self):
+        item = self.items.popleft()
+        if self.latest_seq_by_signature.get(item.signature) == item.seq: del self.latest_seq_by_signature[item.signature]
+
+    def reset(self, history: List[Dict[str, Any]]):
+        self.items.clear(); self.latest_seq_by_signature.clear()
+        for entry in history: self.push(entry)
+
+
+class FormattedHistoryCache:
+    """
+    按会话缓存每条历史的格式化文本和去重签名，与 HistoryStorage 返回的历史逐条对齐。
+    新消息增量追加，被保留策略淘汰的旧消息从队首移除；对不上时整体重建。
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[Hashable, _FormattedSession]" = OrderedDict()
+        self.rebuilds = 0
+
+    def window(self, session_key: Hashable, history: List[Dict[str, Any]], max_messages: Optional[int],
+               token_budget: Optional[int] = None, estimator: Optional[TokenEstimator] = None,
+               align_step: int = 0, image_mode: str = "image") -> List[FormattedHistoryEntry]:
+        # 返回去重后最近 max_messages 条的缓存条目 (时间正序)；给定 token 预算时从新到旧填充，超出预算即停止
+        # align_step > 1 时窗口起点按序号对齐到 align_step 的整数倍，起点每隔 align_step 条消息才移动一次，便于服务端前缀缓存命中
+        session = self._sessions.get(session_key)
+        if session is None:
+            session = self._sessions[session_key] = _FormattedSession()
+            while len(self._sessions) > self.max_sessions: self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_key)
+        self._sync(session, history)
+        visible: List[FormattedHistoryEntry] = []
+        latest = session.latest_seq_by_signature
+        use_budget = token_budget is not None and estimator is not None
+        tokens_used = 0; images_used = 0; truncated = False
+        for item in reversed(session.items):
+            if latest.get(item.signature) != item.seq: continue
+            if max_messages is not None and len(visible) >= max_messages: truncated = True; break
+            if use_budget:
+                item_tokens = item.count_tokens(estimator)
+                if item.image_ref and image_mode == "caption": item_tokens += ImageCaptionUtils.CAPTION_TOKENS_ESTIMATE # 描述模式下每张历史图片都换成一段文字
+                elif item.image_ref and images_used < MessageUtils.MAX_HISTORY_IMAGES_TO_LLM: item_tokens += estimator.IMAGE_TOKENS_DEFAULT
+                if tokens_used + item_tokens > token_budget: truncated = True; break
+                tokens_used += item_tokens
+                if item.image_ref: images_used += 1
+            visible.append(item)
+        visible.reverse()
+        if align_step > 1 and truncated and visible:
+            aligned_start_seq = -(-visible[0].seq // align_step) * align_step # 向上取整，保证不超过条数和预算上限
+            visible = [item for item in visible if item.seq >= aligned_start_seq]
+        return visible
+
+    def _sync(self, session: _FormattedSession, history: List[Dict[str, Any]]):
+        items = session.items
+        if not items or not history:
+            session.reset(history); return
+        # 从尾部找到缓存中最后一条在当前历史中的位置，通常只需向前看几条新消息
+        last_key = items[-1].key
+        j = len(history) - 1
+        while j >= 0 and history_entry_key(history[j]) != last_key: j -= 1
+        if j < 0 or len(items) < j + 1:
+            self.rebuilds += 1; session.reset(history); return
+        while len(items) > j + 1: session.pop_front()
+        if items[0].key != history_entry_key(history[0]):
+            self.rebuilds += 1; session.reset(history); return
+        for entry in history[j + 1:]: session.push(entry)
+
+    def discard(self, session_key: Hashable):
+        self._sessions.pop(session_key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self._sessions), "entries": sum(len(s.items) for s in self._sessions.values()), "rebuilds": self.rebuilds}
+
+
 class MessageUtils:
     MAX_HISTORY_IMAGES_TO_LLM = 5 
+    FORMATTED_HISTORY_CACHE_MAX_SESSIONS = 256
+    _formatted_history_cache = FormattedHistoryCache(FORMATTED_HISTORY_CACHE_MAX_SESSIONS)
 
     @staticmethod
     async def outline_message_list(message_list: Optional[List[BaseMessageComponent]], for_history: bool = False) -> str:
@@ -37,24 +161,31 @@ class MessageUtils:
     @staticmethod
     async def format_history_for_llm(
         history_dicts: List[Dict[str, Any]], 
-        max_messages: Optional[int] = None
+        max_messages: Optional[int] = None,
+        summary: Optional[str] = None,
+        image_mode: str = "image"
     ) -> Tuple[str, List[str]]: 
-        formatted_entries: List[str] = []
+        formatted_entries: List[str] = [MessageUtils.format_history_summary(summary)] if summary else []
         history_image_data_uris: List[str] = [] 
         
         history_to_process = history_dicts
         if max_messages is not None and len(history_dicts) > max_messages:
             history_to_process = history_dicts[-max_messages:]
 
+        if image_mode == "caption":
+            captions = await MessageUtils._get_history_captions([e.get("image_hash") for e in history_to_process])
+            for entry_dict, caption in zip(history_to_process, captions):
+                formatted_entries.append(MessageUtils.with_image_caption(MessageUtils.format_history_entry(entry_dict), caption))
+            return "\n-\n".join(formatted_entries), history_image_data_uris
+
         images_collected_count = 0
         temp_image_uris_reversed = [] # 用于临时反序存储，确保先拿到最新的图片
 
         for entry_dict in reversed(history_to_process): 
             if images_collected_count >= MessageUtils.MAX_HISTORY_IMAGES_TO_LLM:
                 break 
-            # 假设图片信息存储在 "image_base64_uri" 字段
-            image_uri = entry_dict.get("image_base64_uri") 
-            if image_uri and isinstance(image_uri, str) and image_uri.startswith("base64://"):
+            image_uri = await MessageUtils._resolve_history_image(entry_dict.get("image_hash") or entry_dict.get("image_base64_uri"))
+            if image_uri:
                 temp_image_uris_reversed.append(image_uri)
                 images_collected_count += 1
         
@@ -64,15 +195,146 @@ class MessageUtils:
             logger.debug(f"MessageUtils: 从最近历史中提取了 {len(history_image_data_uris)} 张图片给LLM。")
 
         for entry_dict in history_to_process: 
-            name = entry_dict.get("name", "未知")
-            user_id = entry_dict.get("user_id", "未知ID")
-            text_content = entry_dict.get("text", "[内容缺失或非文本]") 
-            text_content_single_line = text_content.replace("\n", " ").replace("\r", " ")
-            formatted_entry = f"发送者: {name} (ID: {user_id})\n时间: {entry_dict.get('time', 'N/A')}\n内容: {text_content_single_line}"
-            formatted_entries.append(formatted_entry)
+            formatted_entries.append(MessageUtils.format_history_entry(entry_dict))
             
         return "\n-\n".join(formatted_entries), history_image_data_uris
 
+    @staticmethod
+    async def format_session_history_for_llm(
+        session_key: Hashable,
+        history_dicts: List[Dict[str, Any]], 
+        max_messages: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        estimator: Optional[TokenEstimator] = None,
+        summary: Optional[str] = None,
+        image_mode: str = "image"
+    ) -> Tuple[str, List[str]]:
+        # 等价于 dedup_history + format_history_for_llm，但每条历史只格式化一次，之后按会话增量维护
+        window = MessageUtils._formatted_history_cache.window(session_key, history_dicts, max_messages, token_budget, estimator, image_mode=image_mode)
+        if image_mode == "caption":
+            history_image_data_uris: List[str] = []
+            captions = await MessageUtils._get_history_captions([item.entry.get("image_hash") for item in window])
+            pieces = [MessageUtils.with_image_caption(item.piece, caption) for item, caption in zip(window, captions)]
+        else:
+            history_image_data_uris = await MessageUtils._collect_window_images(window)
+            if history_image_data_uris:
+                logger.debug(f"MessageUtils: 从最近历史中提取了 {len(history_image_data_uris)} 张图片给LLM。")
+            pieces = [item.piece for item in window]
+        if summary: pieces.insert(0, MessageUtils.format_history_summary(summary))
+        return "\n-\n".join(pieces), history_image_data_uris
+
+    @staticmethod
+    def get_cache_stats() -> Dict[str, int]:
+        return MessageUtils._formatted_history_cache.stats()
+
+    @staticmethod
+    def get_session_window_entries(
+        session_key: Hashable,
+        history_dicts: List[Dict[str, Any]],
+        max_messages: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        estimator: Optional[TokenEstimator] = None,
+        image_mode: str = "image"
+    ) -> List[Dict[str, Any]]:
+        # 去重后按条数和预算可能发送的最近历史条目。预算更小或按步长对齐的窗口都是它的后缀，检索时排除这些条目即可避免重复
+        return [item.entry for item in MessageUtils._formatted_history_cache.window(session_key, history_dicts, max_messages, token_budget, estimator, image_mode=image_mode)]
+
+    @staticmethod
+    async def build_session_contexts_for_llm(
+        session_key: Hashable,
+        history_dicts: List[Dict[str, Any]],
+        persona_name: str,
+        max_messages: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        estimator: Optional[TokenEstimator] = None,
+        align_step: int = 0,
+        exclude_message: Optional[Tuple[Optional[str], Optional[str], Optional[str]]] = None,
+        summary: Optional[str] = None,
+        image_mode: str = "image"
+    ) -> Tuple[List[Dict[str, str]], List[str]]:
+        # 把历史转换为 user/assistant 多轮上下文：只有当前人格自己的发言是 assistant，其余 (用户和其他Bot) 带名字作为 user
+        # exclude_message 为 (message_id, user_id, text)，用于去掉与当前消息重复的最后一条历史
+        window = MessageUtils._formatted_history_cache.window(session_key, history_dicts, max_messages, token_budget, estimator, align_step, image_mode)
+        if window and exclude_message:
+            last_entry = window[-1].entry
+            exclude_mid, exclude_uid, exclude_text = exclude_message
+            if (exclude_mid and last_entry.get("message_id") == exclude_mid) or \
+               (exclude_uid and str(last_entry.get("user_id")) == str(exclude_uid) and (last_entry.get("text") or "").strip() == (exclude_text or "").strip()):
+                window = window[:-1]
+        own_name = f"Bot_{persona_name}"
+        contexts: List[Dict[str, str]] = [{"role": "user", "content": MessageUtils.format_history_summary(summary)}] if summary else []
+        captions = await MessageUtils._get_history_captions([item.entry.get("image_hash") for item in window]) if image_mode == "caption" else [None] * len(window)
+        for item, caption in zip(window, captions):
+            entry = item.entry
+            text_single_line = (entry.get("text") or "[内容缺失或非文本]").replace("\n", " ").replace("\r", " ")
+            if entry.get("role") == "assistant" and entry.get("name") == own_name:
+                contexts.append({"role": "assistant", "content": MessageUtils.with_image_caption(text_single_line, caption)}) # 自己的发言不加名字前缀，避免模型在回复中模仿该格式
+                continue
+            if item.context_content is None:
+                item.context_content = f"{entry.get('name', '未知')} (ID: {entry.get('user_id', '未知ID')}): {text_single_line}"
+            contexts.append({"role": "user", "content": MessageUtils.with_image_caption(item.context_content, caption)})
+        if image_mode == "caption": return contexts, []
+        return contexts, await MessageUtils._collect_window_images(window)
+
+    @staticmethod
+    async def _collect_window_images(window: List[FormattedHistoryEntry]) -> List[str]:
+        # 取窗口内最新的几张图片，按时间正序返回
+        temp_image_uris_reversed: List[str] = []
+        for item in reversed(window):
+            if len(temp_image_uris_reversed) >= MessageUtils.MAX_HISTORY_IMAGES_TO_LLM: break
+            if not item.image_ref: continue
+            image_uri = await MessageUtils._resolve_history_image(item.image_ref)
+            if image_uri: temp_image_uris_reversed.append(image_uri)
+        return list(reversed(temp_image_uris_reversed))
+
+    @staticmethod
+    async def _resolve_history_image(image_ref: Any) -> Optional[str]:
+        # 图片以内容哈希存放在 "image_hash" 字段，只还原真正要发送的这几张；兼容旧的 "image_base64_uri"
+        if not image_ref or not isinstance(image_ref, str): return None
+        if image_ref.startswith("base64://"): return image_ref
+        image_uri = await IOExecutor.run(ImageBlobStore.get_base64_uri, image_ref)
+        return image_uri if image_uri and image_uri.startswith("base64://") else None
+
+    @staticmethod
+    async def _get_history_captions(image_hashes: List[Any]) -> List[Optional[str]]:
+        # 描述模式：历史图片只取已缓存的描述，尚未生成的在后台生成，本次先以 "[图片]" 占位
+        async def _caption(image_hash: Any) -> Optional[str]:
+            if not image_hash or not isinstance(image_hash, str): return None
+            return await ImageCaptionUtils.get_history_caption(image_hash)
+        if not any(image_hashes): return [None] * len(image_hashes)
+        return list(await asyncio.gather(*(_caption(h) for h in image_hashes)))
+
+    @staticmethod
+    def with_image_caption(text: str, caption: Optional[str]) -> str:
+        return f"{text}（图片描述：{caption}）" if caption else text
+
+    @staticmethod
+    def format_history_summary(summary: str) -> str:
+        return f"更早的对话摘要：\n{summary}"
+
+    @staticmethod
+    def format_history_entry(entry_dict: Dict[str, Any]) -> str:
+        name = entry_dict.get("name", "未知")
+        user_id = entry_dict.get("user_id", "未知ID")
+        text_content = entry_dict.get("text", "[内容缺失或非文本]") 
+        text_content_single_line = text_content.replace("\n", " ").replace("\r", " ")
+        return f"发送者: {name} (ID: {user_id})\n时间: {entry_dict.get('time', 'N/A')}\n内容: {text_content_single_line}"
+
+    @staticmethod
+    def history_signature(entry: Dict[str, Any]) -> str:
+        # 基于 "role", "user_id", "text" 和 "image_hash" (如果存在) 作为去重键
+        signature_parts = [
+            entry.get("role", ""),
+            str(entry.get("user_id", "")),
+            entry.get("text", "") 
+        ]
+        if entry.get("image_hash"):
+            signature_parts.append(str(entry["image_hash"])) # 完整内容哈希，不会因前缀相同而误判
+        elif "image_base64_uri" in entry and entry["image_base64_uri"]:
+            # 只取base64数据的前一小部分作为签名的一部分，避免过长的key
+            signature_parts.append(entry["image_base64_uri"][:100]) 
+        return "::".join(signature_parts)
+
     @staticmethod
     async def get_text_from_event(event: AstrMessageEvent, for_history: bool = False) -> str:
         if not event or not event.get_messages(): return ""
@@ -80,21 +342,11 @@ class MessageUtils:
     
     @staticmethod
     def dedup_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        # 基于 "role", "user_id", "text" 和 "image_base64_uri" (如果存在) 作为去重键
         # 注意：这只是一个简单的示例，对于复杂情况（例如，文本相似但不完全相同），可能需要更高级的去重逻辑。
         seen_signatures = set()
         deduped_history: List[Dict[str, Any]] = []
         for entry in reversed(history): # 从后往前，保留最新的
-            signature_parts = [
-                entry.get("role", ""),
-                str(entry.get("user_id", "")),
-                entry.get("text", "") 
-            ]
-            if "image_base64_uri" in entry and entry["image_base64_uri"]:
-                # 只取base64数据的前一小部分作为签名的一部分，避免过长的key
-                signature_parts.append(entry["image_base64_uri"][:100]) 
-            
-            signature = "::".join(signature_parts)
+            signature = MessageUtils.history_signature(entry)
             
             if signature not in seen_signatures:
                 deduped_history.append(entry)
@@ -1,61 +1,92 @@
 # astrbot_plugin_relaychat/utils/persona_utils.py
 
-from astrbot.api.all import Context, logger 
-from typing import List, Optional, Any, Dict, Union
+from astrbot.api.all import Context, logger
+from typing import List, Optional, Any, Dict, Union, Tuple
+
+class ResolvedPersona:
+    # 预先解析好的人格：每次 LLM 请求只需一次字典查找
+    __slots__ = ("name", "persona_dict", "system_prompt", "model")
+
+    def __init__(self, name: str, persona_dict: Dict[str, Any]):
+        self.name = name
+        self.persona_dict = persona_dict
+        system_prompt = persona_dict.get("system_prompt") or persona_dict.get("prompt") # Try both keys
+        self.system_prompt: Optional[str] = system_prompt if isinstance(system_prompt, str) and system_prompt.strip() else None
+        model_name = persona_dict.get("model")
+        self.model: Optional[str] = model_name.strip() if isinstance(model_name, str) and model_name.strip() else None
 
 class PersonaUtils:
+    _index: Dict[str, ResolvedPersona] = {}
+    _index_signature: Optional[Tuple[int, int, Any]] = None # (列表 id, 列表长度, provider_manager 的版本号 (如果有))
+    _missing_warned: set = set()
+
     @staticmethod
-    def get_persona_by_name(context: Context, persona_name: str) -> Optional[Dict[str, Any]]:
-        if not persona_name:
-            logger.warning("PersonaUtils: get_persona_by_name called with empty persona_name.")
-            return None
-        logger.debug(f"PersonaUtils: Attempting to get persona by name: '{persona_name}'")
+    def _get_persona_list(context: Context) -> Optional[List[Any]]:
         if not hasattr(context, 'provider_manager') or not context.provider_manager:
             logger.error("PersonaUtils: context.provider_manager is not available."); return None
         if not hasattr(context.provider_manager, 'personas') or not isinstance(context.provider_manager.personas, list):
             logger.error("PersonaUtils: context.provider_manager.personas is not available or not a list."); return None
-        all_personas: List[Dict[str, Any]] = context.provider_manager.personas
-        logger.debug(f"PersonaUtils: Iterating through {len(all_personas)} personas.")
-        if len(all_personas) > 0 and isinstance(all_personas[0], dict):
-             logger.debug(f"PersonaUtils: First persona dict keys: {list(all_personas[0].keys())}")
-        elif len(all_personas) > 0:
-             logger.warning(f"PersonaUtils: First persona object is not a dict, type: {type(all_personas[0])}")
+        return context.provider_manager.personas
+
+    @staticmethod
+    def _ensure_index(context: Context) -> Dict[str, ResolvedPersona]:
+        all_personas = PersonaUtils._get_persona_list(context)
+        if all_personas is None: return {}
+        signature = (id(all_personas), len(all_personas), getattr(context.provider_manager, 'version', None))
+        if signature != PersonaUtils._index_signature:
+            PersonaUtils._build_index(all_personas)
+            PersonaUtils._index_signature = signature
+        return PersonaUtils._index
+
+    @staticmethod
+    def _build_index(all_personas: List[Any]):
+        index: Dict[str, ResolvedPersona] = {}
         for i, persona_dict in enumerate(all_personas):
-            if not isinstance(persona_dict, dict): 
+            if not isinstance(persona_dict, dict):
                 logger.warning(f"PersonaUtils: Persona entry #{i} is not a dictionary, skipping. Type: {type(persona_dict)}")
                 continue
             current_p_name = persona_dict.get('name')
-            p_id = persona_dict.get('id') 
-            has_prompt_key = "prompt" in persona_dict or "system_prompt" in persona_dict
-            logger.debug(f"PersonaUtils: Checking persona dict #{i}: Name='{current_p_name}', ID='{p_id}', HasPromptKey={has_prompt_key}")
-            if current_p_name == persona_name:
-                logger.info(f"PersonaUtils: Found matching persona for '{persona_name}' by name. Returning dict.")
-                return persona_dict
-        logger.warning(f"PersonaUtils: Persona named '{persona_name}' not found after checking all entries.")
-        return None
+            if not current_p_name or current_p_name in index: continue # 与逐个扫描一致：同名时第一个生效
+            index[current_p_name] = ResolvedPersona(current_p_name, persona_dict)
+        PersonaUtils._index = index
+        PersonaUtils._missing_warned = set()
+        logger.info(f"PersonaUtils: Persona index rebuilt with {len(index)} personas: {list(index.keys())}")
+
+    @staticmethod
+    def invalidate():
+        PersonaUtils._index = {}
+        PersonaUtils._index_signature = None
+
+    @staticmethod
+    def reload(context: Context) -> int:
+        PersonaUtils.invalidate()
+        return len(PersonaUtils._ensure_index(context))
+
+    @staticmethod
+    def resolve_persona(context: Context, persona_name: str) -> Optional[ResolvedPersona]:
+        if not persona_name:
+            logger.warning("PersonaUtils: resolve_persona called with empty persona_name.")
+            return None
+        resolved = PersonaUtils._ensure_index(context).get(persona_name)
+        if resolved is None and persona_name not in PersonaUtils._missing_warned:
+            PersonaUtils._missing_warned.add(persona_name) # 每个缺失的人格在索引重建前只警告一次
+            logger.warning(f"PersonaUtils: Persona named '{persona_name}' not found in persona index.")
+        return resolved
+
+    @staticmethod
+    def get_persona_by_name(context: Context, persona_name: str) -> Optional[Dict[str, Any]]:
+        resolved = PersonaUtils.resolve_persona(context, persona_name)
+        return resolved.persona_dict if resolved else None
 
     @staticmethod
     def get_persona_system_prompt(context: Context, persona_name: str, default_prompt: str = "") -> str:
-        logger.debug(f"PersonaUtils: Requesting system_prompt for persona '{persona_name}'.")
-        persona_dict = PersonaUtils.get_persona_by_name(context, persona_name)
-        if persona_dict:
-            system_prompt = persona_dict.get("system_prompt") or persona_dict.get("prompt") # Try both keys
-            if system_prompt and isinstance(system_prompt, str) and system_prompt.strip():
-                logger.info(f"PersonaUtils: Successfully retrieved system_prompt for '{persona_name}' (length: {len(system_prompt)}).")
-                return system_prompt
-            else:
-                logger.warning(f"PersonaUtils: Persona '{persona_name}' found, but its 'system_prompt' (or 'prompt') field is empty or not a string. Using default prompt.")
+        resolved = PersonaUtils.resolve_persona(context, persona_name)
+        if resolved and resolved.system_prompt: return resolved.system_prompt
+        if resolved: logger.debug(f"PersonaUtils: Persona '{persona_name}' found, but its 'system_prompt' (or 'prompt') field is empty or not a string. Using default prompt.")
         return default_prompt
 
     @staticmethod
     def get_persona_model(context: Context, persona_name: str, default_model: Optional[str] = None) -> Optional[str]:
-        logger.debug(f"PersonaUtils: Requesting model for persona '{persona_name}'.")
-        persona_dict = PersonaUtils.get_persona_by_name(context, persona_name)
-        if persona_dict:
-            model_name = persona_dict.get("model")
-            if model_name and isinstance(model_name, str) and model_name.strip():
-                logger.info(f"PersonaUtils: Successfully retrieved model '{model_name}' for '{persona_name}'.")
-                return model_name.strip()
-            else:
-                logger.debug(f"PersonaUtils: Persona '{persona_name}' found, but no specific model configured or model is empty.")
+        resolved = PersonaUtils.resolve_persona(context, persona_name)
+        if resolved and resolved.model: return resolved.model
         return default_model
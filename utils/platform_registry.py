@@ -0,0 +1,68 @@
+# astrbot_plugin_relaychat/utils/platform_registry.py
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from astrbot.api.all import Context, PlatformMetadata, logger
+
+
+class PlatformRegistry:
+    """
+    平台ID -> 适配器实例 / 模拟事件用 PlatformMetadata 的缓存。
+    平台实例发生变化 (增删、整体替换或原地替换某个实例) 时自动重建，构造连锁事件时只需比较一次实例标识再做字典查找。
+    """
+
+    def __init__(self, context: Context):
+        self.context = context
+        self._adapters: Dict[str, Any] = {}
+        self._metadata: Dict[Tuple[str, str], PlatformMetadata] = {}
+        self._signature: Optional[Tuple[int, ...]] = None # 各平台实例的 id；原地替换某个实例时数量不变但标识会变
+
+    def _get_platform_insts(self) -> Optional[List[Any]]:
+        platform_manager = getattr(self.context, 'platform_manager', None)
+        if not platform_manager: return None
+        insts = getattr(platform_manager, 'platform_insts', None)
+        if isinstance(insts, list): return insts
+        if hasattr(platform_manager, 'get_insts'):
+            insts = platform_manager.get_insts() # type: ignore
+            return insts if isinstance(insts, list) else list(insts or [])
+        return None
+
+    def _ensure_fresh(self, force: bool = False):
+        insts = self._get_platform_insts()
+        if insts is None: return
+        signature = tuple(id(inst_plat) for inst_plat in insts)
+        if not force and signature == self._signature: return
+        adapters: Dict[str, Any] = {}
+        for inst_plat in insts:
+            meta = getattr(inst_plat, 'metadata', None)
+            if meta is not None and getattr(meta, 'id', None) is not None:
+                adapters.setdefault(str(meta.id), inst_plat)
+        self._adapters = adapters
+        self._signature = signature
+        logger.debug(f"PlatformRegistry: 平台索引已重建，共 {len(adapters)} 个平台实例: {list(adapters.keys())}")
+
+    def refresh(self) -> int:
+        self._ensure_fresh(force=True)
+        return len(self._adapters)
+
+    def get_adapter(self, platform_id: str) -> Optional[Any]:
+        platform_id = str(platform_id)
+        self._ensure_fresh()
+        adapter = self._adapters.get(platform_id)
+        if adapter is not None: return adapter
+        # 实例变化已由签名发现，未命中时再强制重建一次 (平台元数据可能刚被修改)；仍未命中再尝试平台管理器的按ID查找
+        self._ensure_fresh(force=True)
+        adapter = self._adapters.get(platform_id)
+        if adapter is None:
+            platform_manager = getattr(self.context, 'platform_manager', None)
+            if platform_manager and hasattr(platform_manager, 'get_platform_by_id'):
+                adapter = platform_manager.get_platform_by_id(platform_id)
+                if adapter is not None: self._adapters[platform_id] = adapter
+        return adapter
+
+    def get_chain_metadata(self, platform_name: str, platform_id: str) -> PlatformMetadata:
+        key = (platform_name, str(platform_id))
+        meta = self._metadata.get(key)
+        if meta is None:
+            meta = self._metadata[key] = PlatformMetadata(name=platform_name, id=str(platform_id), description=f"模拟连锁事件 for {platform_id}")
+        return meta
@@ -0,0 +1,276 @@
+# astrbot_plugin_relaychat/utils/relay_stats.py
+
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .io_executor import IOExecutor
+
+logger = logging.getLogger(__name__)
+
+OTHER_LABEL = "other" # 超出标签数量上限的人格归入此项
+
+
+class LatencyHistogram:
+    """固定桶的耗时直方图：每次记录只做一次二分查找和几次加法，分位数按桶上界估算。"""
+    __slots__ = ("bucket_counts", "count", "total_seconds", "max_seconds")
+    BUCKET_BOUNDS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(self.BUCKET_BOUNDS_SECONDS) + 1) # 最后一个桶为 +Inf
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds: float):
+        bounds = self.BUCKET_BOUNDS_SECONDS
+        lo, hi = 0, len(bounds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if seconds <= bounds[mid]: hi = mid
+            else: lo = mid + 1
+        self.bucket_counts[lo] += 1
+        self.count += 1; self.total_seconds += seconds
+        if seconds > self.max_seconds: self.max_seconds = seconds
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, n in enumerate(other.bucket_counts): self.bucket_counts[i] += n
+        self.count += other.count; self.total_seconds += other.total_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.count: return 0.0
+        rank = q * self.count; seen = 0
+        for i, n in enumerate(self.bucket_counts):
+            seen += n
+            if seen >= rank: return self.BUCKET_BOUNDS_SECONDS[i] if i < len(self.BUCKET_BOUNDS_SECONDS) else self.max_seconds
+        return self.max_seconds
+
+
+class _StageTimer:
+    __slots__ = ("stage", "persona", "started_at")
+
+    def __init__(self, stage: str, persona: Optional[str]):
+        self.stage = stage; self.persona = persona; self.started_at = 0.0
+
+    def __enter__(self) -> "_StageTimer":
+        self.started_at = time.perf_counter(); return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        RelayStats.observe(self.stage, time.perf_counter() - self.started_at, self.persona)
+
+
+class RelayStats:
+    """
+    各处理阶段的耗时直方图和计数器，按人格和会话分组。
+    只在事件循环中读写；人格标签数量有上限，会话计数按 LRU 只保留最近活跃的若干个，内存占用不随会话数增长。
+    通过 /relaystats 查看，也可以定期写出 Prometheus 文本格式的文件。
+    """
+    MAX_PERSONA_LABELS = 32
+    MAX_SESSIONS_DEFAULT = 64
+    DUMP_INTERVAL_SECONDS_DEFAULT = 60.0
+
+    enabled: bool = True
+    max_sessions: int = MAX_SESSIONS_DEFAULT
+    prometheus_path: str = ""
+    dump_interval_seconds: float = DUMP_INTERVAL_SECONDS_DEFAULT
+    started_at: float = time.time()
+    _histograms: Dict[Tuple[str, str], LatencyHistogram] = {} # (阶段, 人格) -> 直方图
+    _counters: Dict[Tuple[str, str, str], int] = {} # (计数器名, 人格, 细分原因) -> 次数
+    _persona_labels: set = set()
+    _sessions: "OrderedDict[str, Dict[str, int]]" = OrderedDict() # 会话 -> 计数器名 -> 次数
+    _sessions_evicted: int = 0
+    _sources: Dict[str, Callable[[], Dict[str, Any]]] = {} # 其他模块已有的 stats()，查看时再读取
+    _dump_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def init(plugin_config: Any):
+        RelayStats.enabled = bool(plugin_config.get("stats_enable", True))
+        RelayStats.max_sessions = max(0, int(plugin_config.get("stats_max_sessions", RelayStats.MAX_SESSIONS_DEFAULT)))
+        RelayStats.prometheus_path = str(plugin_config.get("stats_prometheus_path", "") or "").strip()
+        RelayStats.dump_interval_seconds = max(1.0, float(plugin_config.get("stats_dump_interval_seconds", RelayStats.DUMP_INTERVAL_SECONDS_DEFAULT)))
+        RelayStats.reset()
+        RelayStats._sources.clear()
+        logger.debug(f"RelayChat RelayStats: enabled={RelayStats.enabled}, max_sessions={RelayStats.max_sessions}, "
+                     f"prometheus_path={RelayStats.prometheus_path or '无'}, dump_interval={RelayStats.dump_interval_seconds}s")
+
+    @staticmethod
+    def reset():
+        RelayStats._histograms.clear(); RelayStats._counters.clear(); RelayStats._persona_labels.clear()
+        RelayStats._sessions.clear(); RelayStats._sessions_evicted = 0
+        RelayStats.started_at = time.time()
+
+    @staticmethod
+    def register_source(name: str, stats_fn: Callable[[], Dict[str, Any]]):
+        RelayStats._sources[name] = stats_fn
+
+    @staticmethod
+    def _persona_label(persona: Optional[str]) -> str:
+        if not persona: return ""
+        if persona in RelayStats._persona_labels: return persona
+        if len(RelayStats._persona_labels) >= RelayStats.MAX_PERSONA_LABELS: return OTHER_LABEL
+        RelayStats._persona_labels.add(persona); return persona
+
+    @staticmethod
+    def timer(stage: str, persona: Optional[str] = None) -> _StageTimer:
+        """用法: `with RelayStats.timer("history_load"): ...`，可以包住 await。"""
+        return _StageTimer(stage, persona)
+
+    @staticmethod
+    @asynccontextmanager
+    async def contended(lock: asyncio.Lock, name: str):
+        """替代 `async with lock`：锁已被占用时记录一次争用 (lock_contention) 和等待耗时 ({name}_lock_wait)。"""
+        if RelayStats.enabled and lock.locked():
+            RelayStats.incr("lock_contention", reason=name)
+            with RelayStats.timer(f"{name}_lock_wait"): await lock.acquire()
+        else: await lock.acquire()
+        try: yield
+        finally: lock.release()
+
+    @staticmethod
+    def observe(stage: str, seconds: float, persona: Optional[str] = None):
+        if not RelayStats.enabled: return
+        key = (stage, RelayStats._persona_label(persona))
+        histogram = RelayStats._histograms.get(key)
+        if histogram is None: histogram = RelayStats._histograms[key] = LatencyHistogram()
+        histogram.observe(max(0.0, seconds))
+
+    @staticmethod
+    def incr(name: str, persona: Optional[str] = None, reason: str = "", session: Optional[str] = None, value: int = 1):
+        if not RelayStats.enabled: return
+        key = (name, RelayStats._persona_label(persona), reason)
+        RelayStats._counters[key] = RelayStats._counters.get(key, 0) + value
+        if session is None or RelayStats.max_sessions <= 0: return
+        session_counters = RelayStats._sessions.get(session)
+        if session_counters is None:
+            session_counters = RelayStats._sessions[session] = {}
+            if len(RelayStats._sessions) > RelayStats.max_sessions:
+                RelayStats._sessions.popitem(last=False); RelayStats._sessions_evicted += 1
+        else: RelayStats._sessions.move_to_end(session)
+        session_counters[name] = session_counters.get(name, 0) + value
+
+    @staticmethod
+    def _read_sources() -> Dict[str, Dict[str, Any]]:
+        results: Dict[str, Dict[str, Any]] = {}
+        for name, stats_fn in list(RelayStats._sources.items()):
+            try: results[name] = stats_fn()
+            except Exception as e: logger.warning(f"RelayChat RelayStats: 读取 {name} 的统计出错: {e}")
+        return results
+
+    @staticmethod
+    def _flatten(prefix: str, value: Any, out: List[Tuple[str, float]]):
+        if isinstance(value, bool): out.append((prefix, float(value)))
+        elif isinstance(value, (int, float)): out.append((prefix, float(value)))
+        elif isinstance(value, dict):
+            for k, v in value.items(): RelayStats._flatten(f"{prefix}_{k}", v, out)
+
+    @staticmethod
+    def format_report(top_sessions: int = 5, top_labels: int = 8) -> str:
+        uptime_minutes = (time.time() - RelayStats.started_at) / 60
+        lines = [f"RelayChat 统计 (最近 {uptime_minutes:.1f} 分钟{'' if RelayStats.enabled else '，统计已关闭'})"]
+        merged: Dict[str, LatencyHistogram] = {}
+        for (stage, _), histogram in RelayStats._histograms.items():
+            merged.setdefault(stage, LatencyHistogram()).merge(histogram)
+        if merged:
+            lines.append("[阶段耗时] 次数 | 平均 | p50 | p95 | 最大 (ms)")
+            for stage, h in sorted(merged.items(), key=lambda item: item[1].total_seconds, reverse=True): # 总耗时最多的阶段排在前面
+                lines.append(f"  {stage}: {h.count} | {h.total_seconds / h.count * 1000:.1f} | ≤{h.quantile(0.5) * 1000:g} | "
+                             f"≤{h.quantile(0.95) * 1000:g} | {h.max_seconds * 1000:.1f}")
+        if RelayStats._counters:
+            lines.append("[计数]")
+            grouped: Dict[str, Dict[str, int]] = {}
+            for (name, persona, reason), count in RelayStats._counters.items():
+                label = "/".join(part for part in (persona, reason) if part) or "全部"
+                by_label = grouped.setdefault(name, {}); by_label[label] = by_label.get(label, 0) + count
+            for name in sorted(grouped):
+                parts = sorted(grouped[name].items(), key=lambda item: item[1], reverse=True)
+                shown = ", ".join(f"{label}={count}" for label, count in parts[:top_labels]) + (", ..." if len(parts) > top_labels else "")
+                lines.append(f"  {name}: {sum(grouped[name].values())} ({shown})")
+        if RelayStats._sessions:
+            busiest = sorted(RelayStats._sessions.items(), key=lambda item: sum(item[1].values()), reverse=True)[:top_sessions]
+            lines.append(f"[活跃会话] 跟踪 {len(RelayStats._sessions)} 个 (已淘汰 {RelayStats._sessions_evicted} 个)")
+            for session, counters in busiest:
+                lines.append(f"  {session}: " + ", ".join(f"{k}={v}" for k, v in sorted(counters.items())))
+        sources = RelayStats._read_sources()
+        if sources:
+            lines.append("[模块状态]")
+            for name, values in sources.items():
+                flat: List[Tuple[str, float]] = []
+                RelayStats._flatten("", values, flat)
+                lines.append(f"  {name}: " + ", ".join(f"{k[1:]}={v:g}" for k, v in flat))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _escape_label(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    @staticmethod
+    def _metric_name(name: str) -> str:
+        return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    @staticmethod
+    def render_prometheus() -> str:
+        esc = RelayStats._escape_label
+        lines = ["# HELP relaychat_stage_duration_seconds RelayChat 各处理阶段耗时", "# TYPE relaychat_stage_duration_seconds histogram"]
+        for (stage, persona), h in sorted(RelayStats._histograms.items()):
+            labels = f'stage="{esc(stage)}",persona="{esc(persona)}"'
+            cumulative = 0
+            for bound, n in zip(LatencyHistogram.BUCKET_BOUNDS_SECONDS, h.bucket_counts):
+                cumulative += n
+                lines.append(f'relaychat_stage_duration_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+            lines.append(f'relaychat_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f"relaychat_stage_duration_seconds_sum{{{labels}}} {h.total_seconds:.6f}")
+            lines.append(f"relaychat_stage_duration_seconds_count{{{labels}}} {h.count}")
+        counter_names = sorted({name for name, _, _ in RelayStats._counters})
+        for name in counter_names:
+            metric = f"relaychat_{RelayStats._metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (counter_name, persona, reason), count in sorted(RelayStats._counters.items()):
+                if counter_name == name: lines.append(f'{metric}{{persona="{esc(persona)}",reason="{esc(reason)}"}} {count}')
+        for source_name, values in RelayStats._read_sources().items():
+            flat: List[Tuple[str, float]] = []
+            RelayStats._flatten(RelayStats._metric_name(source_name), values, flat)
+            for key, value in flat:
+                metric = f"relaychat_{RelayStats._metric_name(key)}"
+                lines.append(f"# TYPE {metric} gauge"); lines.append(f"{metric} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write_file(path: str, content: str):
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: f.write(content)
+        os.replace(tmp_path, path) # 原子替换，抓取方不会读到写了一半的文件
+
+    @staticmethod
+    async def dump_prometheus():
+        if not RelayStats.prometheus_path: return
+        try: await IOExecutor.run(RelayStats._write_file, RelayStats.prometheus_path, RelayStats.render_prometheus())
+        except Exception as e: logger.warning(f"RelayChat RelayStats: 写出统计文件 '{RelayStats.prometheus_path}' 失败: {e}")
+
+    @staticmethod
+    def ensure_dump_task():
+        if not (RelayStats.enabled and RelayStats.prometheus_path): return
+        if RelayStats._dump_task and not RelayStats._dump_task.done(): return
+        RelayStats._dump_task = asyncio.get_running_loop().create_task(RelayStats._dump_loop())
+
+    @staticmethod
+    async def _dump_loop():
+        while True:
+            await asyncio.sleep(RelayStats.dump_interval_seconds)
+            await RelayStats.dump_prometheus()
+
+    @staticmethod
+    async def shutdown():
+        dump_task, RelayStats._dump_task = RelayStats._dump_task, None
+        if dump_task and not dump_task.done():
+            dump_task.cancel()
+            try: await dump_task
+            except asyncio.CancelledError: pass
+            await RelayStats.dump_prometheus() # 关闭前写出最后一次
@@ -0,0 +1,133 @@
+# astrbot_plugin_relaychat/utils/runtime_config.py
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Any, Callable, Dict, List, Optional
+
+from astrbot.api.all import Context, AstrBotConfig, logger
+from .bot_profile import BotProfileRegistry
+from .decision_utils import DecisionModule
+from .llm_module import LLMModule
+from .io_executor import IOExecutor
+
+DEFAULT_MAX_INTERNAL_CHAIN_DEPTH = 1
+DEFAULT_INITIAL_REPLY_MIN_DELAY = 0.1
+DEFAULT_INITIAL_REPLY_MAX_DELAY = 0.8
+DEFAULT_INTERNAL_CHAIN_MIN_DELAY = 1.0
+DEFAULT_INTERNAL_CHAIN_MAX_DELAY = 3.0
+
+# 重载时会重新读取的配置项；其余配置项 (存储后端、线程池、索引、图片处理、llm_history_image_mode 等) 在启动时初始化，修改后需重启插件
+RELOADABLE_CONFIG_KEYS = (
+    "managed_bots", "default_global_keywords", "default_global_blacklist",
+    "default_global_base_reply_probability", "default_global_chain_reply_probability",
+    "max_chain_depth", "chain_fanout_max_speakers", "chain_speculative_generation",
+    "initial_reply_min_delay_seconds", "initial_reply_max_delay_seconds",
+    "chain_reply_min_delay_seconds", "chain_reply_max_delay_seconds",
+    "conversation_incentive_probability", "conversation_incentive_duration_seconds", "state_store_max_entries",
+    "llm_max_history_default", "history_summary_window", "llm_history_token_budget", "llm_persona_token_budgets", "llm_token_estimator",
+    "llm_structured_contexts", "llm_context_window_step", "llm_lock_release_delay_seconds", "llm_lock_max_hold_seconds",
+)
+
+
+def _config_values(plugin_config: Any) -> Dict[str, str]:
+    # 每个配置项序列化为规范的 JSON 文本，便于比较和计算指纹
+    return {key: json.dumps(value, ensure_ascii=False, sort_keys=True, default=str) for key, value in plugin_config.items()}
+
+
+class RelayRuntimeConfig:
+    """
+    可热重载的运行参数快照：连锁深度、回复延迟、Bot档案以及据此构建的决策模块和LLM模块。
+    构建后只读，重载时整体替换；处理中的事件继续使用开始时取到的快照。
+    对话激励计时器和LLM锁是类级别的状态，替换模块实例时原样保留。
+    """
+    __slots__ = ("max_chain_depth", "initial_min_delay", "initial_max_delay", "chain_min_delay", "chain_max_delay",
+                 "chain_speculative_generation", "bot_profiles", "decision_module", "llm_module",
+                 "config_values", "fingerprint", "version", "loaded_at")
+
+    def __init__(self, context: Context, plugin_config: AstrBotConfig, version: int = 1):
+        self.max_chain_depth: int = int(plugin_config.get("max_chain_depth", DEFAULT_MAX_INTERNAL_CHAIN_DEPTH))
+        self.initial_min_delay: float = float(plugin_config.get("initial_reply_min_delay_seconds", DEFAULT_INITIAL_REPLY_MIN_DELAY))
+        self.initial_max_delay: float = float(plugin_config.get("initial_reply_max_delay_seconds", DEFAULT_INITIAL_REPLY_MAX_DELAY))
+        self.chain_min_delay: float = float(plugin_config.get("chain_reply_min_delay_seconds", DEFAULT_INTERNAL_CHAIN_MIN_DELAY))
+        self.chain_max_delay: float = float(plugin_config.get("chain_reply_max_delay_seconds", DEFAULT_INTERNAL_CHAIN_MAX_DELAY))
+        self.chain_speculative_generation: bool = bool(plugin_config.get("chain_speculative_generation", False))
+        self.bot_profiles = BotProfileRegistry.from_config(plugin_config) # 每个Bot解析一次，附带平台ID/BotUID索引和编译好的关键词自动机
+        self.decision_module = DecisionModule(plugin_config, self.bot_profiles)
+        self.llm_module = LLMModule(context, plugin_config)
+        self.config_values = _config_values(plugin_config)
+        self.fingerprint = RelayRuntimeConfig.fingerprint_of(plugin_config)
+        self.version = version
+        self.loaded_at = time.time()
+        logger.debug(f"RelayRuntimeConfig v{version}: 初始回复延迟 {self.initial_min_delay}s - {self.initial_max_delay}s, "
+                     f"连锁回复延迟 {self.chain_min_delay}s - {self.chain_max_delay}s, 最大连锁深度 {self.max_chain_depth}, Bot数 {len(self.bot_profiles)}")
+
+    @staticmethod
+    def fingerprint_of(plugin_config: Any) -> str:
+        values = _config_values(plugin_config)
+        payload = json.dumps([(key, values.get(key)) for key in RELOADABLE_CONFIG_KEYS], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def changed_keys(self, plugin_config: Any) -> List[str]:
+        new_values = _config_values(plugin_config)
+        return sorted(key for key in set(self.config_values) | set(new_values) if self.config_values.get(key) != new_values.get(key))
+
+
+class ConfigFileWatcher:
+    """
+    轮询插件配置文件的修改时间，文件变化后读入内存中的配置对象，再由回调比较指纹决定是否重载。
+    只在配置对象提供 config_path 时读取文件；否则只检查内存中的配置是否被修改。
+    """
+
+    def __init__(self, plugin_config: AstrBotConfig, interval_seconds: float, on_change: Callable[[str], Any]):
+        self.plugin_config = plugin_config
+        self.interval_seconds = max(0.0, float(interval_seconds))
+        self.on_change = on_change
+        self.config_path: Optional[str] = getattr(plugin_config, "config_path", None)
+        self._last_mtime: Optional[float] = self._stat_mtime()
+        self._task: Optional[asyncio.Task] = None
+
+    def _stat_mtime(self) -> Optional[float]:
+        if not self.config_path: return None
+        try: return os.path.getmtime(self.config_path)
+        except OSError: return None
+
+    def _read_file(self) -> Optional[Dict[str, Any]]:
+        with open(self.config_path, "r", encoding="utf-8-sig") as f: data = json.load(f) # type: ignore[arg-type]
+        return data if isinstance(data, dict) else None
+
+    async def refresh_from_file(self) -> bool:
+        """把配置文件的内容读入内存中的配置对象；文件不可用或内容无效时保持原样，返回是否已读取。"""
+        if not self.config_path: return False
+        self._last_mtime = await IOExecutor.run(self._stat_mtime)
+        try: data = await IOExecutor.run(self._read_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"RelayChat ConfigFileWatcher: 读取配置文件 '{self.config_path}' 失败，保持当前配置: {e}"); return False
+        if data is None:
+            logger.warning(f"RelayChat ConfigFileWatcher: 配置文件 '{self.config_path}' 的内容不是对象，保持当前配置。"); return False
+        self.plugin_config.update(data)
+        return True
+
+    def ensure_started(self):
+        if self.interval_seconds <= 0 or (self._task and not self._task.done()): return
+        self._task = asyncio.get_running_loop().create_task(self._watch_loop())
+        logger.debug(f"RelayChat ConfigFileWatcher: 开始监视配置 (间隔 {self.interval_seconds}s, 文件: {self.config_path or '无'})。")
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                mtime = await IOExecutor.run(self._stat_mtime)
+                if mtime is not None and mtime != self._last_mtime: await self.refresh_from_file()
+                self.on_change("配置监视")
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.error(f"RelayChat ConfigFileWatcher: 检查配置变化出错: {e}", exc_info=True)
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task and not task.done():
+            task.cancel()
+            try: await task
+            except asyncio.CancelledError: pass
@@ -0,0 +1,74 @@
+# astrbot_plugin_relaychat/utils/token_estimator.py
+
+import re
+import logging
+from typing import Dict, Optional, Type
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken # 可选依赖：安装后可以得到更准确的计数
+    _TIKTOKEN_AVAILABLE = True
+except ImportError:
+    tiktoken = None # type: ignore
+    _TIKTOKEN_AVAILABLE = False
+
+
+class TokenEstimator:
+    """离线估算文本的 token 数，用于按预算截取历史。不同实现只需覆盖 count。"""
+    name = "base"
+    IMAGE_TOKENS_DEFAULT = 256 # 每张图片按固定 token 数预留
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class HeuristicTokenEstimator(TokenEstimator):
+    # 中日韩字符大致一字一 token；其余文本按单词/符号切分，长单词约每 4 个字符一个 token
+    name = "heuristic"
+    _CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+    _WORD_PATTERN = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_]")
+
+    def count(self, text: str) -> int:
+        if not text: return 0
+        cjk_count = len(self._CJK_PATTERN.findall(text))
+        rest = self._CJK_PATTERN.sub(" ", text) if cjk_count else text
+        other_count = 0
+        for token in self._WORD_PATTERN.findall(rest):
+            other_count += (len(token) + 3) // 4 if len(token) > 4 else 1
+        return cjk_count + other_count
+
+
+class TiktokenEstimator(TokenEstimator):
+    name = "tiktoken"
+    ENCODING_NAME = "cl100k_base"
+
+    def __init__(self):
+        self._encoding = tiktoken.get_encoding(self.ENCODING_NAME) # type: ignore
+
+    def count(self, text: str) -> int:
+        if not text: return 0
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+TOKEN_ESTIMATORS: Dict[str, Type[TokenEstimator]] = {
+    HeuristicTokenEstimator.name: HeuristicTokenEstimator,
+    TiktokenEstimator.name: TiktokenEstimator,
+}
+
+
+def create_token_estimator(estimator_name: Optional[str]) -> TokenEstimator:
+    name = (estimator_name or HeuristicTokenEstimator.name).strip().lower()
+    estimator_cls = TOKEN_ESTIMATORS.get(name)
+    if estimator_cls is None:
+        logger.warning(f"RelayChat TokenEstimator: 未知的 token 估算器 '{estimator_name}'，使用 '{HeuristicTokenEstimator.name}'。")
+        estimator_cls = HeuristicTokenEstimator
+    if estimator_cls is TiktokenEstimator:
+        if not _TIKTOKEN_AVAILABLE:
+            logger.warning("RelayChat TokenEstimator: 未安装 tiktoken，改用启发式估算。")
+            return HeuristicTokenEstimator()
+        try: return TiktokenEstimator()
+        except Exception as e: # 编码表需要联网下载，离线环境下可能失败
+            logger.warning(f"RelayChat TokenEstimator: 加载 tiktoken 编码失败 ({e})，改用启发式估算。")
+            return HeuristicTokenEstimator()
+    return estimator_cls()
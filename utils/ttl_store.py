@@ -0,0 +1,118 @@
+# astrbot_plugin_relaychat/utils/ttl_store.py
+
+import time
+import heapq
+import asyncio
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from astrbot.api.all import logger
+
+
+class TTLStore:
+    """
+    带过期时间和容量上限的键值存储。
+    过期时间放在最小堆中 (O(log n))，后台任务定期清理过期条目；超出容量时淘汰最早过期的条目。
+    """
+    SWEEP_INTERVAL_SECONDS_DEFAULT = 30.0
+
+    def __init__(self, name: str, max_entries: int, default_ttl: float):
+        self.name = name
+        self.max_entries = max(1, int(max_entries))
+        self.default_ttl = float(default_ttl)
+        self._entries: Dict[Hashable, Tuple[float, Any, int]] = {} # key -> (expires_at, value, seq)
+        self._heap: List[Tuple[float, int, Hashable]] = [] # 惰性删除：刷新或删除后旧的堆节点在弹出时丢弃
+        self._seq = 0
+        self._lock = threading.Lock() # 允许在非事件循环线程中同步读取
+        self._sweep_task: Optional[asyncio.Task] = None
+        self.sweep_interval = self.SWEEP_INTERVAL_SECONDS_DEFAULT
+        self.expired_evictions = 0
+        self.capacity_evictions = 0
+
+    def configure(self, max_entries: Optional[int] = None, default_ttl: Optional[float] = None, sweep_interval: Optional[float] = None):
+        with self._lock:
+            if max_entries is not None: self.max_entries = max(1, int(max_entries))
+            if default_ttl is not None: self.default_ttl = float(default_ttl)
+            if sweep_interval is not None: self.sweep_interval = max(0.1, float(sweep_interval))
+            self._evict_over_capacity(time.monotonic())
+
+    def set(self, key: Hashable, value: Any = True, ttl: Optional[float] = None):
+        now = time.monotonic()
+        expires_at = now + (self.default_ttl if ttl is None else float(ttl))
+        with self._lock:
+            self._seq += 1
+            self._entries[key] = (expires_at, value, self._seq)
+            heapq.heappush(self._heap, (expires_at, self._seq, key))
+            self._evict_over_capacity(now)
+            if len(self._heap) > 2 * len(self._entries) + 64: self._rebuild_heap()
+        self._ensure_sweeper()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None: return default
+            if item[0] <= time.monotonic():
+                del self._entries[key]; self.expired_evictions += 1
+                return default
+            return item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._entries.pop(key, None)
+        return item[1] if item is not None else default
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_expired_locked(time.monotonic())
+
+    def _purge_expired_locked(self, now: float) -> int:
+        purged = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            item = self._entries.get(key)
+            if item is not None and item[2] == seq:
+                del self._entries[key]; purged += 1
+        self.expired_evictions += purged
+        return purged
+
+    def _evict_over_capacity(self, now: float):
+        if len(self._entries) <= self.max_entries: return
+        self._purge_expired_locked(now)
+        while len(self._entries) > self.max_entries and self._heap:
+            _, seq, key = heapq.heappop(self._heap)
+            item = self._entries.get(key)
+            if item is not None and item[2] == seq:
+                del self._entries[key]; self.capacity_evictions += 1
+
+    def _rebuild_heap(self):
+        self._heap = [(expires_at, seq, key) for key, (expires_at, _, seq) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _ensure_sweeper(self):
+        if self._sweep_task and not self._sweep_task.done(): return
+        try: self._sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+        except RuntimeError: pass # 没有运行中的事件循环时只依赖访问时的惰性过期
+
+    async def _sweep_loop(self):
+        # 没有条目时退出，下次写入时再启动
+        while self._entries:
+            await asyncio.sleep(self.sweep_interval)
+            purged = self.purge_expired()
+            if purged: logger.debug(f"TTLStore '{self.name}': 清理了 {purged} 个过期条目，剩余 {len(self._entries)} 个。")
+
+    def stop(self):
+        if self._sweep_task and not self._sweep_task.done(): self._sweep_task.cancel()
+        self._sweep_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries), "max_entries": self.max_entries,
+            "expired_evictions": self.expired_evictions, "capacity_evictions": self.capacity_evictions,
+        }